@@ -0,0 +1,178 @@
+"""Cold-start benchmark of the Lambda handlers.
+
+Runs each handler in a fresh Python process and reports the time taken to
+import its module and the latency of its first (cold) and second (warm)
+invocations. AWS API calls are answered in process by FakeConnect and
+canned SSM responses, so the first invocation includes the boto3 import
+and client construction but no network time.
+
+    python benchmarks/cold_start.py --runs 10
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+LAMBDAS_DIR = os.path.join(BENCHMARK_DIR, '..', 'lambdas')
+
+# Lambda directory of each handler module
+HANDLERS = {
+    'okta': 'user_management',
+    'azure': 'user_management',
+    'lambda_authorizer': 'lambda_authorizer',
+    'custom_resource': 'custom_resource'
+}
+
+API_TOKEN = 'benchmark-token'
+
+# Responses of the SSM calls made by the authorizer and the custom resource
+SSM_RESPONSES = {
+    'GetParameter': {'Parameter': {'Name': 'benchmark-parameter', 'Value': API_TOKEN}},     # noqa: E501
+    'PutParameter': {'Version': 1},
+    'DeleteParameters': {'DeletedParameters': ['benchmark-parameter']}
+}
+
+
+class FakeContext(object):
+    """The attributes of the Lambda context read by the handlers."""
+
+    log_stream_name = 'benchmark-log-stream'
+
+    def get_remaining_time_in_millis(self):
+        return 30000
+
+
+class FakeHttpResponse(object):
+    """The attributes of the urllib3 response read by the custom resource."""
+
+    status = 200
+    reason = 'OK'
+
+
+def install_fakes():
+    """To answer the AWS and HTTP calls of the handlers in process.
+
+    botocore is imported by the handlers when they create their first
+    client, so the import here stands in for that one.
+    """
+    import botocore
+    import botocore.client
+    from fake_connect import FakeConnect
+    fake = FakeConnect(users=100)
+
+    def make_api_call(client, operation_name, api_params):
+        if client.meta.service_model.service_name == 'connect':
+            return getattr(fake, botocore.xform_name(operation_name))(**api_params)     # noqa: E501
+        return SSM_RESPONSES[operation_name]
+    botocore.client.BaseClient._make_api_call = make_api_call
+    try:
+        import urllib3
+        urllib3.PoolManager.request = lambda self, method, url, **kwargs: FakeHttpResponse()     # noqa: E501
+    except ImportError:
+        pass
+    return fake
+
+
+def build_event(name, fake):
+    """To build the event of the first request a container serves."""
+    import fixtures
+    users = list(fake.users.values())
+    if name == 'okta':
+        return fixtures.okta_get_user(users[0]['Username'])
+    if name == 'azure':
+        return fixtures.azure_get_user(users[0]['Id'], 'ext0')
+    if name == 'lambda_authorizer':
+        return {
+            'type': 'TOKEN',
+            'authorizationToken': 'Bearer ' + API_TOKEN,
+            'methodArn': 'arn:aws:execute-api:us-east-1:123456789012:abcdef1234/prod/GET/scim/v2/Users'     # noqa: E501
+        }
+    return {
+        'RequestType': 'Create',
+        'ResourceProperties': {'ApiLength': '30'},
+        'ResponseURL': 'https://cloudformation-custom-resource-response.example.com/',     # noqa: E501
+        'StackId': 'benchmark-stack',
+        'RequestId': 'benchmark-request',
+        'LogicalResourceId': 'benchmark-resource'
+    }
+
+
+def run_child(name, lambdas_dir):
+    """To measure one cold start of a handler in this process."""
+    import io
+    import logging
+    import contextlib
+    import importlib
+    sys.path.insert(0, os.path.join(lambdas_dir, HANDLERS[name]))
+    started = time.perf_counter()
+    module = importlib.import_module(name)
+    import_ms = (time.perf_counter() - started) * 1000
+    logging.disable(logging.CRITICAL)
+    sys.path.insert(0, BENCHMARK_DIR)
+    timings = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        started = time.perf_counter()
+        fake = install_fakes()
+        event = build_event(name, fake)
+        module.lambda_handler(event, FakeContext())
+        timings.append((time.perf_counter() - started) * 1000)
+        started = time.perf_counter()
+        module.lambda_handler(event, FakeContext())
+        timings.append((time.perf_counter() - started) * 1000)
+    return {'import_ms': import_ms, 'first_ms': timings[0], 'warm_ms': timings[1]}     # noqa: E501
+
+
+def measure(name, runs, lambdas_dir):
+    """To run a handler cold in runs fresh processes."""
+    env = dict(
+        os.environ,
+        AWS_DEFAULT_REGION='us-east-1',
+        AWS_ACCESS_KEY_ID='benchmark',
+        AWS_SECRET_ACCESS_KEY='benchmark',
+        INSTANCE_ID='benchmark-instance',
+        PARAMETER_NAME='benchmark-parameter',
+        DEFAULT_ROUTING_PROFILE='Basic Routing Profile'
+    )
+    samples = []
+    for run in range(runs):
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--child', name, '--lambdas-dir', lambdas_dir],     # noqa: E501
+            env=env, check=True, stdout=subprocess.PIPE
+        )
+        samples.append(json.loads(output.stdout.decode('utf-8').strip().splitlines()[-1]))     # noqa: E501
+    result = {}
+    for key in ('import_ms', 'first_ms', 'warm_ms'):
+        values = sorted(sample[key] for sample in samples)
+        result[key] = values[len(values) // 2]
+    result['cold_ms'] = result['import_ms'] + result['first_ms']
+    return result
+
+
+def main():
+    """To parse the command line and run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--handlers', nargs='+', choices=sorted(HANDLERS), default=list(HANDLERS))     # noqa: E501
+    parser.add_argument('--runs', type=int, default=5, help='fresh processes per handler, the median is reported')     # noqa: E501
+    parser.add_argument('--lambdas-dir', default=LAMBDAS_DIR, help='lambdas directory to measure, to compare two trees')     # noqa: E501
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')     # noqa: E501
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        print(json.dumps(run_child(args.child, args.lambdas_dir)))
+        return
+    results = dict((name, measure(name, args.runs, args.lambdas_dir)) for name in args.handlers)     # noqa: E501
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print("runs=%s (median)" % args.runs)
+    print("%-18s %10s %10s %10s %10s" % ('handler', 'import_ms', 'first_ms', 'cold_ms', 'warm_ms'))     # noqa: E501
+    for name, result in results.items():
+        print("%-18s %10.1f %10.1f %10.1f %10.2f" % (name, result['import_ms'], result['first_ms'], result['cold_ms'], result['warm_ms']))     # noqa: E501
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""Fixtures of the handler tests, run against the in-process FakeConnect.
+
+    python -m pytest benchmarks
+"""
+
+import sys
+
+import pytest
+
+import run_benchmark
+from fake_connect import FakeConnect
+
+if run_benchmark.LAMBDA_DIR not in sys.path:
+    sys.path.insert(0, run_benchmark.LAMBDA_DIR)
+
+
+@pytest.fixture
+def fake_connect():
+    """A fake instance of 50 users, 20 security and 5 routing profiles."""
+    return FakeConnect(users=50)
+
+
+@pytest.fixture
+def okta(fake_connect):
+    """A fresh okta handler module wired to the fake instance."""
+    return run_benchmark.load_handler('okta', fake_connect, 0)
+
+
+@pytest.fixture
+def azure(fake_connect):
+    """A fresh azure handler module wired to the fake instance."""
+    return run_benchmark.load_handler('azure', fake_connect, 0)
+
+
+@pytest.fixture
+def user_names(fake_connect):
+    """The usernames of the fake instance."""
+    return sorted(user['Username'] for user in fake_connect.users.values())
+
+
+@pytest.fixture
+def profile_names(fake_connect):
+    """The security profile names of the fake instance."""
+    return [profile['Name'] for profile in fake_connect.security_profiles]
@@ -0,0 +1,189 @@
+"""In-process stand-in for the Amazon Connect API used by the benchmarks."""
+
+import time
+import uuid
+import threading
+from botocore.exceptions import ClientError
+
+
+def client_error(code, operation):
+    """To build the ClientError botocore raises for a Connect error code."""
+    return ClientError(
+        {'Error': {'Code': code, 'Message': code}},
+        operation
+    )
+
+
+class FakeConnect(object):
+    """Connect API double seeded with users, security and routing profiles.
+
+    Responses follow the shapes of the boto3 Connect client for the calls
+    made by the user management Lambdas. Every call is counted, can be
+    delayed by a simulated network latency and is rejected with
+    TooManyRequestsException once the simulated account quota is used up.
+    """
+
+    def __init__(self, users=1000, security_profiles=20, routing_profiles=5,
+                 page_size=100, latency=0.0, quota_rate=0.0, quota_burst=5):
+        self.page_size = page_size
+        self.latency = latency
+        self.quota_rate = quota_rate
+        self.quota_burst = quota_burst
+        self.quota_tokens = quota_burst
+        self.quota_updated = time.monotonic()
+        self.calls = {}
+        self.throttles = 0
+        self.lock = threading.Lock()
+        self.security_profiles = [
+            {'Id': str(uuid.uuid4()), 'Arn': 'arn:aws:connect:security-profile', 'Name': 'SecurityProfile%d' % index}     # noqa: E501
+            for index in range(security_profiles)
+        ]
+        self.routing_profiles = [
+            {'Id': str(uuid.uuid4()), 'Arn': 'arn:aws:connect:routing-profile', 'Name': 'RoutingProfile%d' % index}     # noqa: E501
+            for index in range(routing_profiles)
+        ]
+        self.routing_profiles.append({'Id': str(uuid.uuid4()), 'Arn': 'arn:aws:connect:routing-profile', 'Name': 'Basic Routing Profile'})     # noqa: E501
+        self.users = {}
+        for index in range(users):
+            self._add_user(
+                'agent%d@example.com' % index,
+                {'FirstName': 'Agent', 'LastName': str(index)},
+                [self.security_profiles[index % security_profiles]['Id']],
+                self.routing_profiles[0]['Id']
+            )
+
+    def _add_user(self, username, identity_info, security_profile_ids,
+                  routing_profile_id):
+        userid = str(uuid.uuid4())
+        self.users[userid] = {
+            'Id': userid,
+            'Arn': 'arn:aws:connect:agent/' + userid,
+            'Username': username,
+            'IdentityInfo': identity_info,
+            'PhoneConfig': {'PhoneType': 'SOFT_PHONE'},
+            'SecurityProfileIds': list(security_profile_ids),
+            'RoutingProfileId': routing_profile_id
+        }
+        return self.users[userid]
+
+    def _call(self, operation):
+        """To count, delay and rate limit one API call."""
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            if self.quota_rate:
+                now = time.monotonic()
+                self.quota_tokens = min(self.quota_burst, self.quota_tokens + (now - self.quota_updated) * self.quota_rate)     # noqa: E501
+                self.quota_updated = now
+                if self.quota_tokens < 1:
+                    self.throttles += 1
+                    raise client_error('TooManyRequestsException', operation)
+                self.quota_tokens -= 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _user(self, userid, operation):
+        if userid not in self.users:
+            raise client_error('ResourceNotFoundException', operation)
+        return self.users[userid]
+
+    def _page(self, items, key, MaxResults=None, NextToken=None):
+        size = min(MaxResults or self.page_size, self.page_size)
+        start = int(NextToken or 0)
+        page = {key: items[start:start + size]}
+        if start + size < len(items):
+            page['NextToken'] = str(start + size)
+        return page
+
+    def total_calls(self):
+        """To get the number of API calls made so far."""
+        return sum(self.calls.values())
+
+    def reset_calls(self):
+        """To reset the call counters."""
+        self.calls = {}
+        self.throttles = 0
+
+    # boto3 Connect client operations
+
+    def list_users(self, InstanceId, MaxResults=None, NextToken=None):
+        self._call('ListUsers')
+        summaries = [
+            {'Id': user['Id'], 'Arn': user['Arn'], 'Username': user['Username']}     # noqa: E501
+            for user in self.users.values()
+        ]
+        return self._page(summaries, 'UserSummaryList', MaxResults, NextToken)
+
+    def describe_user(self, InstanceId, UserId):
+        self._call('DescribeUser')
+        return {'User': dict(self._user(UserId, 'DescribeUser'))}
+
+    @staticmethod
+    def _matches(user, criteria):
+        """To evaluate SearchUsers criteria on a user."""
+        if 'AndConditions' in criteria:
+            return all(FakeConnect._matches(user, item) for item in criteria['AndConditions'])     # noqa: E501
+        if 'OrConditions' in criteria:
+            return any(FakeConnect._matches(user, item) for item in criteria['OrConditions'])     # noqa: E501
+        condition = criteria.get('StringCondition')
+        if not condition:
+            return True
+        if condition['FieldName'] in ('FirstName', 'LastName'):
+            value = user['IdentityInfo'].get(condition['FieldName'], '')
+        else:
+            value = user[{'Username': 'Username', 'ResourceId': 'Id'}[condition['FieldName']]]     # noqa: E501
+        return {
+            'EXACT': lambda: value == condition['Value'],
+            'STARTS_WITH': lambda: value.startswith(condition['Value']),
+            'CONTAINS': lambda: condition['Value'] in value
+        }[condition['ComparisonType']]()
+
+    def search_users(self, InstanceId, SearchCriteria=None, MaxResults=None,
+                     NextToken=None, SearchFilter=None):
+        self._call('SearchUsers')
+        users = [user for user in self.users.values() if self._matches(user, SearchCriteria or {})]     # noqa: E501
+        page = self._page([dict(user) for user in users], 'Users', MaxResults, NextToken)     # noqa: E501
+        page['ApproximateTotalCount'] = len(users)
+        return page
+
+    def list_security_profiles(self, InstanceId, MaxResults=None,
+                               NextToken=None):
+        self._call('ListSecurityProfiles')
+        return self._page(self.security_profiles, 'SecurityProfileSummaryList', MaxResults, NextToken)     # noqa: E501
+
+    def list_routing_profiles(self, InstanceId, MaxResults=None,
+                              NextToken=None):
+        self._call('ListRoutingProfiles')
+        return self._page(self.routing_profiles, 'RoutingProfileSummaryList', MaxResults, NextToken)     # noqa: E501
+
+    def describe_security_profile(self, SecurityProfileId, InstanceId):
+        self._call('DescribeSecurityProfile')
+        for profile in self.security_profiles:
+            if profile['Id'] == SecurityProfileId:
+                return {'SecurityProfile': {'Id': profile['Id'], 'SecurityProfileName': profile['Name']}}     # noqa: E501
+        raise client_error('ResourceNotFoundException', 'DescribeSecurityProfile')     # noqa: E501
+
+    def create_user(self, Username, IdentityInfo, PhoneConfig,
+                    SecurityProfileIds, RoutingProfileId, InstanceId,
+                    **kwargs):
+        self._call('CreateUser')
+        if any(user['Username'] == Username for user in self.users.values()):
+            raise client_error('DuplicateResourceException', 'CreateUser')
+        user = self._add_user(Username, IdentityInfo, SecurityProfileIds, RoutingProfileId)     # noqa: E501
+        return {'UserId': user['Id'], 'UserArn': user['Arn']}
+
+    def delete_user(self, InstanceId, UserId):
+        self._call('DeleteUser')
+        self._user(UserId, 'DeleteUser')
+        del self.users[UserId]
+        return {}
+
+    def update_user_security_profiles(self, SecurityProfileIds, UserId,
+                                      InstanceId):
+        self._call('UpdateUserSecurityProfiles')
+        self._user(UserId, 'UpdateUserSecurityProfiles')['SecurityProfileIds'] = list(SecurityProfileIds)     # noqa: E501
+        return {}
+
+    def update_user_identity_info(self, IdentityInfo, UserId, InstanceId):
+        self._call('UpdateUserIdentityInfo')
+        self._user(UserId, 'UpdateUserIdentityInfo')['IdentityInfo'] = dict(IdentityInfo)     # noqa: E501
+        return {}
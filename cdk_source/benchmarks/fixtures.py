@@ -0,0 +1,153 @@
+"""API Gateway proxy events for the SCIM requests sent by Okta and Azure AD."""
+
+import json
+
+ENTERPRISE_SCHEMA = "urn:ietf:params:scim:schemas:extension:enterprise:2.0:User"     # noqa: E501
+
+
+def proxy_event(method, path, body=None, query=None):
+    """To build an API Gateway AWS_PROXY event for the {Users+} resource."""
+    return {
+        'httpMethod': method,
+        'pathParameters': {'Users': path},
+        'queryStringParameters': query,
+        'body': json.dumps(body) if body is not None else None,
+        'headers': {'Content-Type': 'application/scim+json'}
+    }
+
+
+def user_filter(value):
+    """To build the userName filter sent by Okta."""
+    return {'filter': 'userName eq "%s"' % value}
+
+
+def bulk_request(operations, path='Bulk', fail_on_errors=None):
+    """To build a SCIM BulkRequest of (method, path, data) operations."""
+    body = {
+        'schemas': ['urn:ietf:params:scim:api:messages:2.0:BulkRequest'],
+        'Operations': [
+            {'method': method, 'bulkId': 'op%d' % index, 'path': operation_path, 'data': data}     # noqa: E501
+            for index, (method, operation_path, data) in enumerate(operations)
+        ]
+    }
+    if fail_on_errors:
+        body['failOnErrors'] = fail_on_errors
+    return proxy_event('POST', path, body=body)
+
+
+# Okta SCIM 2.0 requests
+
+
+def okta_get_user(username, attributes=None):
+    """To build an Okta existence check, optionally projected."""
+    query = user_filter(username)
+    if attributes:
+        query['attributes'] = attributes
+    return proxy_event('GET', 'Users', query=query)
+
+
+def okta_search_users(filter_text):
+    """To build an Okta user search with any SCIM filter."""
+    return proxy_event('GET', 'Users', query={'filter': filter_text})
+
+
+def okta_list_users(start_index, count):
+    """To build an Okta user enumeration window."""
+    return proxy_event('GET', 'Users', query={'startIndex': str(start_index), 'count': str(count)})     # noqa: E501
+
+
+def okta_create_user(username, security_profiles, routing_profile=None):
+    """To build an Okta user creation."""
+    body = {
+        'schemas': ['urn:ietf:params:scim:schemas:core:2.0:User'],
+        'userName': username,
+        'name': {'givenName': 'Bench', 'familyName': 'User'},
+        'emails': [{'primary': True, 'value': username, 'type': 'work'}],
+        'entitlements': security_profiles,
+        'active': True
+    }
+    if routing_profile:
+        body['roles'] = [routing_profile]
+    return proxy_event('POST', 'Users', body=body)
+
+
+def okta_bulk_create(usernames, security_profiles):
+    """To build an Okta bulk creation of several users."""
+    return bulk_request([
+        ('POST', '/Users', json.loads(okta_create_user(username, security_profiles)['body']))     # noqa: E501
+        for username in usernames
+    ])
+
+
+def okta_update_user(userid, security_profiles):
+    """To build an Okta entitlement update."""
+    body = {
+        'schemas': ['urn:ietf:params:scim:schemas:core:2.0:User'],
+        'id': userid,
+        'entitlements': security_profiles
+    }
+    return proxy_event('PUT', 'Users', body=body, query=user_filter(userid))
+
+
+def okta_deactivate_user(userid):
+    """To build an Okta deactivation."""
+    body = {
+        'schemas': ['urn:ietf:params:scim:api:messages:2.0:PatchOp'],
+        'Operations': [{'op': 'replace', 'value': {'active': False}}]
+    }
+    return proxy_event('PATCH', 'Users', body=body, query=user_filter(userid))
+
+
+# Azure AD SCIM 2.0 requests
+
+
+def azure_get_user(userid, external_id):
+    """To build an Azure AD user read."""
+    return proxy_event('GET', 'scim/Users/%s%%3F%s' % (userid, external_id))
+
+
+def azure_list_users(start_index, count):
+    """To build an Azure AD user enumeration window."""
+    return proxy_event('GET', 'scim/Users', query={'startIndex': str(start_index), 'count': str(count)})     # noqa: E501
+
+
+def azure_create_user(username, external_id, security_profiles):
+    """To build an Azure AD user creation."""
+    body = {
+        'schemas': ['urn:ietf:params:scim:schemas:core:2.0:User', ENTERPRISE_SCHEMA],     # noqa: E501
+        'externalId': external_id,
+        'userName': username,
+        'active': True,
+        'name': {'givenName': 'Bench', 'familyName': 'User'},
+        ENTERPRISE_SCHEMA: {'department': ','.join(security_profiles)}
+    }
+    return proxy_event('POST', 'scim/Users', body=body)
+
+
+def azure_bulk_create(usernames, security_profiles):
+    """To build an Azure AD bulk creation of several users."""
+    return bulk_request([
+        ('POST', '/Users', json.loads(azure_create_user(username, 'ext-%s' % username, security_profiles)['body']))     # noqa: E501
+        for username in usernames
+    ], path='scim/Bulk')
+
+
+def azure_update_user(userid, external_id, security_profiles):
+    """To build an Azure AD department update."""
+    body = {
+        'schemas': ['urn:ietf:params:scim:api:messages:2.0:PatchOp'],
+        'Operations': [
+            {'op': 'Replace', 'path': 'department', 'value': profile}
+            for profile in security_profiles
+        ]
+    }
+    return proxy_event('PATCH', 'scim/Users/%s%%3F%s' % (userid, external_id), body=body)     # noqa: E501
+
+
+def azure_deactivate_user(userid, external_id):
+    """To build an Azure AD deactivation."""
+    body = {
+        'schemas': ['urn:ietf:params:scim:api:messages:2.0:PatchOp'],
+        'Operations': [{'op': 'Replace', 'path': 'active', 'value': 'False'}]
+    }
+    return proxy_event('PATCH', 'scim/Users/%s%%3F%s' % (userid, external_id), body=body)     # noqa: E501
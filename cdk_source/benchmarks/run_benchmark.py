@@ -0,0 +1,186 @@
+"""Offline benchmark of the SCIM user management Lambda handlers.
+
+Drives lambda_handler of okta.py or azure.py with SCIM events against an
+in-process FakeConnect, and reports the Connect API calls per request, the
+p50/p99 latency and the throughput of each kind of request.
+
+    python benchmarks/run_benchmark.py --idp okta --users 15000 --latency 0.02
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import importlib
+
+import fixtures
+from fake_connect import FakeConnect
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambdas', 'user_management')     # noqa: E501
+
+# Modules holding warm-container state, reloaded for every benchmark run
+LAMBDA_MODULES = ('okta', 'azure', 'user_index', 'profile_catalog', 'user_lookup', 'rate_limiter', 'identity_store', 'write_queue', 'user_replica', 'idempotency', 'fan_out', 'call_ledger')     # noqa: E501
+
+
+def load_handler(idp, fake, client_rate, user_replica=False):
+    """To import a fresh handler module wired to the fake Connect client.
+
+    With user_replica the GETs are answered from an in-memory replica,
+    verified against the fake instance before the scenarios run. The calls
+    are recorded in the call ledger as in production, but no EMF line is
+    printed. POST retries are replayed from an in-memory create ledger.
+    """
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ['INSTANCE_ID'] = 'benchmark-instance'
+    os.environ['DEFAULT_ROUTING_PROFILE'] = 'Basic Routing Profile'
+    os.environ['USER_REPLICA_MODE'] = 'memory' if user_replica else 'off'
+    os.environ['CALL_LEDGER_MODE'] = 'off'
+    os.environ['IDEMPOTENCY_MODE'] = 'memory'
+    if LAMBDA_DIR not in sys.path:
+        sys.path.insert(0, LAMBDA_DIR)
+    for name in LAMBDA_MODULES:
+        sys.modules.pop(name, None)
+    handler = importlib.import_module(idp)
+    rate_limiter = importlib.import_module('rate_limiter')
+    call_ledger = importlib.import_module('call_ledger')
+    limiter = rate_limiter.TokenBucket(rate=client_rate, burst=max(1.0, client_rate)) if client_rate else rate_limiter.TokenBucket(rate=1e9, burst=1e9)     # noqa: E501
+    handler.CONNECT_CLIENT = rate_limiter.RateLimitedClient(call_ledger.LedgerClient(fake), limiter=limiter, ledger=call_ledger.LEDGER)     # noqa: E501
+    if user_replica:
+        handler.verify_handler({}, None)
+    logging.getLogger().setLevel(logging.ERROR)
+    return handler
+
+
+def percentile(values, fraction):
+    """To get a percentile of a list of values."""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]     # noqa: E501
+
+
+def build_scenarios(idp, fake, requests, bulk_size, rng):
+    """To build the events of each benchmarked request kind."""
+    existing = rng.sample(list(fake.users.values()), min(requests * 3, len(fake.users)))     # noqa: E501
+    reads = existing[:requests]
+    updates = existing[requests:2 * requests]
+    deletes = existing[2 * requests:3 * requests]
+    names = [profile['Name'] for profile in fake.security_profiles]
+    names_by_id = dict((profile['Id'], profile['Name']) for profile in fake.security_profiles)     # noqa: E501
+
+    def current_names(user):
+        return [names_by_id[profile_id] for profile_id in user['SecurityProfileIds']]     # noqa: E501
+    if idp == 'okta':
+        creates = [fixtures.okta_create_user('new%d@example.com' % index, rng.sample(names, 2)) for index in range(requests)]     # noqa: E501
+        return [
+            ('get_existing', [fixtures.okta_get_user(user['Username']) for user in reads]),     # noqa: E501
+            ('get_projected', [fixtures.okta_get_user(user['Username'], 'id,userName') for user in reads]),     # noqa: E501
+            ('get_missing', [fixtures.okta_get_user('missing%d@example.com' % index) for index in range(requests)]),     # noqa: E501
+            ('list', [fixtures.okta_list_users(rng.randint(1, len(fake.users)), 100) for index in range(requests)]),     # noqa: E501
+            ('search', [fixtures.okta_search_users('userName sw "%s"' % user['Username'][:-12]) for user in reads]),     # noqa: E501
+            ('create', creates),
+            ('create_retry', creates),
+            ('bulk_create', [fixtures.okta_bulk_create(['bulk%d.%d@example.com' % (index, item) for item in range(bulk_size)], rng.sample(names, 2)) for index in range(requests)]),     # noqa: E501
+            ('update', [fixtures.okta_update_user(user['Id'], rng.sample(names, 2)) for user in updates]),     # noqa: E501
+            ('repush', [fixtures.okta_update_user(user['Id'], current_names(user)) for user in reads]),     # noqa: E501
+            ('deactivate', [fixtures.okta_deactivate_user(user['Id']) for user in deletes])     # noqa: E501
+        ]
+    creates = [fixtures.azure_create_user('new%d@example.com' % index, 'ext%d' % index, rng.sample(names, 2)) for index in range(requests)]     # noqa: E501
+    return [
+        ('get_existing', [fixtures.azure_get_user(user['Id'], 'ext%d' % index) for index, user in enumerate(reads)]),     # noqa: E501
+        ('list', [fixtures.azure_list_users(rng.randint(1, len(fake.users)), 100) for index in range(requests)]),     # noqa: E501
+        ('create', creates),
+        ('create_retry', creates),
+        ('bulk_create', [fixtures.azure_bulk_create(['bulk%d.%d@example.com' % (index, item) for item in range(bulk_size)], rng.sample(names, 2)) for index in range(requests)]),     # noqa: E501
+        ('update', [fixtures.azure_update_user(user['Id'], 'ext%d' % index, rng.sample(names, 2)) for index, user in enumerate(updates)]),     # noqa: E501
+        ('repush', [fixtures.azure_update_user(user['Id'], 'ext%d' % index, current_names(user)) for index, user in enumerate(reads)]),     # noqa: E501
+        ('deactivate', [fixtures.azure_deactivate_user(user['Id'], 'ext%d' % index) for index, user in enumerate(deletes)])     # noqa: E501
+    ]
+
+
+def run_scenario(handler, fake, events):
+    """To run the events of one request kind and measure them."""
+    latencies = []
+    calls = []
+    throttles = 0
+    errors = 0
+    started = time.perf_counter()
+    for event in events:
+        fake.reset_calls()
+        request_started = time.perf_counter()
+        try:
+            handler.lambda_handler(event, None)
+        except Exception:     # noqa: B902
+            errors += 1
+        latencies.append(time.perf_counter() - request_started)
+        calls.append(fake.total_calls())
+        throttles += fake.throttles
+    elapsed = time.perf_counter() - started
+    return {
+        'requests': len(events),
+        'errors': errors,
+        'calls_per_request': sum(calls) / len(calls),
+        'max_calls': max(calls),
+        'throttles': throttles,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'throughput_rps': len(events) / elapsed if elapsed else 0.0
+    }
+
+
+def run_benchmark(args):
+    """To run every request kind against a freshly seeded fake instance."""
+    rng = random.Random(args.seed)
+    fake = FakeConnect(
+        users=args.users,
+        security_profiles=args.security_profiles,
+        routing_profiles=args.routing_profiles,
+        page_size=args.page_size,
+        latency=args.latency,
+        quota_rate=args.quota_rate,
+        quota_burst=args.quota_burst
+    )
+    scenarios = build_scenarios(args.idp, fake, args.requests, args.bulk_size, rng)     # noqa: E501
+    handler = load_handler(args.idp, fake, args.client_rate, args.user_replica)
+    results = {}
+    for name, events in scenarios:
+        results[name] = run_scenario(handler, fake, events)
+    return results
+
+
+def print_results(args, results):
+    """To print the results as a table."""
+    print("idp=%s users=%s page_size=%s latency=%ss quota_rate=%s" % (args.idp, args.users, args.page_size, args.latency, args.quota_rate))     # noqa: E501
+    print("%-14s %8s %7s %11s %9s %9s %10s %10s %10s" % ('request', 'count', 'errors', 'calls/req', 'max_calls', 'throttles', 'p50_ms', 'p99_ms', 'req/s'))     # noqa: E501
+    for name, result in results.items():
+        print("%-14s %8d %7d %11.2f %9d %9d %10.2f %10.2f %10.1f" % (name, result['requests'], result['errors'], result['calls_per_request'], result['max_calls'], result['throttles'], result['p50_ms'], result['p99_ms'], result['throughput_rps']))     # noqa: E501
+
+
+def main():
+    """To parse the command line and run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--idp', choices=['okta', 'azure'], default='okta')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--security-profiles', type=int, default=20)
+    parser.add_argument('--routing-profiles', type=int, default=5)
+    parser.add_argument('--page-size', type=int, default=100, help='largest page the fake returns')     # noqa: E501
+    parser.add_argument('--requests', type=int, default=50, help='requests per request kind')     # noqa: E501
+    parser.add_argument('--bulk-size', type=int, default=20, help='operations per bulk request')     # noqa: E501
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated seconds per Connect call')     # noqa: E501
+    parser.add_argument('--quota-rate', type=float, default=0.0, help='simulated account quota in requests per second, 0 for none')     # noqa: E501
+    parser.add_argument('--quota-burst', type=float, default=5)
+    parser.add_argument('--client-rate', type=float, default=0.0, help='client side pacing in requests per second, 0 for none')     # noqa: E501
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--user-replica', action='store_true', help='answer the GETs from an in-memory user replica')     # noqa: E501
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')     # noqa: E501
+    args = parser.parse_args()
+    results = run_benchmark(args)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(args, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Tests of the coalescing of PATCH operations and queued mutations."""
+
+import json
+
+from coalesce import (coalesce_mutations, coalesce_operations, merge_states,
+                      patch_operations)
+from write_queue import mutation
+
+
+def test_coalesce_operations():
+    state = coalesce_operations([
+        {'op': 'Add', 'path': 'department', 'value': 'Agent'},
+        {'op': 'Add', 'path': 'department', 'value': 'Admin, QA'},
+        {'op': 'Replace', 'path': 'title', 'value': 'first'},
+        {'op': 'Replace', 'path': 'title', 'value': 'last'},
+        {'op': 'Remove', 'path': 'nickName'},
+        {'op': 'Replace', 'path': 'active', 'value': 'False'}
+    ])
+    assert state == {
+        'department': ['Agent', 'Admin', 'QA'],
+        'title': 'last',
+        'nickName': None,
+        'active': False
+    }
+
+
+def test_coalesce_okta_deactivation():
+    assert coalesce_operations([{'op': 'replace', 'value': {'active': False}}]) == {'active': False}     # noqa: E501
+
+
+def test_patch_operations_round_trip():
+    state = merge_states(
+        {'department': ['Agent'], 'active': True},
+        {'department': ['Admin', 'QA'], 'title': None}
+    )
+    assert coalesce_operations(patch_operations(state)) == {
+        'department': ['Admin', 'QA'],
+        'active': True,
+        'title': None
+    }
+
+
+def test_coalesce_mutations_per_user():
+    messages = [
+        mutation('update', 'a', json.dumps({'entitlements': ['1']})),
+        mutation('update', 'b', json.dumps({'entitlements': ['2']})),
+        mutation('update', 'a', json.dumps({'entitlements': ['3']})),
+        mutation('delete', 'b', '{}')
+    ]
+
+    def merge(previous, message):
+        return message if message['operation'] == previous['operation'] else None     # noqa: E501
+
+    groups = coalesce_mutations(messages, merge)
+    assert [(message['user'], message['operation'], ids) for message, ids in groups] == [     # noqa: E501
+        ('a', 'update', [messages[0]['id'], messages[2]['id']]),
+        ('b', 'update', [messages[1]['id']]),
+        ('b', 'delete', [messages[3]['id']])
+    ]
+    assert json.loads(groups[0][0]['body']) == {'entitlements': ['3']}
+
+
+def test_okta_merge_create_and_update(okta):
+    create = mutation('create', 'new.user', json.dumps({'userName': 'new.user', 'entitlements': ['1']}))     # noqa: E501
+    update = mutation('update', 'new.user', json.dumps({'entitlements': ['2', '3']}))     # noqa: E501
+    merged = okta.merge_user_mutations(create, update)
+    assert merged['operation'] == 'create'
+    assert json.loads(merged['body'])['entitlements'] == ['2', '3']
+
+
+def test_azure_merge_patches(azure):
+    first = mutation('patch', 'u', json.dumps({'Operations': [{'op': 'Add', 'path': 'department', 'value': 'Agent'}]}))     # noqa: E501
+    second = mutation('patch', 'u', json.dumps({'Operations': [{'op': 'Replace', 'path': 'active', 'value': 'False'}]}))     # noqa: E501
+    merged = azure.merge_user_mutations(first, second)
+    assert coalesce_operations(json.loads(merged['body'])['Operations']) == {'department': ['Agent'], 'active': False}     # noqa: E501
@@ -0,0 +1,78 @@
+"""Tests of the idempotent user creation of the POSTs."""
+
+import json
+
+import pytest
+
+import fixtures
+from idempotency import CreateLedger, MemoryTable, idempotent_create
+from scim_bulk import ScimError
+
+
+def create_events(profile_names):
+    """To get the Okta and Azure AD creations of a new user."""
+    return {
+        'okta': fixtures.okta_create_user('new.user@example.com', profile_names[:1]),     # noqa: E501
+        'azure': fixtures.azure_create_user('new.user@example.com', 'new-user', profile_names[:1])     # noqa: E501
+    }
+
+
+@pytest.mark.parametrize('idp', ['okta', 'azure'])
+def test_retry_replayed(idp, request, fake_connect, profile_names):
+    handler = request.getfixturevalue(idp)
+    event = create_events(profile_names)[idp]
+    first = handler.lambda_handler(event, None)
+    fake_connect.reset_calls()
+    retry = handler.lambda_handler(event, None)
+    assert json.loads(retry['body'])['id'] == json.loads(first['body'])['id']
+    assert fake_connect.total_calls() == 0
+
+
+@pytest.mark.parametrize('idp', ['okta', 'azure'])
+def test_retry_without_ledger(idp, request, fake_connect, profile_names):
+    handler = request.getfixturevalue(idp)
+    handler.CREATE_LEDGER = None
+    event = create_events(profile_names)[idp]
+    first = handler.lambda_handler(event, None)
+    fake_connect.reset_calls()
+    retry = handler.lambda_handler(event, None)
+    assert json.loads(retry['body'])['id'] == json.loads(first['body'])['id']
+    assert 'CreateUser' not in fake_connect.calls
+
+
+def test_changed_payload_gets_existing_user():
+    ledger = CreateLedger(MemoryTable())
+    created = []
+
+    def create(body):
+        created.append(body)
+        return dict(json.loads(body), id='user-id')
+
+    def existing(body):
+        return dict(json.loads(body), id='user-id') if created else None
+
+    body = json.dumps({'userName': 'a', 'title': 'first'})
+    assert idempotent_create(ledger, body, create, existing)['title'] == 'first'     # noqa: E501
+    body = json.dumps({'userName': 'a', 'title': 'second'})
+    assert idempotent_create(ledger, body, create, existing) == {'userName': 'a', 'title': 'second', 'id': 'user-id'}     # noqa: E501
+    assert len(created) == 1
+
+
+def test_pending_create_conflicts():
+    ledger = CreateLedger(MemoryTable(), wait=0)
+    ledger.claim('a', 'another request')
+    with pytest.raises(ScimError) as error:
+        idempotent_create(ledger, json.dumps({'userName': 'a'}), lambda body: {}, lambda body: None)     # noqa: E501
+    assert error.value.status == 409
+
+
+def test_failed_create_released():
+    ledger = CreateLedger(MemoryTable())
+    body = json.dumps({'userName': 'a'})
+
+    def failing(body):
+        raise RuntimeError('create failed')
+
+    with pytest.raises(RuntimeError):
+        idempotent_create(ledger, body, failing, lambda body: None)
+    assert idempotent_create(ledger, body, lambda body: {'id': 'user-id'}, lambda body: None) == {'id': 'user-id'}     # noqa: E501
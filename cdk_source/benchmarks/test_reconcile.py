@@ -0,0 +1,88 @@
+"""Tests of the checkpoints of a reconciliation run."""
+
+import json
+import functools
+from types import SimpleNamespace
+
+import pytest
+
+import reconcile
+
+
+class LambdaClient(object):
+    """Records the asynchronous invocations of a reconciliation."""
+
+    def __init__(self):
+        self.invocations = []
+
+    def invoke(self, **kwargs):
+        self.invocations.append(kwargs)
+
+
+@pytest.fixture
+def lambda_client(monkeypatch, tmp_path):
+    """Checkpoints under tmp_path and the resume invocations recorded."""
+    lambda_client = LambdaClient()
+    monkeypatch.setattr(reconcile, 'CheckpointStore', functools.partial(reconcile.CheckpointStore, bucket=None, directory=str(tmp_path)))     # noqa: E501
+    monkeypatch.setattr(reconcile, 'client', lambda service: lambda_client)
+    return lambda_client
+
+
+def context(seconds):
+    """To get a Lambda context with seconds left above the time margin."""
+    return SimpleNamespace(
+        invoked_function_arn='arn:aws:lambda:us-east-1:123456789012:function:connect-scim-reconciler',     # noqa: E501
+        aws_request_id='request',
+        get_remaining_time_in_millis=lambda: (reconcile.RECONCILE_TIME_MARGIN + seconds) * 1000     # noqa: E501
+    )
+
+
+def export(user_names, profile_names):
+    """To get the users of an Okta export as JSON lines."""
+    return [json.dumps({
+        'userName': user_name,
+        'name': {'givenName': 'Bench', 'familyName': 'User'},
+        'entitlements': profile_names,
+        'active': True
+    }) for user_name in user_names]
+
+
+def test_resume_after_deadline(okta, fake_connect, lambda_client, profile_names):     # noqa: E501
+    event = {'users': export(['new%d@example.com' % index for index in range(5)], profile_names[:1])}     # noqa: E501
+    result = okta.reconcile_handler(event, context(-1))
+    assert result['status'] == 'in_progress'
+    assert result['applied'] == 0
+    assert result['planned'] == {'create': 5}
+    payload = json.loads(lambda_client.invocations[0]['Payload'])
+    assert lambda_client.invocations[0]['InvocationType'] == 'Event'
+    assert payload['run_id'] == result['run_id']
+
+    fake_connect.reset_calls()
+    result = okta.reconcile_handler(payload, context(600))
+    assert result['status'] == 'complete'
+    assert result['applied'] == 5
+    assert fake_connect.calls.get('CreateUser') == 5
+    assert 'ListUsers' not in fake_connect.calls
+    assert len(lambda_client.invocations) == 1
+
+
+def test_resume_from_position(okta, fake_connect, lambda_client, profile_names):     # noqa: E501
+    user_names = ['new%d@example.com' % index for index in range(4)]
+    event = {'users': export(user_names, profile_names[:1])}
+    run_id = okta.reconcile_handler(event, context(-1))['run_id']
+    store = reconcile.CheckpointStore(run_id)
+    checkpoint = store.load()
+    checkpoint['position'] = 2
+    store.save(checkpoint)
+
+    result = okta.reconcile_handler(dict(event, run_id=run_id), None)
+    assert result['applied'] == 4
+    created = set(user['Username'] for user in fake_connect.users.values())
+    assert [user_name in created for user_name in user_names] == [False, False, True, True]     # noqa: E501
+
+
+def test_dry_run_plan(okta, fake_connect, lambda_client, user_names, profile_names):     # noqa: E501
+    event = {'users': export(user_names, profile_names[:1]), 'dry_run': True}
+    result = okta.reconcile_handler(event, None)
+    assert result['status'] == 'planned'
+    assert all(action['action'] != 'create' for action in result['plan'])
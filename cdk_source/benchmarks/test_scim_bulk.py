@@ -0,0 +1,66 @@
+"""Tests of the bulkId references of the SCIM /Bulk requests."""
+
+import json
+
+import pytest
+
+import fixtures
+from scim_bulk import _resolve_data, _resolve_path
+
+
+def okta_user(username, security_profiles, given_name='Bench'):
+    """To get the data of an Okta user creation."""
+    data = json.loads(fixtures.okta_create_user(username, security_profiles)['body'])     # noqa: E501
+    data['name']['givenName'] = given_name
+    return data
+
+
+def test_resolve_path():
+    assert _resolve_path('/Users/bulkId:qwerty', {'qwerty': 'abc'}) == '/Users/abc'     # noqa: E501
+    assert _resolve_path('/Users/abc', {}) == '/Users/abc'
+    with pytest.raises(KeyError):
+        _resolve_path('/Users/bulkId:missing', {})
+
+
+def test_resolve_data_values_only():
+    data = {
+        'displayName': 'bulkId:qwerty',
+        'members': [{'type': 'User', 'value': 'bulkId:qwerty'}],
+        'Operations': [{'op': 'add', 'path': 'manager', 'value': 'see bulkId:qwerty'}]     # noqa: E501
+    }
+    assert _resolve_data(data, {'qwerty': 'abc'}) == {
+        'displayName': 'bulkId:qwerty',
+        'members': [{'type': 'User', 'value': 'abc'}],
+        'Operations': [{'op': 'add', 'path': 'manager', 'value': 'see bulkId:qwerty'}]     # noqa: E501
+    }
+
+
+def test_bulk_path_reference(okta, fake_connect, profile_names):
+    event = fixtures.bulk_request([
+        ('POST', '/Users', okta_user('bulk.user', profile_names[:1])),
+        ('PUT', '/Users/bulkId:op0', {'entitlements': profile_names[1:3]})
+    ])
+    operations = json.loads(okta.lambda_handler(event, None)['body'])['Operations']     # noqa: E501
+    assert [operation['status'] for operation in operations] == ['201', '200']     # noqa: E501
+    user = next(user for user in fake_connect.users.values() if user['Username'] == 'bulk.user')     # noqa: E501
+    assert operations[1]['location'] == '/Users/' + user['Id']
+    assert sorted(user['SecurityProfileIds']) == sorted(profile['Id'] for profile in fake_connect.security_profiles[1:3])     # noqa: E501
+
+
+def test_bulk_reference_text_kept(okta, fake_connect, profile_names):
+    event = fixtures.bulk_request([
+        ('POST', '/Users', okta_user('text.user', profile_names[:1], 'bulkId:op9'))     # noqa: E501
+    ])
+    operations = json.loads(okta.lambda_handler(event, None)['body'])['Operations']     # noqa: E501
+    assert operations[0]['status'] == '201'
+    user = next(user for user in fake_connect.users.values() if user['Username'] == 'text.user')     # noqa: E501
+    assert user['IdentityInfo']['FirstName'] == 'bulkId:op9'
+
+
+def test_bulk_unresolved_reference(okta):
+    event = fixtures.bulk_request([
+        ('PUT', '/Users/bulkId:unknown', {'entitlements': []})
+    ])
+    operations = json.loads(okta.lambda_handler(event, None)['body'])['Operations']     # noqa: E501
+    assert operations[0]['status'] == '409'
+    assert operations[0]['response']['detail'] == 'Unresolved reference bulkId:unknown'     # noqa: E501
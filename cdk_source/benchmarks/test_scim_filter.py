@@ -0,0 +1,66 @@
+"""Tests of the SCIM filter parser and of the filtered GETs."""
+
+import json
+
+import pytest
+
+import fixtures
+from scim_filter import (And, Comparison, Not, Or, Present, ScimFilterError,
+                         compile_filter, equality_value, parse_filter)
+
+
+def test_parse_precedence():
+    node = parse_filter('userName eq "a" or name.givenName sw "B" and active pr')     # noqa: E501
+    assert node == Or(
+        Comparison('userName', 'eq', 'a'),
+        And(Comparison('name.givenName', 'sw', 'B'), Present('active'))
+    )
+
+
+def test_parse_grouping_and_not():
+    node = parse_filter('not (userName eq "a\\"b") and active eq true')
+    assert node == And(Not(Comparison('userName', 'eq', 'a"b')), Comparison('active', 'eq', True))     # noqa: E501
+
+
+@pytest.mark.parametrize('text', ['userName eq', 'userName xx "a"', '(userName eq "a"', 'userName eq "a" junk'])     # noqa: E501
+def test_parse_invalid(text):
+    with pytest.raises(ScimFilterError):
+        parse_filter(text)
+
+
+def test_compile_filter():
+    user = {'userName': 'Jane.Doe', 'name': {'givenName': 'Jane'}, 'active': True}     # noqa: E501
+    assert compile_filter('username eq "jane.doe"')(user)
+    assert compile_filter('name.givenName co "an" and active eq true')(user)
+    assert not compile_filter('userName sw "john"')(user)
+    assert not compile_filter('emails pr')(user)
+
+
+def test_equality_value():
+    attributes = ('userName', 'externalId')
+    assert equality_value(parse_filter('userName eq "a" and active eq true'), attributes) == 'a'     # noqa: E501
+    assert equality_value(parse_filter('externalId eq "b"'), attributes) == 'b'     # noqa: E501
+    assert equality_value(parse_filter('userName eq "a" or userName eq "b"'), attributes) is None     # noqa: E501
+    assert equality_value(parse_filter('userName sw "a"'), attributes) is None
+
+
+def test_okta_get_by_user_name(okta, fake_connect, user_names):
+    fake_connect.reset_calls()
+    response = okta.lambda_handler(fixtures.okta_get_user(user_names[0]), None)     # noqa: E501
+    assert response['statusCode'] == 200
+    resources = json.loads(response['body'])['Resources']
+    assert [resource['userName'] for resource in resources] == [user_names[0]]     # noqa: E501
+    assert 'ListUsers' not in fake_connect.calls
+
+
+def test_okta_get_by_other_filter(okta, user_names):
+    filter_text = 'userName sw "%s"' % user_names[0]
+    response = okta.lambda_handler(fixtures.okta_search_users(filter_text), None)     # noqa: E501
+    resources = json.loads(response['body'])['Resources']
+    assert [resource['userName'] for resource in resources] == [user_names[0]]
+
+
+def test_okta_get_invalid_filter(okta):
+    response = okta.lambda_handler(fixtures.okta_search_users('userName eq'), None)     # noqa: E501
+    assert response['statusCode'] == 400
+    assert json.loads(response['body'])['scimType'] == 'invalidFilter'
@@ -6,16 +6,14 @@ import json
 from json import dumps
 import random
 import string
-import boto3
 import logging
-import urllib3
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-ssm_client = boto3.client('ssm')
-http = urllib3.PoolManager()
+# SSM client and HTTP pool, created on first use and reused by warm invocations
+clients = {}
 
 lower = string.ascii_lowercase
 num = string.digits
@@ -23,6 +21,22 @@ all = lower + num
 PARAMETER_NAME = os.getenv("PARAMETER_NAME")
 
 
+def get_ssm_client():
+    '''Returns the SSM client, importing boto3 on first use.'''
+    if 'ssm' not in clients:
+        import boto3
+        clients['ssm'] = boto3.client('ssm')
+    return clients['ssm']
+
+
+def get_http():
+    '''Returns the urllib3 pool manager, importing urllib3 on first use.'''
+    if 'http' not in clients:
+        import urllib3
+        clients['http'] = urllib3.PoolManager()
+    return clients['http']
+
+
 def send_response(event, context, response):
     '''Send a response to CloudFormation to handle the custom resource lifecycle.'''   # noqa: E501
 
@@ -44,7 +58,7 @@ def send_response(event, context, response):
           'content-length': str(len(json_responseBody))
     }
     try:
-        response = http.request('PUT', responseUrl, headers=headers, body=json_responseBody)   # noqa: E501
+        response = get_http().request('PUT', responseUrl, headers=headers, body=json_responseBody)   # noqa: E501
         print("Status code: " + response.reason)
 
     except Exception as e:
@@ -61,7 +75,7 @@ def lambda_handler(event, context):
             logger.info(f"Generating api key of length {key_length}")
             temp = random.sample(all, key_length)
             temppass = ''.join(temp)
-            ssm_client.put_parameter(Name=PARAMETER_NAME, Type='StringList', Value=f'{temppass}', Overwrite=True)   # noqa: E501
+            get_ssm_client().put_parameter(Name=PARAMETER_NAME, Type='StringList', Value=f'{temppass}', Overwrite=True)   # noqa: E501
             response = 'SUCCESS'
         except Exception as e:
             logger.info(f"Uploading API Key to Parameter store failed because of {e}")    # noqa: E501
@@ -72,7 +86,7 @@ def lambda_handler(event, context):
         send_response(event, context, response)
     if event['RequestType'] == 'Delete':
         try:
-            response = ssm_client.delete_parameters(
+            response = get_ssm_client().delete_parameters(
                 Names=[
                     PARAMETER_NAME,
                 ])
@@ -1,15 +1,208 @@
 import os
 import re
-import boto3
+import hmac
+import json
+import time
+import hashlib
 import logging
 
 
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.INFO)
 PARAMETER_NAME = os.getenv("PARAMETER_NAME")
+# Seconds the API token read from Parameter store is reused for
+TOKEN_CACHE_TTL = int(os.getenv("TOKEN_CACHE_TTL", "300"))
+# Minimum seconds between Parameter store reads forced by a token mismatch
+TOKEN_MISMATCH_REFRESH = int(os.getenv("TOKEN_MISMATCH_REFRESH", "5"))
+
+# SSM client, created by the first Parameter store read and reused by warm
+# invocations
+SSM_CLIENT = None
+
+# API token cache, reused by warm invocations
+TOKEN_CACHE = {
+    'value': None,
+    'fetchedAt': 0.0
+}
+
+# Allow decisions keyed on the token digest and the API stage, and the prebuilt
+# policy documents they return, reused by warm invocations
+DECISION_CACHE = {}
+DECISION_CACHE_SIZE = 64
+POLICY_CACHE = {}
+
+# Set to 'off' to stop publishing the per-invocation metrics
+CALL_LEDGER_MODE = os.getenv("CALL_LEDGER_MODE", "emf")
+METRICS_NAMESPACE = os.getenv("METRICS_NAMESPACE", "ConnectScimUserManagement")     # noqa: E501
+# Error codes returned by SSM when the account quota is exceeded
+THROTTLING_ERRORS = ('ThrottlingException', 'TooManyUpdates', 'Throttling')
+
+# Parameter store calls and cache lookups of the current invocation
+CALL_LEDGER = {}
+
+
+def getSsmClient():
+    '''Returns the SSM client, created on first use. The client is built from
+    a botocore session so the handler does not import boto3 for its single API
+    call.'''
+    global SSM_CLIENT
+    if SSM_CLIENT is None:
+        import botocore.session
+        SSM_CLIENT = botocore.session.get_session().create_client('ssm')
+    return SSM_CLIENT
+
+
+def startLedger():
+    '''Starts the call ledger of a new invocation.'''
+    CALL_LEDGER.clear()
+    CALL_LEDGER.update({
+        'startedAt': time.monotonic(),
+        'ssmCalls': 0,
+        'ssmThrottles': 0,
+        'ssmErrors': 0,
+        'ssmSeconds': 0.0,
+        'caches': {}
+    })
+
+
+def recordCache(cache, hit):
+    '''Records one cache lookup in the call ledger.'''
+    lookups = CALL_LEDGER.setdefault('caches', {}).setdefault(cache, {'hits': 0, 'misses': 0})     # noqa: E501
+    lookups['hits' if hit else 'misses'] += 1
+
+
+def getParameter(**kwargs):
+    '''Reads a parameter from Parameter store, recording the call and its time
+    in the call ledger.'''
+    startedAt = time.monotonic()
+    errorCode = None
+    try:
+        return getSsmClient().get_parameter(**kwargs)
+    except Exception as e:
+        errorCode = getattr(e, 'response', {}).get('Error', {}).get('Code', type(e).__name__)     # noqa: E501
+        raise
+    finally:
+        CALL_LEDGER['ssmCalls'] = CALL_LEDGER.get('ssmCalls', 0) + 1
+        CALL_LEDGER['ssmSeconds'] = CALL_LEDGER.get('ssmSeconds', 0.0) + time.monotonic() - startedAt     # noqa: E501
+        if errorCode in THROTTLING_ERRORS:
+            CALL_LEDGER['ssmThrottles'] = CALL_LEDGER.get('ssmThrottles', 0) + 1     # noqa: E501
+        elif errorCode is not None:
+            CALL_LEDGER['ssmErrors'] = CALL_LEDGER.get('ssmErrors', 0) + 1
+
+
+def publishLedger(method, context):
+    '''Prints the call ledger of the invocation as a CloudWatch embedded metric
+    format line, from which CloudWatch extracts the metrics without any
+    PutMetricData call.'''
+    caches = CALL_LEDGER.get('caches', {})
+    metrics = {
+        'SsmCalls': (CALL_LEDGER.get('ssmCalls', 0), 'Count'),
+        'SsmThrottles': (CALL_LEDGER.get('ssmThrottles', 0), 'Count'),
+        'SsmErrors': (CALL_LEDGER.get('ssmErrors', 0), 'Count'),
+        'SsmTime': (CALL_LEDGER.get('ssmSeconds', 0.0) * 1000, 'Milliseconds'),     # noqa: E501
+        'Latency': ((time.monotonic() - CALL_LEDGER.get('startedAt', time.monotonic())) * 1000, 'Milliseconds')     # noqa: E501
+    }
+    for cache, lookups in caches.items():
+        metrics[cache + 'HitRate'] = (100.0 * lookups['hits'] / (lookups['hits'] + lookups['misses']), 'Percent')     # noqa: E501
+    document = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [['Function', 'Method']],
+                'Metrics': [{'Name': name, 'Unit': unit} for name, (value, unit) in sorted(metrics.items())]     # noqa: E501
+            }]
+        },
+        'Function': 'Authorizer',
+        'Method': method,
+        'Caches': caches,
+        'RequestId': getattr(context, 'aws_request_id', None)
+    }
+    document.update((name, value) for name, (value, unit) in metrics.items())
+    print(json.dumps(document), flush=True)
+
+
+def getApiToken(forceRefresh=False):
+    '''Returns the API token from Parameter store, cached for TOKEN_CACHE_TTL seconds.'''     # noqa: E501
+    age = time.monotonic() - TOKEN_CACHE['fetchedAt']
+    refresh = forceRefresh or TOKEN_CACHE['value'] is None or age > TOKEN_CACHE_TTL     # noqa: E501
+    recordCache('TokenCache', not refresh)
+    if refresh:
+        myParameter = getParameter(Name=PARAMETER_NAME, WithDecryption=False)     # noqa: E501
+        if myParameter['Parameter']['Value'] != TOKEN_CACHE['value']:
+            DECISION_CACHE.clear()
+        TOKEN_CACHE['value'] = myParameter['Parameter']['Value']
+        TOKEN_CACHE['fetchedAt'] = time.monotonic()
+    return TOKEN_CACHE['value']
+
+
+def isValidToken(token):
+    '''Compares the token with the cached API token. A mismatch re-reads the
+    parameter once, so a token rotated by the custom resource is picked up
+    before the TTL expires. Mismatch reads are spaced by TOKEN_MISMATCH_REFRESH
+    seconds so that invalid tokens cannot drive Parameter store traffic.'''
+    if hmac.compare_digest(token.encode(), getApiToken().encode()):
+        return True
+    if time.monotonic() - TOKEN_CACHE['fetchedAt'] < TOKEN_MISMATCH_REFRESH:
+        return False
+    LOGGER.info("Token mismatch, refreshing API key from Parameter store")
+    return hmac.compare_digest(token.encode(), getApiToken(forceRefresh=True).encode())     # noqa: E501
+
+
+def getPolicy(effect, principalId, awsAccountId, region, restApiId, stage):
+    '''Returns the allow-all or deny-all policy for the API stage, built once per container.'''     # noqa: E501
+    policyKey = (effect, principalId, awsAccountId, region, restApiId, stage)
+    if policyKey not in POLICY_CACHE:
+        policy = AuthPolicy(principalId, awsAccountId)
+        policy.restApiId = restApiId
+        policy.region = region
+        policy.stage = stage
+        if effect == 'Allow':
+            policy.allowAllMethods()
+        else:
+            policy.denyAllMethods()
+        POLICY_CACHE[policyKey] = policy.build()
+    return POLICY_CACHE[policyKey]
+
+
+def getCachedDecision(decisionKey):
+    '''Returns the cached allow policy for the token and API stage, if still
+    fresh.
+
+    Only allow decisions are cached, and for no longer than the API token
+    itself, so a rotated token stops being accepted on the same schedule as the
+    token cache.'''
+    decision = DECISION_CACHE.get(decisionKey)
+    if decision is None:
+        return None
+    if time.monotonic() > decision['expiresAt']:
+        DECISION_CACHE.pop(decisionKey, None)
+        return None
+    return decision['policy']
+
+
+def cacheDecision(decisionKey, policy):
+    '''Caches an allow policy until the cached API token expires.'''
+    if len(DECISION_CACHE) >= DECISION_CACHE_SIZE:
+        DECISION_CACHE.clear()
+    DECISION_CACHE[decisionKey] = {
+        'policy': policy,
+        'expiresAt': TOKEN_CACHE['fetchedAt'] + TOKEN_CACHE_TTL
+    }
 
 
 def lambda_handler(event, context):
+    '''Authorizes the request, publishing the call ledger of the invocation.'''
+    startLedger()
+    try:
+        return authorize(event, context)
+    finally:
+        if CALL_LEDGER_MODE == 'emf':
+            methodArn = event.get('methodArn', '').split('/')
+            publishLedger(methodArn[2] if len(methodArn) > 2 else 'UNKNOWN', context)     # noqa: E501
+
+
+def authorize(event, context):
     LOGGER.info(event)
     LOGGER.info("Client token: " + event['authorizationToken'])
     LOGGER.info("Method ARN: " + event['methodArn'])
@@ -23,11 +216,20 @@ def lambda_handler(event, context):
     apiGatewayArnTmp = tmp[5].split('/')
     awsAccountId = tmp[4]
 
-    policy = AuthPolicy(principalId, awsAccountId)
-    policy.restApiId = apiGatewayArnTmp[0]
-    policy.region = tmp[3]
-    policy.stage = apiGatewayArnTmp[1]
-    
+    restApiId = apiGatewayArnTmp[0]
+    region = tmp[3]
+    stage = apiGatewayArnTmp[1]
+
+    # Requests from the IdP repeat the same token, so a fresh allow decision
+    # for the token digest and API stage is returned without reading
+    # Parameter store
+    decisionKey = (hashlib.sha256(token.encode()).hexdigest(), awsAccountId, region, restApiId, stage)     # noqa: E501
+    authResponse = getCachedDecision(decisionKey)
+    recordCache('DecisionCache', authResponse is not None)
+    if authResponse is not None:
+        LOGGER.info("Cached authorization decision used")
+        return authResponse
+
     # This is where a request would be sent to an external authentication system for token verification  # noqa: E501
     # For this demo, the token is verified if it is equal to 'allow' and other values are invalid        # noqa: E501
     
@@ -36,15 +238,12 @@ def lambda_handler(event, context):
     LOGGER.info("Read API key/ Secret key from Parameter store")
 
     try:
-        ssm = boto3.client('ssm')
-        myParameter = ssm.get_parameter(Name=PARAMETER_NAME, WithDecryption=False)     # noqa: E501
-        if(token == ((myParameter['Parameter']['Value']))):
-            policy.allowAllMethods()
+        if(isValidToken(token)):
+            authResponse = getPolicy('Allow', principalId, awsAccountId, region, restApiId, stage)     # noqa: E501
+            cacheDecision(decisionKey, authResponse)
         else:
-            policy.denyAllMethods()
+            authResponse = getPolicy('Deny', principalId, awsAccountId, region, restApiId, stage)     # noqa: E501
 
-        # Finally, build the policy
-        authResponse = policy.build()
         LOGGER.info(authResponse)
         return authResponse
     except Exception as e:
@@ -71,6 +270,8 @@ class AuthPolicy(object):
     version = '2012-10-17'
     # The regular expression used to validate resource paths for the policy
     pathRegex = '^[/.a-zA-Z0-9-\*]+$'
+    # The compiled pathRegex, shared by every policy built in the container
+    pathPattern = re.compile(pathRegex)
 
     '''Internal lists of allowed and denied methods.
 
@@ -102,8 +303,7 @@ class AuthPolicy(object):
         '''
         if verb != '*' and not hasattr(HttpVerb, verb):
             raise NameError('Invalid HTTP verb ' + verb + '. Allowed verbs in HttpVerb class')    # noqa: E501
-        resourcePattern = re.compile(self.pathRegex)
-        if not resourcePattern.match(resource):
+        if not self.pathPattern.match(resource):
             raise NameError('Invalid resource path: ' + resource + '. Path should match ' + self.pathRegex)    # noqa: E501
 
         if resource[:1] == '/':
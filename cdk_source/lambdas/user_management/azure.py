@@ -6,47 +6,102 @@
 import os
 import json
 import logging
-import boto3
-import botocore
+import botocore.exceptions
+from clients import LazyClient
+from rate_limiter import RateLimitedClient
+from user_index import UserIndex
+from profile_catalog import ProfileCatalog
+from user_lookup import lookup_connect_user
+from user_pages import UserPager, list_parameters, list_response
+from reconcile import Reconciler
+from scim_attributes import Projection, ENTERPRISE_USER_SCHEMA
+from scim_resources import ScimUser, dumps
+from scim_bulk import ScimError, is_bulk_request, bulk_deadline, process_bulk, error_response     # noqa: E501
+from coalesce import coalesce_operations, merge_states, patch_operations
+from write_queue import write_queue, mutation, drain_records, drain_queue
+from identity_store import identity_store, identity
+from user_replica import user_replica
+from idempotency import create_ledger, idempotent_create
+from fan_out import CONNECT_MAX_CONCURRENCY, run_concurrently
+from call_ledger import LEDGER, LedgerClient, instrumented
+from scim_filter import Comparison, ScimFilterError, parse_filter, compile_filter, equality_value     # noqa: E501
 
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.INFO)
 
-# boto3 service call
-CONNECT_CLIENT = boto3.client('connect')
+# boto3 service call, paced by the shared Connect rate limiter which also
+# retries throttled calls, so the botocore retries are turned off. The
+# client is created by the first Connect call of the container, with a
+# connection per concurrent call of a fan-out. Every attempt, throttled
+# ones included, and the time it waited on the limiter is recorded in the
+# call ledger of the invocation
+CONNECT_CLIENT = RateLimitedClient(LedgerClient(LazyClient('connect', max_attempts=1, max_pool_connections=CONNECT_MAX_CONCURRENCY)), ledger=LEDGER)     # noqa: E501
 
 # Environment variable
 INSTANCE_ID = os.getenv("INSTANCE_ID")
 DEFAULT_ROUTING_PROFILE = os.getenv('DEFAULT_ROUTING_PROFILE')
 
+# Users on the instance, kept warm between invocations
+USER_INDEX = UserIndex(INSTANCE_ID)
+
+# Security and routing profile names, kept warm between invocations
+SECURITY_PROFILES = ProfileCatalog(INSTANCE_ID, 'list_security_profiles', 'SecurityProfileSummaryList')     # noqa: E501
+ROUTING_PROFILES = ProfileCatalog(INSTANCE_ID, 'list_routing_profiles', 'RoutingProfileSummaryList')     # noqa: E501
+
+# list_users cursors of the SCIM list windows, kept warm between invocations
+USER_PAGES = UserPager(INSTANCE_ID)
+
+# Queue of the user mutations when they are applied asynchronously
+WRITE_QUEUE = write_queue()
+
+# Mapping of the SCIM ids onto the Connect users, when the externalId is
+# not carried in the SCIM id
+IDENTITY_STORE = identity_store()
+
+# Shadow copy of the users answering the GETs, when configured
+USER_REPLICA = user_replica()
+
+# User creations of the last minutes, replayed to the IdP retries
+CREATE_LEDGER = create_ledger()
+
 # The fuction to get connect user information
 
 
-def get_connect_user(userid):
-    """To get Connect user info."""
+def get_connect_user(userid, replica=None):
+    """To get Connect user info, from the replica when given.
+
+    userid is the SCIM id with its '?' encoded as %3F. A SCIM id found in
+    the identity store resolves the Connect user id and externalId with one
+    key lookup, otherwise the externalId is read after the '?'.
+    """
+    scim_id = userid.replace("%3F", "?")
+    record = IDENTITY_STORE.get('id', scim_id) if IDENTITY_STORE is not None else None     # noqa: E501
+    if record:
+        return resolve_connect_user(record['UserId'], record['ExternalId'], record['ScimId'], replica)     # noqa: E501
     user_info_list = userid.split("%3F")
     userid = user_info_list[0]
-    externalId = user_info_list[1]
+    externalId = user_info_list[1] if len(user_info_list) > 1 else ''
+    return resolve_connect_user(userid, externalId, replica=replica)
+
+
+def resolve_connect_user(userid, externalId, scim_id=None, replica=None):
+    """To get Connect user info by Connect user id or username.
+
+    scim_id defaults to the Connect user id followed by the externalId.
+    """
     user_found = {}
     try:
         LOGGER.info("Looking for %s in Connect instance %s...", userid, INSTANCE_ID)     # noqa: E501
-        paginator = CONNECT_CLIENT.get_paginator('list_users')
-        paginated_user_list = paginator.paginate(
-            InstanceId=INSTANCE_ID,
-            PaginationConfig={
-            }
-        )
-        for page in paginated_user_list:
-            for users in page['UserSummaryList']:
-                if userid == users['Id']:
-                    user_info = CONNECT_CLIENT.describe_user(InstanceId=INSTANCE_ID, UserId=userid)     # noqa: E501
-                    user_found = {
-                        "Username": user_info['User']['Username'],
-                        "Id": users['Id'],
-                        "externalId": externalId,
-                        "FirstName": user_info['User']['IdentityInfo']['FirstName'],     # noqa: E501
-                        "LastName": user_info['User']['IdentityInfo']['LastName']        # noqa: E501
-                    }
+        users = lookup_connect_user(CONNECT_CLIENT, INSTANCE_ID, USER_INDEX, userid, replica)     # noqa: E501
+        if users:
+            user_info = users.details(CONNECT_CLIENT, INSTANCE_ID)
+            user_found = users
+            user_found.update({
+                "ScimId": scim_id or users["Id"] + "?" + externalId,
+                "externalId": externalId,
+                "FirstName": user_info['IdentityInfo']['FirstName'],     # noqa: E501
+                "LastName": user_info['IdentityInfo']['LastName']        # noqa: E501
+            })
         return user_found
     except botocore.exceptions.ClientError as error:
         LOGGER.error("Connect User Management Failure - Boto3 client error in UserManagementScimLambda while getting Connect user due to %s", error.response['Error']['Code'])     # noqa: E501
@@ -56,8 +111,12 @@ def get_connect_user(userid):
 # The fuction to Create connect user based on SCIM payload
 
 
-def create_connect_user(body):
-    """To create connect user based on scim payload."""
+def create_connect_user(body, scim_id=None):
+    """To create connect user based on scim payload.
+
+    With an identity store the SCIM id is scim_id, or the Connect user id
+    when not given, and its mapping is written through.
+    """
     try:
         user_info = json.loads(body)
         user_name = user_info['userName']
@@ -65,8 +124,10 @@ def create_connect_user(body):
         last_name = user_info['name']['familyName']
         security_profile = user_info["urn:ietf:params:scim:schemas:extension:enterprise:2.0:User"]["department"]   # noqa: E501
         security_profile_list = security_profile.split(',')
-        sg_id_list = get_sg_id(security_profile_list)
-        routing_id = get_routing_id(DEFAULT_ROUTING_PROFILE)
+        sg_id_list, routing_id = run_concurrently(
+            lambda: get_sg_id(security_profile_list),
+            lambda: get_routing_id(DEFAULT_ROUTING_PROFILE)
+        )
         LOGGER.info("The Security profile %s attached to user %s", sg_id_list, user_name)    # noqa: E501
         output = CONNECT_CLIENT.create_user(
             Username=user_name,
@@ -83,42 +144,98 @@ def create_connect_user(body):
             RoutingProfileId=routing_id,
             InstanceId=INSTANCE_ID
         )
-        user_info['id'] = output['UserId'] + "?" + user_info["externalId"]
+        USER_INDEX.put({
+            "Id": output['UserId'],
+            "Arn": output['UserArn'],
+            "Username": user_name
+        })
+        if USER_REPLICA is not None:
+            USER_REPLICA.put({
+                "Id": output['UserId'],
+                "Arn": output['UserArn'],
+                "Username": user_name,
+                "IdentityInfo": {"FirstName": first_name, "LastName": last_name},     # noqa: E501
+                "SecurityProfileIds": sg_id_list,
+                "RoutingProfileId": routing_id
+            })
+        if IDENTITY_STORE is not None:
+            user_info['id'] = scim_id or output['UserId']
+            IDENTITY_STORE.put(identity(user_info['id'], output['UserId'], user_info["externalId"], user_name))     # noqa: E501
+        else:
+            user_info['id'] = output['UserId'] + "?" + user_info["externalId"]
         return user_info
     except botocore.exceptions.ClientError as error:
         LOGGER.error("Connect User Management Failure - Boto3 client error in UserManagementScimLambda while creating Connect user due to %s", error.response['Error']['Code'])     # noqa: E501
         raise error
 
 
+# The fuction to create a connect user once whatever the POST retries
+
+
+def post_connect_user(body):
+    """To create connect user, or queue its creation, at most once.
+
+    A retried POST gets the response of the first one, and a POST of a user
+    already on the instance gets that user instead of a second create_user.
+    """
+    def create(body):
+        if WRITE_QUEUE is not None:
+            return queue_user_mutation('create', '', body)
+        return create_connect_user(body)
+    return idempotent_create(CREATE_LEDGER, body, create, existing_connect_user)     # noqa: E501
+
+
+def existing_connect_user(body):
+    """To get the scim response of a POST for a user already in connect.
+
+    The SCIM id is the one of the identity store when it maps the userName,
+    otherwise the Connect user id followed by the externalId of the POST.
+    """
+    user_info = json.loads(body)
+    record = IDENTITY_STORE.get('userName', user_info['userName']) if IDENTITY_STORE is not None else None     # noqa: E501
+    if record:
+        user = resolve_connect_user(record['UserId'], record['ExternalId'], record['ScimId'])     # noqa: E501
+    else:
+        user = resolve_connect_user(user_info['userName'], user_info.get('externalId', ''))     # noqa: E501
+    if not user:
+        return None
+    user_info['id'] = user['ScimId']
+    return user_info
+
+
 # The fuction to get connect security profile.
 
 
 def get_sg_id(security_profile):
     """To get security profile id."""
     try:
-        sg_id = []
-        security_list = CONNECT_CLIENT.list_security_profiles(InstanceId=INSTANCE_ID)     # noqa: E501
-        for each_security_profile in security_profile:
-            for profile in security_list['SecurityProfileSummaryList']:
-                if each_security_profile == profile['Name']:
-                    sg_id.append(profile['Id'])
+        sg_id = SECURITY_PROFILES.get_ids(CONNECT_CLIENT, security_profile)
         return sg_id
     except botocore.exceptions.ClientError as error:
         LOGGER.error("Connect User Management Failure - Boto3 client error in UserManagementScimLambda while getting SecurityProfile Id due to %s", error.response['Error']['Code'])       # noqa: E501
         raise error
 
 
+# The fuction to get connect security profile names.
+
+
+def get_sg_names(security_profile_ids):
+    """To get security profile names from the profile catalog."""
+    try:
+        sg_names = SECURITY_PROFILES.get_names(CONNECT_CLIENT, security_profile_ids)     # noqa: E501
+        return sg_names
+    except botocore.exceptions.ClientError as error:
+        LOGGER.error("Connect User Management Failure - Boto3 client error in UserManagementScimLambda while getting SecurityProfile names due to %s", error.response['Error']['Code'])       # noqa: E501
+        raise error
+
+
 # The fuction to get connect Routing profile Id.
 
 
 def get_routing_id(routing_profile):
     """To get Routing profile id."""
     try:
-        routing_id = ''
-        routing_profile_id = CONNECT_CLIENT.list_routing_profiles(InstanceId=INSTANCE_ID)  # noqa: E501
-        for profile in routing_profile_id['RoutingProfileSummaryList']:
-            if routing_profile == profile['Name']:
-                routing_id = profile['Id']
+        routing_id = ROUTING_PROFILES.get_id(CONNECT_CLIENT, routing_profile)
         return routing_id
     except botocore.exceptions.ClientError as error:
         LOGGER.error("Connect User Management Failure - Boto3 client error in UserManagementScimLambda while getting Routing Profile Id due to %s", error.response['Error']['Code'])       # noqa: E501
@@ -136,46 +253,88 @@ def user_not_found_response():
         "totalResults": 0,
         "Resources": [],
         "startIndex": 1,
-        "itemsPerPage": 20
+        "itemsPerPage": 0
     }
     return return_response
 
 # SCIM response to send when user exist in Connect.
 
 
-def build_scim_user(user):
-    """To send scim response when user exist."""
+def build_scim_user(user, projection=None):
+    """To send scim response when user exist.
+
+    The department needs the describe_user record and the security profile
+    names, so it is only resolved when the projection returns it.
+    """
     LOGGER.info("The Existing user to build SCIM response %s", user)
-    id = user["Id"] + "?" + user["externalId"]
-    sg_entitlement = []
+    id = user["ScimId"]
+    projection = projection or Projection()
+
+    def department():
+        get_user_info, _ = run_concurrently(
+            lambda: user.details(CONNECT_CLIENT, INSTANCE_ID),
+            lambda: SECURITY_PROFILES.warm(CONNECT_CLIENT)
+        )
+        user['department'] = get_sg_names(get_user_info['SecurityProfileIds'])     # noqa: E501
+        return user['department']
     try:
-        paginator = CONNECT_CLIENT.get_paginator('list_users')
-        paginated_user_list = paginator.paginate(InstanceId=INSTANCE_ID, PaginationConfig={})   # noqa: E501
-        userid = user["Id"]
-        for page in paginated_user_list:
-            for users in page['UserSummaryList']:
-                if userid == users['Id']:
-                    get_user_info = CONNECT_CLIENT.describe_user(UserId=userid,
-                                                                 InstanceId=INSTANCE_ID)   # noqa: E501
-                    get_exist_sg_id = get_user_info['User']['SecurityProfileIds']          # noqa: E501
-            for each_sg_info in get_exist_sg_id:
-                get_sg_detail = CONNECT_CLIENT.describe_security_profile(
-                        SecurityProfileId=each_sg_info,
-                        InstanceId=INSTANCE_ID
-                )
-                get_sg_name = get_sg_detail['SecurityProfile']['SecurityProfileName']      # noqa: E501
-                sg_entitlement.append(get_sg_name)
-
-        entitlement = ','.join(map(str, sg_entitlement))
-        user['department'] = entitlement
-        scim_user = "{{\"schemas\":[\"urn:ietf:params:scim:schemas:core:2.0:User\", \"urn:ietf:params:scim:schemas:extension:enterprise:2.0:User\"], \"id\":\"{}\",\"externalId\":\"{}\",\"userName\":\"{}\",\"active\":true,\"meta\":{{\"resourceType\":\"User\"}},\"roles\":[],\"name\": {{\"familyName\":\"{}\",\"givenName\":\"{}\"}}, \"urn:ietf:params:scim:schemas:extension:enterprise:2.0:User\":{{\"department\":\"{}\"}}}}".format(id, user["externalId"],  user["Username"], user["LastName"], user["FirstName"], user['department'])      # noqa: E501
-        send_response = json.loads(scim_user)
-        return_response = send_response
-        return return_response
+        return ScimUser(
+            id,
+            user["Username"],
+            user["externalId"],
+            given_name=user["FirstName"],
+            family_name=user["LastName"],
+            department=department
+        ).to_dict(projection)
     except botocore.exceptions.ClientError as error:
         LOGGER.error("Connect User Management Failure - Boto3 client error in UserManagementScimLambda while building scim response due to %s", error.response['Error']['Code'])     # noqa: E501
         raise error
 
+# SCIM response listing a window of the users in Connect.
+
+
+def list_connect_users(query):
+    """To send scim list response for the startIndex and count requested."""
+    start_index, count = list_parameters(query)
+    try:
+        users, total_results = USER_PAGES.window(CONNECT_CLIENT, start_index, count)     # noqa: E501
+    except botocore.exceptions.ClientError as error:
+        LOGGER.error("Connect User Management Failure - Boto3 client error in UserManagementScimLambda while listing Connect users due to %s", error.response['Error']['Code'])     # noqa: E501
+        raise error
+    projection = Projection.from_query(query)
+    resources = []
+    for summary in users:
+        resources.append(ScimUser(summary['Id'], summary['Username']).to_dict(projection))     # noqa: E501
+    return list_response(resources, total_results, start_index)
+
+# SCIM response for a user filter.
+
+
+def filter_connect_user(query):
+    """To send scim list response of the user an eq filter asks for.
+
+    Azure AD checks whether a user exists with an eq filter on userName or
+    externalId. The identity store resolves both, without it no user is
+    reported so that Azure AD creates the user and learns its SCIM id.
+    """
+    filter_text = query['filter']
+    node = parse_filter(filter_text)
+    if IDENTITY_STORE is None:
+        return user_not_found_response()
+    record = None
+    for kind in ('userName', 'externalId'):
+        value = equality_value(node, (kind,))
+        if value is not None:
+            record = IDENTITY_STORE.get(kind, value)
+            break
+    user = resolve_connect_user(record['UserId'], record['ExternalId'], record['ScimId'], USER_REPLICA) if record else None     # noqa: E501
+    if not user:
+        return user_not_found_response()
+    # The other terms of the filter are checked on the user found
+    if not isinstance(node, Comparison) and not compile_filter(filter_text)(build_scim_user(user)):     # noqa: E501
+        return user_not_found_response()
+    return list_response([build_scim_user(user, Projection.from_query(query))], 1, 1)     # noqa: E501
+
 # SCIM dummy response for group request.
 
 
@@ -194,32 +353,37 @@ def dummy_group_response():
 # The function to update connect user during PUT request.
 
 
-def update_connect_user(userid, body):
-    """To update connect user."""
+def update_connect_user(userid, body, user=None):
+    """To update connect user, skipping the write when nothing changed.
+
+    user is the user already resolved by the caller, looked up otherwise.
+    """
     user_info = json.loads(body)
-    user_value = []
-    user_entity = []
-    for info in user_info['Operations']:
-        user_value.append(info['value'])
-        user_entity.append(info['path'])
+    user_state = coalesce_operations(user_info['Operations'])
     sg_entitlement = []
-  
-    if "department" in user_entity:
+
+    if "department" in user_state:
         try:
-            paginator = CONNECT_CLIENT.get_paginator('list_users')
-            paginated_user_list = paginator.paginate(InstanceId=INSTANCE_ID, PaginationConfig={})  # noqa: E501
-            for page in paginated_user_list:
-                for users in page['UserSummaryList']:
-                    if userid == users['Id']:
-                        get_updated_sg_info = get_sg_id(user_value)
-                        LOGGER.info("The updated list of security profile %s for the user %s", get_updated_sg_info, userid)     # noqa: E501
-                        CONNECT_CLIENT.update_user_security_profiles(SecurityProfileIds=get_updated_sg_info,        # noqa: E501
-                                                                     UserId=userid,         # noqa: E501
-                                                                     InstanceId=INSTANCE_ID)       # noqa: E501
-            for each_sg_info in get_updated_sg_info:
-                get_sg_detail = CONNECT_CLIENT.describe_security_profile(SecurityProfileId=each_sg_info, InstanceId=INSTANCE_ID)   # noqa: E501
-                get_sg_name = get_sg_detail['SecurityProfile']['SecurityProfileName']     # noqa: E501
-                sg_entitlement.append(get_sg_name)
+            if user is None:
+                user, get_updated_sg_info = run_concurrently(
+                    lambda: lookup_connect_user(CONNECT_CLIENT, INSTANCE_ID, USER_INDEX, userid),     # noqa: E501
+                    lambda: get_sg_id(user_state['department'])
+                )
+            elif user:
+                get_updated_sg_info = get_sg_id(user_state['department'])
+            if not user:
+                get_updated_sg_info = []
+            if user:
+                if set(get_updated_sg_info) == set(user.details(CONNECT_CLIENT, INSTANCE_ID)['SecurityProfileIds']):     # noqa: E501
+                    LOGGER.info("The security profiles %s of the user %s are unchanged", get_updated_sg_info, userid)     # noqa: E501
+                else:
+                    LOGGER.info("The updated list of security profile %s for the user %s", get_updated_sg_info, userid)     # noqa: E501
+                    CONNECT_CLIENT.update_user_security_profiles(SecurityProfileIds=get_updated_sg_info,        # noqa: E501
+                                                                 UserId=userid,         # noqa: E501
+                                                                 InstanceId=INSTANCE_ID)       # noqa: E501
+                if USER_REPLICA is not None:
+                    USER_REPLICA.put(dict(user.details(CONNECT_CLIENT, INSTANCE_ID), SecurityProfileIds=get_updated_sg_info))     # noqa: E501
+            sg_entitlement = get_sg_names(get_updated_sg_info)
             user_info["department"] = sg_entitlement
             return user_info
         except botocore.exceptions.ClientError as error:
@@ -227,10 +391,246 @@ def update_connect_user(userid, body):
             raise error
     else:
         return user_info
-       
+
+# The function to delete connect user when it is deactivated.
+
+
+def delete_connect_user(uid):
+    """To delete connect user, returning the deleted user."""
+    user = get_connect_user(uid)
+    if not user:
+        raise ScimError(404, "User %s not found" % uid)
+    try:
+        CONNECT_CLIENT.delete_user(
+            InstanceId=INSTANCE_ID,
+            UserId=user['Id']
+        )
+        USER_INDEX.evict(user['Id'])
+        if USER_REPLICA is not None:
+            USER_REPLICA.delete(user['Id'])
+        if CREATE_LEDGER is not None:
+            CREATE_LEDGER.forget(user['Username'])
+        record = IDENTITY_STORE.get('userId', user['Id']) if IDENTITY_STORE is not None else None     # noqa: E501
+        if record:
+            IDENTITY_STORE.delete(record)
+        return user
+    except botocore.exceptions.ClientError as error:
+        LOGGER.error("Connect User Management Failure - Boto3 client error in UserManagementScimLambda while deleting Connect user due to %s", error.response['Error']['Code'])     # noqa: E501
+        raise error
+
+# The function to Delete or update connect user during PATCH request.
+
+
+def patch_connect_user(uid, body):
+    """To delete or update connect user based on scim PATCH payload.
+
+    The operations are coalesced into one target state first, so a request
+    costs at most one Connect write whatever its number of operations.
+    """
+    user_update_info = json.loads(body)
+    user_state = coalesce_operations(user_update_info['Operations'])
+
+    # if the user is deactivated then the request is to Delete User
+    if user_state.get('active') is False:
+        user = delete_connect_user(uid)
+        id = user["ScimId"]
+        scim_send_response = ScimUser(id, user["Username"], user["externalId"], active=False, given_name=user["FirstName"], family_name=user["LastName"]).to_dict()     # noqa: E501
+        LOGGER.info("The SCIM retur response for PATCH %s", scim_send_response)     # noqa: E501
+        return scim_send_response
+    # without a department change there is nothing to update in Connect
+    if 'department' not in user_state:
+        return None
+    # otherwise the request is to update User, the profile ids of the
+    # department loading alongside the user
+    user, _ = run_concurrently(
+        lambda: get_connect_user(uid),
+        lambda: SECURITY_PROFILES.warm(CONNECT_CLIENT)
+    )
+    if not user:
+        raise ScimError(404, "User %s not found" % uid)
+    user_update = update_connect_user(user['Id'], body, user)
+    id = user["ScimId"]
+    send_response = ScimUser(id, user["Username"], user["externalId"], given_name=user["FirstName"], family_name=user["LastName"], department=user_update['department']).to_dict()     # noqa: E501
+    LOGGER.info("The Scim return response for PATCH update ======> %s", send_response)    # noqa: E501
+    return send_response
+
+# The function to apply a DELETE of a bulk request.
+
+
+def remove_connect_user(uid, body):
+    """To delete connect user based on scim DELETE operation."""
+    user = delete_connect_user(uid)
+    return {"id": user["ScimId"]}
+
+# The functions applying each method of a bulk request, Azure AD ids
+# carry the externalId after an encoded '?'.
+
+
+BULK_OPERATIONS = {
+    'POST': lambda uid, body: post_connect_user(body),
+    'PATCH': lambda uid, body: patch_connect_user(uid.replace('?', '%3F'), body),     # noqa: E501
+    'DELETE': lambda uid, body: remove_connect_user(uid.replace('?', '%3F'), body)     # noqa: E501
+}
+
+# The functions queueing each method of a bulk request in asynchronous
+# mode, a DELETE being queued as the deactivation that deletes the user.
+
+
+QUEUED_BULK_OPERATIONS = {
+    'POST': lambda uid, body: post_connect_user(body),
+    'PATCH': lambda uid, body: queue_user_mutation('patch', uid.replace('?', '%3F'), body),     # noqa: E501
+    'DELETE': lambda uid, body: queue_user_mutation('patch', uid.replace('?', '%3F'), json.dumps({     # noqa: E501
+        "schemas": ["urn:ietf:params:scim:api:messages:2.0:PatchOp"],
+        "Operations": [{"op": "Replace", "path": "active", "value": "False"}]
+    }))
+}
+
+# The function to map an exported Azure AD user onto its Connect state.
+
+
+def desired_connect_user(user_info):
+    """To get the Connect state of an exported scim user."""
+    department = user_info.get("urn:ietf:params:scim:schemas:extension:enterprise:2.0:User", {}).get("department", '')     # noqa: E501
+    return {
+        "Username": user_info['userName'],
+        "ExternalId": user_info.get('externalId'),
+        "FirstName": user_info['name']['givenName'],
+        "LastName": user_info['name']['familyName'],
+        "SecurityProfiles": [profile for profile in department.split(',') if profile],     # noqa: E501
+        "RoutingProfile": None,
+        "Active": user_info.get('active', True) not in (False, 'False', 'false')     # noqa: E501
+    }
+
+
+# The function to write a reconciled user through to the user stores.
+
+
+def reconciled_connect_user(action, output):
+    """To write an action the reconciliation applied to the user stores."""
+    if action['action'] == 'create':
+        if USER_REPLICA is not None:
+            USER_REPLICA.put({
+                "Id": output['UserId'],
+                "Arn": output['UserArn'],
+                "Username": action['Username'],
+                "IdentityInfo": action['IdentityInfo'],
+                "SecurityProfileIds": action['SecurityProfileIds'],
+                "RoutingProfileId": action['RoutingProfileId']
+            })
+        if IDENTITY_STORE is not None and action.get('ExternalId'):
+            IDENTITY_STORE.put(identity(output['UserId'], output['UserId'], action['ExternalId'], action['Username']))     # noqa: E501
+    elif action['action'] == 'delete':
+        if USER_REPLICA is not None:
+            USER_REPLICA.delete(action['UserId'])
+        if CREATE_LEDGER is not None:
+            CREATE_LEDGER.forget(action['Username'])
+        record = IDENTITY_STORE.get('userId', action['UserId']) if IDENTITY_STORE is not None else None     # noqa: E501
+        if record:
+            IDENTITY_STORE.delete(record)
+    else:
+        record = USER_REPLICA.get(action['UserId']) if USER_REPLICA is not None else None     # noqa: E501
+        if record:
+            changed = dict((name, value) for name, value in action.items() if name in ('IdentityInfo', 'SecurityProfileIds'))     # noqa: E501
+            USER_REPLICA.put(dict(record, **changed))
+
+# The function to queue a user mutation in asynchronous mode.
+
+
+def queue_user_mutation(operation, uid, body):
+    """To validate and queue a user mutation, returning the SCIM response.
+
+    A queued user has no Connect id yet, so its userName takes the place
+    of the Connect id in the SCIM id. The drainer maps it onto the Connect
+    user id in the identity store, which lookups consult before resolving
+    a userName.
+    """
+    try:
+        user_info = json.loads(body)
+        if operation == 'create':
+            uid = user_info['userName'] + "%3F" + user_info['externalId']
+            if not (user_info['name']['givenName'] and user_info['name']['familyName'] and user_info["urn:ietf:params:scim:schemas:extension:enterprise:2.0:User"]["department"]):     # noqa: E501
+                raise ValueError('name and department are required')
+        elif any('path' not in info or 'value' not in info for info in user_info['Operations']):     # noqa: E501
+            raise ValueError('Operations need a path and a value')
+    except (KeyError, ValueError, TypeError) as error:
+        raise ScimError(400, "Invalid user payload: %s" % error, 'invalidSyntax')     # noqa: E501
+    if not uid:
+        raise ScimError(400, "No user Id provided", 'invalidValue')
+    WRITE_QUEUE.send(mutation(operation, uid, body))
+    LOGGER.info("Queued %s of user %s", operation, uid)
+    if operation == 'create':
+        user_info['id'] = uid.replace("%3F", "?")
+        return user_info
+    user_state = coalesce_operations(user_info['Operations'])
+    scim_user = ScimUser(
+        uid.replace("%3F", "?"),
+        None,
+        uid.split("%3F")[-1] if "%3F" in uid else '',
+        active=user_state.get('active', True),
+        department=user_state.get('department') or None
+    ).to_dict()
+    return scim_user
+
+# The function to apply a queued user mutation.
+
+
+def apply_user_mutation(message):
+    """To apply a queued user mutation to connect."""
+    if message['operation'] == 'create':
+        try:
+            create_connect_user(message['body'], message['user'].replace("%3F", "?"))     # noqa: E501
+        except botocore.exceptions.ClientError as error:
+            if error.response['Error']['Code'] != 'DuplicateResourceException':
+                raise error
+            LOGGER.info("Queued user %s already exists", message['user'])
+            user = get_connect_user(message['user'])
+            if user and IDENTITY_STORE is not None:
+                IDENTITY_STORE.put(identity(message['user'].replace("%3F", "?"), user['Id'], user['externalId'], user['Username']))     # noqa: E501
+    elif message['operation'] == 'patch':
+        try:
+            patch_connect_user(message['user'], message['body'])
+        except ScimError:
+            LOGGER.info("Queued user %s no longer exists", message['user'])
+
+# The function to merge two queued mutations of the same user.
+
+
+def merge_user_mutations(previous, message):
+    """To merge two queued user mutations, or None to apply both."""
+    if message['operation'] != 'patch':
+        return None
+    user_state = coalesce_operations(json.loads(message['body'])['Operations'])     # noqa: E501
+    if previous['operation'] == 'patch':
+        user_state = merge_states(coalesce_operations(json.loads(previous['body'])['Operations']), user_state)     # noqa: E501
+        user_info = json.loads(message['body'])
+        user_info['Operations'] = patch_operations(user_state)
+        return dict(message, body=json.dumps(user_info))
+    if user_state.get('active') is False:
+        return message
+    if set(user_state) - set(['active', 'department']):
+        return None
+    user_info = json.loads(previous['body'])
+    if 'department' in user_state:
+        user_info["urn:ietf:params:scim:schemas:extension:enterprise:2.0:User"]["department"] = ','.join(user_state['department'])     # noqa: E501
+    return dict(previous, body=json.dumps(user_info))
+
+# The response to send for a SCIM request.
+
+
+def scim_response(status, message):
+    """To build the API Gateway response of a SCIM message."""
+    return {
+        "statusCode": status,
+        "body": dumps(message),
+        "headers": {
+            'Content-Type': 'application/json',
+        }
+    }
+
 # Main Lambda function
 
 
+@instrumented('azure')
 def lambda_handler(event, context):
     """The handler for the user management."""
     LOGGER.info("Received event is %s", json.dumps(event))
@@ -238,6 +638,20 @@ def lambda_handler(event, context):
     body = event['body']
     method = event['httpMethod']
 
+    # Bulk request running many user operations in one invocation
+    if is_bulk_request(event):
+        bulk_operations = QUEUED_BULK_OPERATIONS if WRITE_QUEUE is not None else BULK_OPERATIONS     # noqa: E501
+        status, bulk_response = process_bulk(body, bulk_operations, bulk_deadline(context))     # noqa: E501
+        response_body = dumps(bulk_response)
+        LOGGER.info("Method:POST Bulk - SCIM Bulk Response ==========> %s", response_body)     # noqa: E501
+        return {
+            "statusCode": status,
+            "body": response_body,
+            "headers": {
+                'Content-Type': 'application/json',
+            }
+        }
+
     # Get method user management action
 
     if method == 'GET':
@@ -247,7 +661,7 @@ def lambda_handler(event, context):
             message = dummy_group_response()
             return {
                 "statusCode": 200,
-                "body": json.dumps(message),
+                "body": dumps(message),
                 "headers": {
                         'Content-Type': 'application/json',
                  }
@@ -255,27 +669,48 @@ def lambda_handler(event, context):
         if ('Users' in event['pathParameters']['Users']):      # noqa: E501
             uid = event["pathParameters"]["Users"].split("/")[-1]
             LOGGER.info("The user in the request is %s", uid)
+        if uid == "Users" and not (event['queryStringParameters'] or {}).get('filter'):     # noqa: E501
+            scim_users = list_connect_users(event['queryStringParameters'])
+            LOGGER.info("Method:GET list of users - SCIM Response with %s users", scim_users['itemsPerPage'])     # noqa: E501
+            return {
+                'statusCode': 200,
+                'body': dumps(scim_users),
+                'headers': {
+                    'Content-Type': 'application/json',
+                }
+            }
         if uid == "Users":
-            scim_user = user_not_found_response()
-            LOGGER.info("Method:GET - SCIM User Response ==========> %s", json.dumps(scim_user))      # noqa: E501
+            try:
+                scim_user = filter_connect_user(event['queryStringParameters'])
+            except ScimFilterError as error:
+                return scim_response(400, error_response(400, str(error), 'invalidFilter'))     # noqa: E501
+            response_body = dumps(scim_user)
+            LOGGER.info("Method:GET - SCIM User Response ==========> %s", response_body)      # noqa: E501
             return {
                 'statusCode': 200,
-                'body': json.dumps(scim_user),
+                'body': response_body,
                 'headers': {
                     'Content-Type': 'application/json',
                 }
             }
         elif uid != "":
-            user = get_connect_user(uid)
+            projection = Projection.from_query(event['queryStringParameters'])     # noqa: E501
+            # The profile names of the department load alongside the user
+            user, _ = run_concurrently(
+                lambda: get_connect_user(uid, USER_REPLICA),
+                lambda: projection.includes(ENTERPRISE_USER_SCHEMA) and SECURITY_PROFILES.warm(CONNECT_CLIENT)     # noqa: E501
+            )
             if user:
-                scim_user = build_scim_user(user)
-                LOGGER.info("Method:GET for existing user - SCIM User Response ==========> %s", json.dumps(scim_user))    # noqa: E501
+                scim_user = build_scim_user(user, projection)
+                response_body = dumps(scim_user)
+                LOGGER.info("Method:GET for existing user - SCIM User Response ==========> %s", response_body)    # noqa: E501
             else:
                 scim_user = user_not_found_response()
-                LOGGER.info("Method:GET - SCIM User Response ==========> %s", json.dumps(scim_user))      # noqa: E501
+                response_body = dumps(scim_user)
+                LOGGER.info("Method:GET - SCIM User Response ==========> %s", response_body)      # noqa: E501
             return {
                 'statusCode': 200,
-                'body': json.dumps(scim_user),
+                'body': response_body,
                 'headers': {
                     'Content-Type': 'application/json',
                 }
@@ -291,18 +726,22 @@ def lambda_handler(event, context):
             message = dummy_group_response()
             return {
              "statusCode": 200,
-             "body": json.dumps(message),
+             "body": dumps(message),
              "headers": {
                 'Content-Type': 'application/json',
              }
             }
         LOGGER.info("Method:POST - Add User %s", body)
-        user_to_create = create_connect_user(body)
+        try:
+            user_to_create = post_connect_user(body)
+        except ScimError as error:
+            return scim_response(error.status, error_response(error.status, error.detail, error.scim_type))     # noqa: E501
         if user_to_create:
-            LOGGER.info("Scim return response for POST ======> %s", json.dumps(user_to_create))      # noqa: E501
+            response_body = dumps(user_to_create)
+            LOGGER.info("Scim return response for POST ======> %s", response_body)      # noqa: E501
             return {
                 "statusCode": 200,
-                "body": json.dumps(user_to_create),
+                "body": response_body,
                 "headers": {
                     'Content-Type': 'application/json',
                 }
@@ -322,53 +761,66 @@ def lambda_handler(event, context):
             message = dummy_group_response()
             return {
                 "statusCode": 200,
-                "body": json.dumps(message),
+                "body": dumps(message),
                 "headers": {
                         'Content-Type': 'application/json',
                  }
                 }
         LOGGER.info("Method:PATCH - Update or Delete User %s", body)
         uid = ''
-        patch_action = []
-        patch_value = []
         if (event['pathParameters'] and event['pathParameters']['Users'] and event['pathParameters']['Users'] != 'Users'):      # noqa: E501
             uid = event["pathParameters"]["Users"].split("/")[-1]
-        user_update_info = json.loads(body)
-        for info in user_update_info['Operations']:
-            patch_value.append(info['value'])
-            patch_action.append(info['path'])
-        
-        # if user_path contains active then the request is to Delete User
-        if 'active' in patch_action:
-            if 'False' in patch_value:
-                user = get_connect_user(uid)
-                CONNECT_CLIENT.delete_user(
-                    InstanceId=INSTANCE_ID,
-                    UserId=user['Id']
-                )
-                id = user["Id"] + "?" + user["externalId"]
-                scim_user = "{{\"schemas\":[\"urn:ietf:params:scim:schemas:core:2.0:User\", \"urn:ietf:params:scim:schemas:extension:enterprise:2.0:User\"], \"id\":\"{}\",\"externalId\":\"{}\",\"userName\":\"{}\",\"active\":false,\"meta\":{{\"resourceType\":\"User\"}},\"roles\":[],\"name\": {{\"familyName\":\"{}\",\"givenName\":\"{}\"}}}}".format(id, user["externalId"],  user["Username"], user["LastName"], user["FirstName"])      # noqa: E501
-                scim_send_response = json.loads(scim_user)
-                LOGGER.info("The SCIM retur response for PATCH %s", json.dumps(scim_send_response))     # noqa: E501
-                return {
-                    "statusCode": 200,
-                    "body": json.dumps(scim_send_response),
-                    "headers": {
-                            'Content-Type': 'application/json',
-                     }
-                    }
-        # if user_path does not contain active then the request is to update User         # noqa: E501
-        else:
-            user = get_connect_user(uid)
-            user_update = update_connect_user(user['Id'], body)
-            id = user["Id"] + "?" + user["externalId"]
-            scim_user = "{{\"schemas\":[\"urn:ietf:params:scim:schemas:core:2.0:User\", \"urn:ietf:params:scim:schemas:extension:enterprise:2.0:User\"], \"id\":\"{}\",\"externalId\":\"{}\",\"userName\":\"{}\",\"active\":true,\"meta\":{{\"resourceType\":\"User\"}},\"roles\":[],\"name\": {{\"familyName\":\"{}\",\"givenName\":\"{}\"}}, \"urn:ietf:params:scim:schemas:extension:enterprise:2.0:User\":{{\"department\":\"{}\"}}}}".format(id, user["externalId"],  user["Username"], user["LastName"], user["FirstName"], user_update['department'])      # noqa: E501
-            send_response = json.loads(scim_user)
-            LOGGER.info("The Scim return response for PATCH update ======> %s", json.dumps(send_response))    # noqa: E501
+        if WRITE_QUEUE is not None:
+            try:
+                return scim_response(200, queue_user_mutation('patch', uid, body))     # noqa: E501
+            except ScimError as error:
+                return scim_response(error.status, error_response(error.status, error.detail, error.scim_type))     # noqa: E501
+        # a deactivation deletes the user, so this covers the DELETE path too
+        try:
+            scim_send_response = patch_connect_user(uid, body)
+        except ScimError as error:
+            return scim_response(error.status, error_response(error.status, error.detail, error.scim_type))     # noqa: E501
+        if scim_send_response is not None:
             return {
                 "statusCode": 200,
-                "body": json.dumps(send_response),
+                "body": dumps(scim_send_response),
                 "headers": {
-                    'Content-Type': 'application/json'
+                        'Content-Type': 'application/json',
+                 }
                 }
-            }
+
+
+# Reconciliation Lambda function
+
+
+@instrumented('azure', 'RECONCILE')
+def reconcile_handler(event, context):
+    """The handler for the reconciliation of an IdP user export."""
+    LOGGER.info("Received reconciliation event is %s", json.dumps({key: value for key, value in event.items() if key != 'users'}))     # noqa: E501
+    reconciler = Reconciler(CONNECT_CLIENT, INSTANCE_ID, USER_INDEX, SECURITY_PROFILES, ROUTING_PROFILES, DEFAULT_ROUTING_PROFILE, reconciled_connect_user)     # noqa: E501
+    result = reconciler.run(event, context, desired_connect_user)
+    LOGGER.info("Reconciliation %s is %s after %s actions with %s errors", result['run_id'], result['status'], result.get('applied', 0), len(result['errors']))     # noqa: E501
+    return result
+
+
+# Write queue drainer Lambda function
+
+
+@instrumented('azure', 'DRAIN')
+def drain_handler(event, context):
+    """The handler applying the queued user mutations."""
+    if event.get('Records'):
+        return drain_records(event['Records'], apply_user_mutation, merge_user_mutations)     # noqa: E501
+    return drain_queue(WRITE_QUEUE, apply_user_mutation, merge_user_mutations)
+
+
+# User replica verifier Lambda function
+
+
+@instrumented('azure', 'VERIFY')
+def verify_handler(event, context):
+    """The handler bringing the user replica in line with the instance."""
+    if USER_REPLICA is None:
+        LOGGER.warning("No user replica is configured, USER_REPLICA_MODE is off")     # noqa: E501
+        return {}
+    return USER_REPLICA.verify(CONNECT_CLIENT, INSTANCE_ID)
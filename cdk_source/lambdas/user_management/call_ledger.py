@@ -0,0 +1,187 @@
+"""Per-invocation ledger of the Connect calls, published as CloudWatch EMF."""
+
+import os
+import json
+import time
+import functools
+import threading
+import botocore.exceptions
+from rate_limiter import THROTTLING_ERRORS, PASSTHROUGH_ATTRIBUTES
+
+# Environment variable
+CALL_LEDGER_MODE = os.getenv('CALL_LEDGER_MODE', 'emf')
+METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE', 'ConnectScimUserManagement')     # noqa: E501
+
+
+def operation_name(name):
+    """To get the API operation name of a boto3 client method."""
+    return ''.join(part.capitalize() for part in name.split('_'))
+
+
+class CallLedger(object):
+    """The API calls and cache lookups of one invocation.
+
+    Calls are counted and timed per operation, throttled and failed calls
+    apart, along with the seconds they waited on the rate limiter. Cache
+    lookups are counted as hits and misses per cache, and the other events
+    of the caches and indexes as named counts.
+    Calls may be recorded from the fan-out worker threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start()
+
+    def start(self):
+        """To start the ledger of a new invocation."""
+        with self.lock:
+            self.operations = {}
+            self.caches = {}
+            self.counts = {}
+            self.started = time.monotonic()
+
+    def _operation(self, operation):
+        return self.operations.setdefault(operation, {
+            'calls': 0,
+            'throttles': 0,
+            'errors': 0,
+            'call_seconds': 0.0,
+            'wait_seconds': 0.0
+        })
+
+    def record_call(self, operation, seconds, error_code=None):
+        """To record one API call, with the error code it failed with."""
+        with self.lock:
+            calls = self._operation(operation)
+            calls['calls'] += 1
+            calls['call_seconds'] += seconds
+            if error_code in THROTTLING_ERRORS:
+                calls['throttles'] += 1
+            elif error_code is not None:
+                calls['errors'] += 1
+
+    def record_wait(self, name, seconds):
+        """To record the seconds a client method call waited to be sent."""
+        with self.lock:
+            self._operation(operation_name(name))['wait_seconds'] += seconds
+
+    def record_cache(self, cache, hit):
+        """To record one cache lookup."""
+        with self.lock:
+            lookups = self.caches.setdefault(cache, {'hits': 0, 'misses': 0})
+            lookups['hits' if hit else 'misses'] += 1
+
+    def record_count(self, name, count=1):
+        """To add to a named count of the invocation."""
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + count
+
+    def metrics(self, service='Connect'):
+        """To get the metric values and units of the invocation so far."""
+        with self.lock:
+            operations = dict((operation, dict(calls)) for operation, calls in self.operations.items())     # noqa: E501
+            caches = dict((cache, dict(lookups)) for cache, lookups in self.caches.items())     # noqa: E501
+            counts = dict(self.counts)
+            latency = time.monotonic() - self.started
+        metrics = {
+            service + 'Calls': (sum(calls['calls'] for calls in operations.values()), 'Count'),     # noqa: E501
+            service + 'Throttles': (sum(calls['throttles'] for calls in operations.values()), 'Count'),     # noqa: E501
+            service + 'Errors': (sum(calls['errors'] for calls in operations.values()), 'Count'),     # noqa: E501
+            service + 'Time': (sum(calls['call_seconds'] for calls in operations.values()) * 1000, 'Milliseconds'),     # noqa: E501
+            service + 'WaitTime': (sum(calls['wait_seconds'] for calls in operations.values()) * 1000, 'Milliseconds'),     # noqa: E501
+            'Latency': (latency * 1000, 'Milliseconds')
+        }
+        for operation, calls in operations.items():
+            if not calls['calls']:
+                continue
+            metrics[operation + 'Calls'] = (calls['calls'], 'Count')
+            if calls['throttles']:
+                metrics[operation + 'Throttles'] = (calls['throttles'], 'Count')     # noqa: E501
+        for cache, lookups in caches.items():
+            metrics[cache + 'HitRate'] = (100.0 * lookups['hits'] / (lookups['hits'] + lookups['misses']), 'Percent')     # noqa: E501
+        for name, count in counts.items():
+            metrics[name] = (count, 'Count')
+        return metrics, operations, caches
+
+    def emf(self, dimensions, properties=None, namespace=METRICS_NAMESPACE):
+        """To build the embedded metric format log line of the invocation."""
+        metrics, operations, caches = self.metrics()
+        document = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': namespace,
+                    'Dimensions': [sorted(dimensions)],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, (value, unit) in sorted(metrics.items())]     # noqa: E501
+                }]
+            },
+            'Operations': operations,
+            'Caches': caches
+        }
+        document.update(properties or {})
+        document.update(dimensions)
+        document.update((name, value) for name, (value, unit) in metrics.items())     # noqa: E501
+        return json.dumps(document)
+
+
+# Ledger of the invocation the container is serving
+LEDGER = CallLedger()
+
+
+class LedgerClient(object):
+    """boto3 client proxy recording every API call in the ledger.
+
+    Placed under the RateLimitedClient, it records each attempt, so the
+    throttled attempts the limiter retries are counted as well.
+    """
+
+    def __init__(self, client, ledger=LEDGER):
+        self.client = client
+        self.ledger = ledger
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        attribute = getattr(self.client, name)
+        if name.startswith('_') or name in PASSTHROUGH_ATTRIBUTES or not callable(attribute):     # noqa: E501
+            return attribute
+        operation = operation_name(name)
+
+        def recorded_call(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                response = attribute(*args, **kwargs)
+            except botocore.exceptions.ClientError as error:
+                self.ledger.record_call(operation, time.monotonic() - started, error.response['Error']['Code'])     # noqa: E501
+                raise error
+            self.ledger.record_call(operation, time.monotonic() - started)
+            return response
+        return recorded_call
+
+
+def instrumented(idp, method=None, ledger=LEDGER, mode=CALL_LEDGER_MODE):
+    """To publish the ledger of each invocation of a handler.
+
+    The EMF line is printed rather than logged, as CloudWatch only extracts
+    the metrics of log lines holding nothing but the JSON document. method
+    defaults to the HTTP method of the API Gateway event.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            ledger.start()
+            properties = {'RequestId': getattr(context, 'aws_request_id', None)}     # noqa: E501
+            try:
+                response = handler(event, context)
+                if isinstance(response, dict) and 'statusCode' in response:
+                    properties['StatusCode'] = response['statusCode']
+                return response
+            except Exception as error:     # noqa: B902
+                properties['Error'] = type(error).__name__
+                raise
+            finally:
+                if mode == 'emf':
+                    dimensions = {'IdP': idp, 'Method': method or (event or {}).get('httpMethod') or 'UNKNOWN'}     # noqa: E501
+                    print(ledger.emf(dimensions, properties), flush=True)
+        return wrapper
+    return decorator
@@ -0,0 +1,45 @@
+"""Lazily created boto3 clients, shared by the handlers of a container."""
+
+import threading
+
+# Clients already created, keyed on the service and their configuration
+CLIENTS = {}
+CLIENTS_LOCK = threading.Lock()
+
+
+def client(service, max_attempts=None, max_pool_connections=None):
+    """To get the boto3 client of a service, created on its first use.
+
+    boto3 is imported here rather than when the handler module is loaded,
+    so a cold start pays for the import and the client construction only
+    once a request needs the service. max_attempts sets the botocore
+    total_max_attempts and max_pool_connections the size of its HTTP
+    connection pool, the botocore defaults being kept otherwise.
+    """
+    key = (service, max_attempts, max_pool_connections)
+    if key not in CLIENTS:
+        with CLIENTS_LOCK:
+            if key not in CLIENTS:
+                import boto3
+                from botocore.config import Config
+                options = {}
+                if max_attempts:
+                    options['retries'] = {'total_max_attempts': max_attempts}
+                if max_pool_connections:
+                    options['max_pool_connections'] = max_pool_connections
+                CLIENTS[key] = boto3.client(service, config=Config(**options) if options else None)     # noqa: E501
+    return CLIENTS[key]
+
+
+class LazyClient(object):
+    """boto3 client proxy creating the client on the first API call."""
+
+    def __init__(self, service, max_attempts=None, max_pool_connections=None):
+        self.service = service
+        self.max_attempts = max_attempts
+        self.max_pool_connections = max_pool_connections
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(client(self.service, self.max_attempts, self.max_pool_connections), name)     # noqa: E501
@@ -0,0 +1,86 @@
+"""Coalescing of the SCIM PATCH operations and queued mutations of a user."""
+
+# Attributes whose values accumulate over the operations of one request,
+# each department operation of Azure AD carries one security profile
+MULTI_VALUED_PATHS = ('department',)
+
+
+def _boolean(value):
+    if isinstance(value, str):
+        return value.lower() != 'false'
+    return bool(value)
+
+
+def coalesce_operations(operations):
+    """To fold the operations of one PATCH request into a target state.
+
+    The state maps each attribute path to its final value: the last
+    operation on a path wins, a remove sets it to None, and the values of
+    a multi-valued path are gathered into one list, comma separated values
+    included. Operations without a path carry a dict of attributes, as the
+    Okta deactivation does. active is read as a boolean.
+    """
+    state = {}
+    for info in operations:
+        path = info.get('path')
+        op = info.get('op', 'replace').lower()
+        value = info.get('value')
+        if not path:
+            for key, attribute in (value or {}).items():
+                state[key] = attribute
+        elif op == 'remove':
+            state[path] = [] if path in MULTI_VALUED_PATHS else None
+        elif path in MULTI_VALUED_PATHS:
+            values = value if isinstance(value, list) else str(value).split(',')     # noqa: E501
+            state[path] = state.get(path, []) + [item.strip() for item in values if item.strip()]     # noqa: E501
+        else:
+            state[path] = value
+    if 'active' in state:
+        state['active'] = _boolean(state['active'])
+    return state
+
+
+def merge_states(earlier, later):
+    """To merge the target states of two requests, the later one winning."""
+    state = dict(earlier)
+    state.update(later)
+    return state
+
+
+def patch_operations(state):
+    """To get the PATCH operations reaching a target state."""
+    operations = []
+    for path, value in state.items():
+        if path == 'active':
+            operations.append({'op': 'Replace', 'path': path, 'value': 'True' if value else 'False'})     # noqa: E501
+        elif path in MULTI_VALUED_PATHS:
+            operations.extend({'op': 'Replace', 'path': path, 'value': item} for item in value)     # noqa: E501
+        elif value is None:
+            operations.append({'op': 'Remove', 'path': path})
+        else:
+            operations.append({'op': 'Replace', 'path': path, 'value': value})     # noqa: E501
+    return operations
+
+
+def coalesce_mutations(messages, merge):
+    """To merge the queued mutations of each user into as few as possible.
+
+    merge takes two mutations of the same user, the earlier first, and
+    returns the single mutation with the effect of both, or None when they
+    cannot be merged. Returns (mutation, ids of the merged mutations)
+    pairs, ordered by their first mutation, with the order of each user
+    kept.
+    """
+    groups = []
+    last_group = {}
+    for message in messages:
+        group = last_group.get(message['user'])
+        merged = merge(group[0], message) if group is not None else None
+        if merged is not None:
+            group[0] = merged
+            group[1].append(message['id'])
+            continue
+        group = [message, [message['id']]]
+        groups.append(group)
+        last_group[message['user']] = group
+    return [(group[0], group[1]) for group in groups]
@@ -0,0 +1,67 @@
+"""Bounded concurrent fan-out of the independent Connect reads of a request."""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Environment variable
+CONNECT_MAX_CONCURRENCY = int(os.getenv('CONNECT_MAX_CONCURRENCY', '4'))
+
+# Worker threads, created by the first fan-out of the container
+EXECUTORS = {}
+EXECUTORS_LOCK = threading.Lock()
+
+# Set in the worker threads, whose own fan-outs run in order
+WORKER = threading.local()
+
+
+def executor():
+    """To get the worker pool, created on its first use."""
+    if 'connect' not in EXECUTORS:
+        with EXECUTORS_LOCK:
+            if 'connect' not in EXECUTORS:
+                EXECUTORS['connect'] = ThreadPoolExecutor(max_workers=CONNECT_MAX_CONCURRENCY - 1, thread_name_prefix='connect')     # noqa: E501
+    return EXECUTORS['connect']
+
+
+def _in_worker(call):
+    WORKER.active = True
+    try:
+        return call()
+    finally:
+        WORKER.active = False
+
+
+def run_concurrently(*calls):
+    """To run independent calls concurrently, returning their results in order.
+
+    The first call runs in the calling thread and the others in a pool of
+    CONNECT_MAX_CONCURRENCY - 1 workers, so at most CONNECT_MAX_CONCURRENCY
+    calls are in flight. The Connect calls are still paced by the shared
+    rate limiter: the pool overlaps their latency, it does not raise the
+    rate. A fan-out from a worker runs its calls in order, so nested
+    fan-outs cannot wait on a full pool. The first error raised is raised
+    again once every call has finished.
+    """
+    if len(calls) < 2 or CONNECT_MAX_CONCURRENCY < 2 or getattr(WORKER, 'active', False):     # noqa: E501
+        return [call() for call in calls]
+    futures = [executor().submit(_in_worker, call) for call in calls[1:]]
+    results = []
+    error = None
+    try:
+        results.append(calls[0]())
+    except Exception as call_error:     # noqa: B902
+        error = call_error
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as call_error:     # noqa: B902
+            error = error or call_error
+    if error is not None:
+        raise error
+    return results
+
+
+def map_concurrently(function, items):
+    """To apply a function to items concurrently, returning the results in order."""     # noqa: E501
+    return run_concurrently(*[lambda item=item: function(item) for item in items])     # noqa: E501
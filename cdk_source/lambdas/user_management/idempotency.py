@@ -0,0 +1,252 @@
+"""Idempotent SCIM user creation, replaying the response of a retried POST."""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+import botocore.exceptions
+from clients import client
+from scim_bulk import ScimError
+from call_ledger import LEDGER
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+
+# Environment variable
+IDEMPOTENCY_MODE = os.getenv('IDEMPOTENCY_MODE', 'off')
+IDEMPOTENCY_TABLE = os.getenv('IDEMPOTENCY_TABLE')
+IDEMPOTENCY_TTL = int(os.getenv('IDEMPOTENCY_TTL', '300'))
+IDEMPOTENCY_PENDING_TTL = int(os.getenv('IDEMPOTENCY_PENDING_TTL', '120'))
+IDEMPOTENCY_WAIT = float(os.getenv('IDEMPOTENCY_WAIT', '10'))
+
+
+def fingerprint(body):
+    """To get the hash of a POST payload, whatever its key order."""
+    canonical = json.dumps(json.loads(body), sort_keys=True, separators=(',', ':'))     # noqa: E501
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def is_duplicate(error):
+    """To check whether a Connect error is a create of an existing user."""
+    return error.response['Error']['Code'] == 'DuplicateResourceException'
+
+
+class MemoryTable(object):
+    """In-process table of the creates, for one warm container."""
+
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """To get the unexpired record stored under a key, or None."""
+        with self.lock:
+            record = self.items.get(key)
+        if record is None or record['ExpiresAt'] < time.time():
+            return None
+        return record
+
+    def put(self, key, record):
+        """To store a record under a key."""
+        with self.lock:
+            self.items[key] = record
+
+    def put_if_absent(self, key, record):
+        """To store a record unless an unexpired one exists, returned then."""
+        with self.lock:
+            previous = self.items.get(key)
+            if previous is not None and previous['ExpiresAt'] >= time.time():
+                return previous
+            self.items[key] = record
+            return None
+
+    def delete(self, key):
+        """To remove the record stored under a key."""
+        with self.lock:
+            self.items.pop(key, None)
+
+
+class DynamoTable(object):
+    """Table of the creates in DynamoDB, shared by every container.
+
+    Items have a Key string partition key, the record as JSON in a Record
+    attribute and an ExpiresAt epoch second to be used as the table TTL
+    attribute. The TTL only removes expired items eventually, so the
+    expiry is checked on read as well.
+    """
+
+    def __init__(self, table=IDEMPOTENCY_TABLE):
+        self.table = table
+
+    def _item(self, key, record):
+        return {
+            'Key': {'S': key},
+            'Record': {'S': json.dumps(record)},
+            'ExpiresAt': {'N': str(int(record['ExpiresAt']))}
+        }
+
+    def get(self, key):
+        """To get the unexpired record stored under a key, or None."""
+        item = client('dynamodb').get_item(
+            TableName=self.table,
+            Key={'Key': {'S': key}},
+            ConsistentRead=True
+        ).get('Item')
+        if item is None:
+            return None
+        record = json.loads(item['Record']['S'])
+        return record if record['ExpiresAt'] >= time.time() else None
+
+    def put(self, key, record):
+        """To store a record under a key."""
+        client('dynamodb').put_item(TableName=self.table, Item=self._item(key, record))     # noqa: E501
+
+    def put_if_absent(self, key, record):
+        """To store a record unless an unexpired one exists, returned then."""
+        try:
+            client('dynamodb').put_item(
+                TableName=self.table,
+                Item=self._item(key, record),
+                ConditionExpression='attribute_not_exists(#key) OR ExpiresAt < :now',     # noqa: E501
+                ExpressionAttributeNames={'#key': 'Key'},
+                ExpressionAttributeValues={':now': {'N': str(int(time.time()))}}     # noqa: E501
+            )
+            return None
+        except botocore.exceptions.ClientError as error:
+            if error.response['Error']['Code'] != 'ConditionalCheckFailedException':     # noqa: E501
+                raise error
+        return self.get(key) or record
+
+    def delete(self, key):
+        """To remove the record stored under a key."""
+        client('dynamodb').delete_item(TableName=self.table, Key={'Key': {'S': key}})     # noqa: E501
+
+
+class CreateLedger(object):
+    """The user creations of the last ttl seconds, keyed on the userName.
+
+    A create claims its userName with a pending record before calling
+    Connect and completes it with its SCIM response, also recorded under
+    the SCIM id so that a delete by id can forget it.
+    """
+
+    def __init__(self, table, ttl=IDEMPOTENCY_TTL,
+                 pending_ttl=IDEMPOTENCY_PENDING_TTL, wait=IDEMPOTENCY_WAIT):
+        self.table = table
+        self.ttl = ttl
+        self.pending_ttl = pending_ttl
+        self.wait = wait
+
+    def claim(self, user_name, request_fingerprint):
+        """To claim the create of a user, or get the create claimed before.
+
+        A create still pending in another invocation is waited for, up to
+        wait seconds.
+        """
+        deadline = time.monotonic() + self.wait
+        while True:
+            record = self.table.put_if_absent('userName#' + user_name, {
+                'Status': 'pending',
+                'Fingerprint': request_fingerprint,
+                'ExpiresAt': time.time() + self.pending_ttl
+            })
+            if record is None or record['Status'] != 'pending' or time.monotonic() >= deadline:     # noqa: E501
+                return record
+            time.sleep(0.25)
+
+    def complete(self, user_name, request_fingerprint, response):
+        """To record the SCIM response of a create."""
+        expires_at = time.time() + self.ttl
+        self.table.put('userName#' + user_name, {
+            'Status': 'done',
+            'Fingerprint': request_fingerprint,
+            'Response': response,
+            'ExpiresAt': expires_at
+        })
+        self.table.put('id#' + response['id'], {'UserName': user_name, 'ExpiresAt': expires_at})     # noqa: E501
+
+    def release(self, user_name):
+        """To drop the claim of a failed create, so a retry can create."""
+        self.table.delete('userName#' + user_name)
+
+    def forget(self, key):
+        """To forget the create of a deleted user, by userName or SCIM id."""
+        alias = self.table.get('id#' + key)
+        if alias is not None:
+            self.table.delete('id#' + key)
+            key = alias['UserName']
+        self.table.delete('userName#' + key)
+
+
+def create_ledger(mode=IDEMPOTENCY_MODE):
+    """To get the create ledger of the mode, or None when POSTs are not replayed."""     # noqa: E501
+    if mode == 'dynamodb':
+        return CreateLedger(DynamoTable())
+    if mode == 'memory':
+        return CreateLedger(MemoryTable())
+    return None
+
+
+def upsert(body, create, existing):
+    """To create a user, or get the existing user Connect reports."""
+    try:
+        return create(body)
+    except botocore.exceptions.ClientError as error:
+        if not is_duplicate(error):
+            raise error
+        response = existing(body)
+        if response is None:
+            raise error
+        LOGGER.info("User %s already exists, returning the existing user", response['id'])     # noqa: E501
+        return response
+
+
+def idempotent_create(ledger, body, create, existing):
+    """To create the user of a POST payload at most once.
+
+    create creates the user and returns its SCIM response. existing returns
+    the SCIM response of the user already on the instance, or None. A POST
+    repeating a create of the last ttl seconds gets the response of that
+    create again, any other POST of a userName created in that window gets
+    the existing user, and so does a create Connect rejects as a duplicate.
+    Without a ledger the user of the userName is looked up before creating
+    it, so a retried POST gets the existing user without calling create.
+    """
+    try:
+        user_name = json.loads(body)['userName']
+    except (KeyError, ValueError, TypeError):
+        user_name = None
+    if ledger is None and user_name:
+        response = existing(body)
+        if response is not None:
+            LOGGER.info("User %s exists already, returning the existing user", user_name)     # noqa: E501
+            return response
+    if ledger is None or not user_name:
+        return upsert(body, create, existing)
+    request_fingerprint = fingerprint(body)
+    record = ledger.claim(user_name, request_fingerprint)
+    replayed = record is not None and record['Status'] == 'done' and record['Fingerprint'] == request_fingerprint     # noqa: E501
+    LEDGER.record_cache('CreateLedger', replayed)
+    if record is not None:
+        if replayed:
+            LOGGER.info("Replaying the create of user %s", user_name)
+            return record['Response']
+        response = existing(body)
+        if response is not None:
+            LOGGER.info("User %s was created already, returning the existing user", user_name)     # noqa: E501
+            return response
+        # the user created in the window was deleted since
+        if record['Status'] == 'done':
+            ledger.release(user_name)
+            record = ledger.claim(user_name, request_fingerprint)
+        if record is not None:
+            raise ScimError(409, "The create of user %s is in progress" % user_name, 'uniqueness')     # noqa: E501
+    try:
+        response = upsert(body, create, existing)
+    except Exception:
+        ledger.release(user_name)
+        raise
+    ledger.complete(user_name, request_fingerprint, response)
+    return response
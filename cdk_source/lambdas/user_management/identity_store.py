@@ -0,0 +1,163 @@
+"""Durable mapping of the SCIM ids onto the Connect users."""
+
+import os
+import json
+import time
+import logging
+import sqlite3
+import threading
+from clients import client
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+
+# Environment variable
+IDENTITY_STORE_MODE = os.getenv('IDENTITY_STORE_MODE', 'off')
+IDENTITY_TABLE = os.getenv('IDENTITY_TABLE')
+IDENTITY_STORE_FILE = os.getenv('IDENTITY_STORE_FILE', '/tmp/scim-identities.db')     # noqa: E501
+
+# Attributes a user is looked up by, each stored under its own key
+KEY_KINDS = ('id', 'userId', 'externalId', 'userName')
+
+RECORD_ATTRIBUTES = ('ScimId', 'UserId', 'ExternalId', 'UserName')
+
+
+def identity(scim_id, user_id, external_id, user_name):
+    """To build the mapping record of one user."""
+    return {
+        'ScimId': scim_id,
+        'UserId': user_id,
+        'ExternalId': external_id or '',
+        'UserName': user_name
+    }
+
+
+def store_key(kind, value):
+    """To get the key a record is stored under for one of its identifiers.
+
+    Usernames are compared ignoring case, as Connect and SCIM do.
+    """
+    if kind == 'userName':
+        value = value.lower()
+    return kind + '#' + value
+
+
+def record_keys(record):
+    """To get every key of a record."""
+    keys = [store_key('id', record['ScimId']), store_key('userId', record['UserId']), store_key('userName', record['UserName'])]     # noqa: E501
+    if record['ExternalId']:
+        keys.append(store_key('externalId', record['ExternalId']))
+    return keys
+
+
+class MemoryStore(object):
+    """In-process identity store, for tests and local runs."""
+
+    def __init__(self):
+        self.records = {}
+        self.lock = threading.Lock()
+
+    def get(self, kind, value):
+        """To get the record of a user by one identifier, or None."""
+        with self.lock:
+            return self.records.get(store_key(kind, value))
+
+    def put(self, record):
+        """To store a record under each of its identifiers."""
+        previous = self.get('id', record['ScimId'])
+        with self.lock:
+            if previous is not None:
+                for key in record_keys(previous):
+                    self.records.pop(key, None)
+            for key in record_keys(record):
+                self.records[key] = dict(record)
+
+    def delete(self, record):
+        """To remove a record."""
+        with self.lock:
+            for key in record_keys(record):
+                self.records.pop(key, None)
+
+
+class SqliteStore(object):
+    """Identity store kept in a SQLite file, surviving a process restart."""
+
+    def __init__(self, path=IDENTITY_STORE_FILE):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS identities (key TEXT PRIMARY KEY, record TEXT NOT NULL)')     # noqa: E501
+
+    def get(self, kind, value):
+        """To get the record of a user by one identifier, or None."""
+        with self.lock:
+            row = self.connection.execute('SELECT record FROM identities WHERE key = ?', (store_key(kind, value),)).fetchone()     # noqa: E501
+        return json.loads(row[0]) if row else None
+
+    def put(self, record):
+        """To store a record under each of its identifiers."""
+        previous = self.get('id', record['ScimId'])
+        with self.lock, self.connection:
+            if previous is not None:
+                self.connection.executemany('DELETE FROM identities WHERE key = ?', [(key,) for key in record_keys(previous)])     # noqa: E501
+            self.connection.executemany('INSERT OR REPLACE INTO identities (key, record) VALUES (?, ?)', [(key, json.dumps(record)) for key in record_keys(record)])     # noqa: E501
+
+    def delete(self, record):
+        """To remove a record."""
+        with self.lock, self.connection:
+            self.connection.executemany('DELETE FROM identities WHERE key = ?', [(key,) for key in record_keys(record)])     # noqa: E501
+
+
+class DynamoStore(object):
+    """Identity store in a DynamoDB table with a Key string partition key.
+
+    The record is written in full under each of its identifiers, so any of
+    them resolves the user with one GetItem.
+    """
+
+    def __init__(self, table=IDENTITY_TABLE):
+        self.table = table
+
+    def get(self, kind, value):
+        """To get the record of a user by one identifier, or None."""
+        item = client('dynamodb').get_item(
+            TableName=self.table,
+            Key={'Key': {'S': store_key(kind, value)}},
+            ConsistentRead=True
+        ).get('Item')
+        if item is None:
+            return None
+        return dict((name, item[name]['S']) for name in RECORD_ATTRIBUTES if name in item)     # noqa: E501
+
+    def _write(self, requests):
+        request_items = {self.table: requests}
+        for attempt in range(5):
+            request_items = client('dynamodb').batch_write_item(RequestItems=request_items).get('UnprocessedItems')     # noqa: E501
+            if not request_items:
+                return
+            time.sleep(0.05 * 2 ** attempt)
+        raise RuntimeError("Identity store writes left unprocessed: %s" % request_items)     # noqa: E501
+
+    def put(self, record):
+        """To store a record under each of its identifiers."""
+        previous = self.get('id', record['ScimId'])
+        keys = record_keys(record)
+        requests = [{'DeleteRequest': {'Key': {'Key': {'S': key}}}} for key in record_keys(previous or record) if key not in keys]     # noqa: E501
+        attributes = dict((name, {'S': record[name]}) for name in RECORD_ATTRIBUTES)     # noqa: E501
+        requests.extend({'PutRequest': {'Item': dict(attributes, Key={'S': key})}} for key in keys)     # noqa: E501
+        self._write(requests)
+
+    def delete(self, record):
+        """To remove a record."""
+        self._write([{'DeleteRequest': {'Key': {'Key': {'S': key}}}} for key in record_keys(record)])     # noqa: E501
+
+
+def identity_store(mode=IDENTITY_STORE_MODE):
+    """To get the store of the mode, or None when ids carry the externalId."""
+    if mode == 'dynamodb':
+        return DynamoStore()
+    if mode == 'sqlite':
+        return SqliteStore()
+    if mode == 'memory':
+        return MemoryStore()
+    return None
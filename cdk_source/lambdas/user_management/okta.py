@@ -4,44 +4,103 @@
 """User management Lambda to manage connect users."""
 
 import os
-import re
 import json
 import logging
-import boto3
-import botocore
+import botocore.exceptions
+from clients import LazyClient
+from rate_limiter import RateLimitedClient
+from user_index import UserIndex
+from profile_catalog import ProfileCatalog
+from user_lookup import lookup_connect_user, search_connect_users
+from user_pages import UserPager, list_parameters, list_response
+from reconcile import Reconciler
+from scim_filter import Comparison, ScimFilterError, parse_filter, compile_filter, equality_value, search_criteria     # noqa: E501
+from scim_attributes import Projection
+from scim_resources import ScimUser, dumps
+from scim_bulk import ScimError, is_bulk_request, bulk_deadline, process_bulk, error_response     # noqa: E501
+from coalesce import coalesce_operations
+from write_queue import write_queue, mutation, drain_records, drain_queue
+from identity_store import identity_store, identity
+from user_replica import user_replica
+from idempotency import create_ledger, idempotent_create
+from fan_out import CONNECT_MAX_CONCURRENCY, run_concurrently
+from call_ledger import LEDGER, LedgerClient, instrumented
 
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.INFO)
 
-# boto3 service call
-CONNECT_CLIENT = boto3.client('connect')
+# boto3 service call, paced by the shared Connect rate limiter which also
+# retries throttled calls, so the botocore retries are turned off. The
+# client is created by the first Connect call of the container, with a
+# connection per concurrent call of a fan-out. Every attempt, throttled
+# ones included, and the time it waited on the limiter is recorded in the
+# call ledger of the invocation
+CONNECT_CLIENT = RateLimitedClient(LedgerClient(LazyClient('connect', max_attempts=1, max_pool_connections=CONNECT_MAX_CONCURRENCY)), ledger=LEDGER)     # noqa: E501
 
 # Environment variaable
 INSTANCE_ID = os.getenv("INSTANCE_ID")
 DEFAULT_ROUTING_PROFILE = os.getenv('DEFAULT_ROUTING_PROFILE')
 
+# Users on the instance, kept warm between invocations
+USER_INDEX = UserIndex(INSTANCE_ID)
+
+# Security and routing profile names, kept warm between invocations
+SECURITY_PROFILES = ProfileCatalog(INSTANCE_ID, 'list_security_profiles', 'SecurityProfileSummaryList')     # noqa: E501
+ROUTING_PROFILES = ProfileCatalog(INSTANCE_ID, 'list_routing_profiles', 'RoutingProfileSummaryList')     # noqa: E501
+
+# list_users cursors of the SCIM list windows, kept warm between invocations
+USER_PAGES = UserPager(INSTANCE_ID)
+
+# Queue of the user mutations when they are applied asynchronously
+WRITE_QUEUE = write_queue()
+
+# Connect users of the SCIM ids answered to queued creates, when configured
+IDENTITY_STORE = identity_store()
+
+# Shadow copy of the users answering the GETs, when configured
+USER_REPLICA = user_replica()
+
+# User creations of the last minutes, replayed to the IdP retries
+CREATE_LEDGER = create_ledger()
+
+# SCIM attributes a filter can address a user with, the externalId of an
+# Okta user being its username
+USER_KEY_ATTRIBUTES = ('userName', 'externalId', 'id')
+
+# SearchUsers fields the SCIM filter attributes are pushed down to
+SEARCH_FIELDS = {
+    'userName': 'Username',
+    'externalId': 'Username',
+    'name.givenName': 'FirstName',
+    'name.familyName': 'LastName'
+}
+
+# The fuction to get the Connect user id of a SCIM id
+
+
+def connect_user_key(userid):
+    """To get the Connect user id a SCIM id is mapped onto, or the SCIM id.
+
+    A queued create is answered with the userName as SCIM id, which the
+    drainer maps onto the Connect user id once created, so the SCIM id keeps
+    resolving after a rename.
+    """
+    record = IDENTITY_STORE.get('id', userid) if IDENTITY_STORE is not None and userid else None     # noqa: E501
+    return record['UserId'] if record else userid
+
 # The fuction to get connect user information
 
 
-def get_connect_user(userid):
-    """To get Connect user info."""
+def get_connect_user(userid, replica=None):
+    """To get Connect user info, from the replica when given."""
     user_found = {}
+    userid = connect_user_key(userid)
     try:
         LOGGER.info("Looking for %s in Connect instance %s...", userid, INSTANCE_ID)    # noqa: E501
-        paginator = CONNECT_CLIENT.get_paginator('list_users')
-        paginated_user_list = paginator.paginate(
-            InstanceId=INSTANCE_ID,
-            PaginationConfig={
-            }
-        )
-        for page in paginated_user_list:
-            for users in page['UserSummaryList']:
-                if userid == users['Id']:
-                    user_found = {
-                        "Username": users['Username'],
-                        "Id": users['Id']
-                    }
-                    LOGGER.info("User %s id: ['%s'] in Connect instance %s...", userid, user_found['Id'], INSTANCE_ID)    # noqa: E501
+        users = lookup_connect_user(CONNECT_CLIENT, INSTANCE_ID, USER_INDEX, userid, replica)     # noqa: E501
+        if users:
+            user_found = users
+            LOGGER.info("User %s id: ['%s'] in Connect instance %s...", userid, user_found['Id'], INSTANCE_ID)    # noqa: E501
         return user_found
     except botocore.exceptions.ClientError as error:
         LOGGER.error("Connect User Management Failure - Boto3 client error in UserManagementScimLambda while getting Connect user due to %s", error.response['Error']['Code'])     # noqa: E501
@@ -50,8 +109,12 @@ def get_connect_user(userid):
 
 # The fuction to Create connect user based on SCIM payload
 
-def create_connect_user(body):
-    """To create connect user based on scim payload."""
+def create_connect_user(body, scim_id=None):
+    """To create connect user based on scim payload.
+
+    scim_id is the SCIM id a queued create was answered with, mapped onto
+    the new user in the identity store.
+    """
     try:
         user_info = json.loads(body)
         user_name = user_info['userName']
@@ -62,8 +125,10 @@ def create_connect_user(body):
             routing_profile_name = ''.join(user_info["roles"])
         else:
             routing_profile_name = DEFAULT_ROUTING_PROFILE
-        sg_id_list = get_sg_id(security_profile)
-        routing_id = get_routing_id(routing_profile_name)
+        sg_id_list, routing_id = run_concurrently(
+            lambda: get_sg_id(security_profile),
+            lambda: get_routing_id(routing_profile_name)
+        )
         LOGGER.info("The security profile %s id: %s will be assigned to user %s", security_profile, sg_id_list, user_name)    # noqa: E501
         LOGGER.info("The routing profile ['%s'] id: ['%s'] will be assigned to user %s", routing_profile_name, routing_id, user_name)    # noqa: E501
         output = CONNECT_CLIENT.create_user(
@@ -81,6 +146,22 @@ def create_connect_user(body):
             RoutingProfileId=routing_id,
             InstanceId=INSTANCE_ID
         )
+        USER_INDEX.put({
+            "Id": output['UserId'],
+            "Arn": output['UserArn'],
+            "Username": user_name
+        })
+        if USER_REPLICA is not None:
+            USER_REPLICA.put({
+                "Id": output['UserId'],
+                "Arn": output['UserArn'],
+                "Username": user_name,
+                "IdentityInfo": {"FirstName": first_name, "LastName": last_name},     # noqa: E501
+                "SecurityProfileIds": sg_id_list,
+                "RoutingProfileId": routing_id
+            })
+        if IDENTITY_STORE is not None and scim_id:
+            IDENTITY_STORE.put(identity(scim_id, output['UserId'], None, user_name))     # noqa: E501
         user_info['id'] = output['UserId']
         return user_info
     except botocore.exceptions.ClientError as error:
@@ -88,41 +169,65 @@ def create_connect_user(body):
         raise error
 
 
+# The fuction to create a connect user once whatever the POST retries
+
+
+def post_connect_user(body):
+    """To create connect user, or queue its creation, at most once.
+
+    A retried POST gets the response of the first one, and a POST of a user
+    already on the instance gets that user instead of a second create_user.
+    """
+    def create(body):
+        if WRITE_QUEUE is not None:
+            return queue_user_mutation('create', '', body)
+        return create_connect_user(body)
+    return idempotent_create(CREATE_LEDGER, body, create, existing_connect_user)     # noqa: E501
+
+
+def existing_connect_user(body):
+    """To get the scim response of a POST for a user already in connect."""
+    user_info = json.loads(body)
+    user = get_connect_user(user_info['userName'])
+    if not user:
+        return None
+    user_info['id'] = user['Id']
+    return user_info
+
+
 # The fuction to get connect security profile.
 
 
 def get_sg_id(security_profile):
     """To get security profile id."""
     try:
-        sg_id = []
-        security_profile_list = CONNECT_CLIENT.list_security_profiles(
-            InstanceId=INSTANCE_ID,
-            MaxResults=1000
-        )
-        for each_security_profile in security_profile:
-            for profile in security_profile_list['SecurityProfileSummaryList']:
-                if each_security_profile == profile['Name']:
-                    sg_id.append(profile['Id'])
+        sg_id = SECURITY_PROFILES.get_ids(CONNECT_CLIENT, security_profile)
         return sg_id
     except botocore.exceptions.ClientError as error:
         LOGGER.error("Connect User Management Failure - Boto3 client error in UserManagementScimLambda while getting SecurityProfile Id due to %s", error.response['Error']['Code'])       # noqa: E501
         raise error
 
 
+# The fuction to get connect security profile names.
+
+
+def get_sg_names(security_profile_ids):
+    """To get security profile names from the profile catalog."""
+    try:
+        sg_names = SECURITY_PROFILES.get_names(CONNECT_CLIENT, security_profile_ids)     # noqa: E501
+        return sg_names
+    except botocore.exceptions.ClientError as error:
+        LOGGER.error("Connect User Management Failure - Boto3 client error in UserManagementScimLambda while getting SecurityProfile names due to %s", error.response['Error']['Code'])       # noqa: E501
+        raise error
+
+
 # The fuction to get connect Routing profile Id.
 
 
 def get_routing_id(routing_profile_name):
     """To get Routing profile id."""
     try:
-        routing_id = ''
-        routing_profile_list = CONNECT_CLIENT.list_routing_profiles(
-            InstanceId=INSTANCE_ID,
-            MaxResults=1000
-        )
-        for profile in routing_profile_list['RoutingProfileSummaryList']:
-            if routing_profile_name == profile['Name']:
-                routing_id = profile['Id']
+        routing_id = ROUTING_PROFILES.get_id(CONNECT_CLIENT, routing_profile_name)     # noqa: E501
         return routing_id
     except botocore.exceptions.ClientError as error:
         LOGGER.error("Connect User Management Failure - Boto3 client error in UserManagementScimLambda while getting Routing Profile Id due to %s", error.response['Error']['Code'])       # noqa: E501
@@ -140,42 +245,23 @@ def user_not_found_response():
         "totalResults": 0,
         "Resources": [],
         "startIndex": 1,
-        "itemsPerPage": 20
+        "itemsPerPage": 0
     }
     return return_response
 
 # SCIM response to send when user exist in Connect.
 
 
-def build_scim_user(user):
-    """To send SCIM response when a user exists on the instance."""
+def build_scim_user(user, projection=None):
+    """To send SCIM response when a user exists on the instance.
+
+    The entitlements need the describe_user record and the security profile
+    names, so they are only resolved when the projection returns them.
+    """
     LOGGER.info("The Existing user to build SCIM response %s", user)
-    sg_entitlement = []
+    projection = projection or Projection()
     try:
-        paginator = CONNECT_CLIENT.get_paginator('list_users')
-        paginated_user_list = paginator.paginate(
-            InstanceId=INSTANCE_ID,
-            PaginationConfig={
-            }
-        )
-        userid = user["Id"]
-        for page in paginated_user_list:
-            for users in page['UserSummaryList']:
-                if userid == users['Id']:
-                    get_user_info = CONNECT_CLIENT.describe_user(UserId=userid,
-                                                                 InstanceId=INSTANCE_ID)   # noqa: E501
-                    get_exist_sg_id = get_user_info['User']['SecurityProfileIds']     # noqa: E501
-        for each_sg_info in get_exist_sg_id:
-            get_sg_detail = CONNECT_CLIENT.describe_security_profile(
-                    SecurityProfileId=each_sg_info,
-                    InstanceId=INSTANCE_ID
-            )
-            get_sg_name = get_sg_detail['SecurityProfile']['SecurityProfileName']    # noqa: E501
-            sg_entitlement.append(get_sg_name)
-
-        user['entitlements'] = sg_entitlement
-        scim_user = "{{\"schemas\":[\"urn:ietf:params:scim:schemas:core:2.0:User\",\"urn:ietf:params:scim:schemas:extension:enterprise:2.0:User\"], \"id\":\"{}\",\"externalId\":\"{}\",\"userName\":\"{}\",\"active\":true,\"meta\":{{\"resourceType\":\"User\"}},\"roles\":[]}}".format(user["Id"], user["Username"],  user["Username"])      # noqa: E501
-        send_response = json.loads(scim_user)
+        send_response = ScimUser(user["Id"], user["Username"], user["Username"]).to_dict(projection)     # noqa: E501
         return_response = {
                 "schemas": [
                     "urn:ietf:params:scim:api:messages:2.0:ListResponse"
@@ -183,14 +269,82 @@ def build_scim_user(user):
                 "totalResults": 1,
                 "Resources": [send_response],
                 "startIndex": 1,
-                "itemsPerPage": 20,
-                "entitlements": sg_entitlement
+                "itemsPerPage": 1
             }
+        if projection.includes('entitlements'):
+            get_user_info, _ = run_concurrently(
+                lambda: user.details(CONNECT_CLIENT, INSTANCE_ID),
+                lambda: SECURITY_PROFILES.warm(CONNECT_CLIENT)
+            )
+            sg_entitlement = get_sg_names(get_user_info['SecurityProfileIds'])
+            user['entitlements'] = sg_entitlement
+            return_response['entitlements'] = sg_entitlement
         return return_response
     except botocore.exceptions.ClientError as error:
         LOGGER.error("Connect User Management Failure - Boto3 client error in UserManagementScimLambda while building scim response due to %s", error.response['Error']['Code'])     # noqa: E501
         raise error
 
+# SCIM response listing a window of the users in Connect.
+
+
+def list_connect_users(query):
+    """To send SCIM list response for the startIndex and count requested."""
+    start_index, count = list_parameters(query)
+    try:
+        users, total_results = USER_PAGES.window(CONNECT_CLIENT, start_index, count)     # noqa: E501
+    except botocore.exceptions.ClientError as error:
+        LOGGER.error("Connect User Management Failure - Boto3 client error in UserManagementScimLambda while listing Connect users due to %s", error.response['Error']['Code'])     # noqa: E501
+        raise error
+    projection = Projection.from_query(query)
+    resources = [projection.build(scim_list_user(summary)) for summary in users]     # noqa: E501
+    return list_response(resources, total_results, start_index)
+
+
+def scim_list_user(users):
+    """To build the SCIM user of a list_users summary or search_users user."""
+    identity_info = users.get('IdentityInfo') or {}
+    return ScimUser(
+        users['Id'],
+        users['Username'],
+        users['Username'],
+        given_name=identity_info.get('FirstName'),
+        family_name=identity_info.get('LastName')
+    ).to_dict()
+
+# SCIM response listing the users matching a filter.
+
+
+def filter_connect_users(filter_text, query):
+    """To send SCIM list response of the users matching a filter.
+
+    The filter is pushed down to search_users when every comparison maps
+    onto a SearchUsers field, otherwise the users are searched without
+    criteria. The compiled predicate is applied to the results either way,
+    as SearchUsers compares case sensitively where SCIM does not.
+    """
+    start_index, count = list_parameters(query)
+    predicate = compile_filter(filter_text)
+    criteria = search_criteria(parse_filter(filter_text), SEARCH_FIELDS)
+    if criteria is None:
+        LOGGER.info("Filter %s cannot be pushed down to search_users, filtering every user", filter_text)     # noqa: E501
+    try:
+        resources = [resource for resource in map(scim_list_user, search_connect_users(CONNECT_CLIENT, INSTANCE_ID, criteria)) if predicate(resource)]     # noqa: E501
+    except botocore.exceptions.ClientError as error:
+        LOGGER.error("Connect User Management Failure - Boto3 client error in UserManagementScimLambda while searching Connect users due to %s", error.response['Error']['Code'])     # noqa: E501
+        raise error
+    projection = Projection.from_query(query)
+    return list_response([projection.build(resource) for resource in resources[start_index - 1:start_index - 1 + count]], len(resources), start_index)     # noqa: E501
+
+# The user key an eq filter of the request asks for.
+
+
+def filter_user_key(query):
+    """To get the user an eq filter on userName or externalId asks for."""
+    filter_text = (query or {}).get('filter')
+    if not filter_text:
+        return ''
+    return equality_value(parse_filter(filter_text), USER_KEY_ATTRIBUTES) or ''     # noqa: E501
+
 # SCIM dumy response for group request.
 
 
@@ -210,29 +364,31 @@ def dummy_group_response():
 
 
 def update_connect_user(userid, body):
-    """To update connect user."""
+    """To update connect user.
+
+    The user and the security profile ids are looked up concurrently. An
+    unknown user raises a SCIM 404 error.
+    """
     user_info = json.loads(body)
     sg_entitlement = []
 
     try:
-        paginator = CONNECT_CLIENT.get_paginator('list_users')
-        paginated_user_list = paginator.paginate(
-            InstanceId=INSTANCE_ID,
-            PaginationConfig={
-            }
+        user, get_updated_sg_info = run_concurrently(
+            lambda: lookup_connect_user(CONNECT_CLIENT, INSTANCE_ID, USER_INDEX, connect_user_key(userid)),     # noqa: E501
+            lambda: get_sg_id(user_info['entitlements'])
         )
-        for page in paginated_user_list:
-            for users in page['UserSummaryList']:
-                if userid == users['Id']:
-                    get_updated_sg_info = get_sg_id(user_info['entitlements'])
-                    LOGGER.info("The updated list of security profile %s for the user %s", get_updated_sg_info, userid)     # noqa: E501
-                    CONNECT_CLIENT.update_user_security_profiles(SecurityProfileIds=get_updated_sg_info,        # noqa: E501
-                                                                 UserId=userid,         # noqa: E501
-                                                                 InstanceId=INSTANCE_ID)       # noqa: E501
-        for each_sg_info in get_updated_sg_info:
-            get_sg_detail = CONNECT_CLIENT.describe_security_profile(SecurityProfileId=each_sg_info, InstanceId=INSTANCE_ID)   # noqa: E501
-            get_sg_name = get_sg_detail['SecurityProfile']['SecurityProfileName']     # noqa: E501
-            sg_entitlement.append(get_sg_name)
+        if not user:
+            raise ScimError(404, "User %s not found" % userid)
+        if set(get_updated_sg_info) == set(user.details(CONNECT_CLIENT, INSTANCE_ID)['SecurityProfileIds']):     # noqa: E501
+            LOGGER.info("The security profiles %s of the user %s are unchanged", get_updated_sg_info, userid)     # noqa: E501
+        else:
+            LOGGER.info("The updated list of security profile %s for the user %s", get_updated_sg_info, userid)     # noqa: E501
+            CONNECT_CLIENT.update_user_security_profiles(SecurityProfileIds=get_updated_sg_info,        # noqa: E501
+                                                         UserId=user['Id'],         # noqa: E501
+                                                         InstanceId=INSTANCE_ID)       # noqa: E501
+        if USER_REPLICA is not None:
+            USER_REPLICA.put(dict(user.details(CONNECT_CLIENT, INSTANCE_ID), SecurityProfileIds=get_updated_sg_info))     # noqa: E501
+        sg_entitlement = get_sg_names(get_updated_sg_info)
         user_info["id"] = userid
         user_info["entitlements"] = sg_entitlement
         return user_info
@@ -240,9 +396,206 @@ def update_connect_user(userid, body):
         LOGGER.error("Connect User Management Failure - Boto3 client error in UserManagementScimLambda while updating Connect user due to %s", error.response['Error']['Code'])     # noqa: E501
         raise error
 
+# The function to delete connect user when it is deactivated.
+
+
+def delete_connect_user(userid):
+    """To delete connect user."""
+    user_id = connect_user_key(userid)
+    try:
+        CONNECT_CLIENT.delete_user(
+            InstanceId=INSTANCE_ID,
+            UserId=user_id
+        )
+        USER_INDEX.evict(user_id)
+        if USER_REPLICA is not None:
+            USER_REPLICA.delete(user_id)
+        if CREATE_LEDGER is not None:
+            CREATE_LEDGER.forget(userid)
+        record = IDENTITY_STORE.get('userId', user_id) if IDENTITY_STORE is not None else None     # noqa: E501
+        if record:
+            IDENTITY_STORE.delete(record)
+    except botocore.exceptions.ClientError as error:
+        LOGGER.error("Connect User Management Failure - Boto3 client error in UserManagementScimLambda while deleting Connect user due to %s", error.response['Error']['Code'])     # noqa: E501
+        raise error
+
+# The function to apply a PATCH of a bulk request.
+
+
+def patch_connect_user(userid, body):
+    """To deactivate connect user based on scim PATCH payload."""
+    user_update_info = json.loads(body)
+    if coalesce_operations(user_update_info['Operations']).get('active') is False:     # noqa: E501
+        delete_connect_user(userid)
+    user_update_info["id"] = userid
+    return user_update_info
+
+# The function to apply a DELETE of a bulk request.
+
+
+def remove_connect_user(userid, body):
+    """To delete connect user based on scim DELETE operation."""
+    delete_connect_user(userid)
+    return {"id": userid}
+
+# The functions applying each method of a bulk request.
+
+
+BULK_OPERATIONS = {
+    'POST': lambda userid, body: post_connect_user(body),
+    'PUT': update_connect_user,
+    'PATCH': patch_connect_user,
+    'DELETE': remove_connect_user
+}
+
+# The function to queue a PATCH of a bulk request.
+
+
+def queue_patch_connect_user(userid, body):
+    """To queue the deactivation of a scim PATCH payload."""
+    user_update_info = json.loads(body)
+    if coalesce_operations(user_update_info['Operations']).get('active') is False:     # noqa: E501
+        queue_user_mutation('delete', userid, body)
+    user_update_info["id"] = userid
+    return user_update_info
+
+# The functions queueing each method of a bulk request in asynchronous mode.
+
+
+QUEUED_BULK_OPERATIONS = {
+    'POST': lambda userid, body: post_connect_user(body),
+    'PUT': lambda userid, body: queue_user_mutation('update', userid, body),
+    'PATCH': queue_patch_connect_user,
+    'DELETE': lambda userid, body: queue_user_mutation('delete', userid, body)     # noqa: E501
+}
+
+# The function to map an exported Okta user onto its Connect state.
+
+
+def desired_connect_user(user_info):
+    """To get the Connect state of an exported scim user."""
+    return {
+        "Username": user_info['userName'],
+        "FirstName": user_info['name']['givenName'],
+        "LastName": user_info['name']['familyName'],
+        "SecurityProfiles": user_info.get('entitlements', []),
+        "RoutingProfile": ''.join(user_info['roles']) if user_info.get('roles') else None,     # noqa: E501
+        "Active": user_info.get('active', True) not in (False, 'False', 'false')     # noqa: E501
+    }
+
+
+# The function to write a reconciled user through to the user stores.
+
+
+def reconciled_connect_user(action, output):
+    """To write an action the reconciliation applied to the user stores."""
+    if action['action'] == 'create':
+        if USER_REPLICA is not None:
+            USER_REPLICA.put({
+                "Id": output['UserId'],
+                "Arn": output['UserArn'],
+                "Username": action['Username'],
+                "IdentityInfo": action['IdentityInfo'],
+                "SecurityProfileIds": action['SecurityProfileIds'],
+                "RoutingProfileId": action['RoutingProfileId']
+            })
+    elif action['action'] == 'delete':
+        if USER_REPLICA is not None:
+            USER_REPLICA.delete(action['UserId'])
+        if CREATE_LEDGER is not None:
+            CREATE_LEDGER.forget(action['Username'])
+    else:
+        record = USER_REPLICA.get(action['UserId']) if USER_REPLICA is not None else None     # noqa: E501
+        if record:
+            changed = dict((name, value) for name, value in action.items() if name in ('IdentityInfo', 'SecurityProfileIds'))     # noqa: E501
+            USER_REPLICA.put(dict(record, **changed))
+
+# The function to queue a user mutation in asynchronous mode.
+
+
+def queue_user_mutation(operation, userid, body):
+    """To validate and queue a user mutation, returning the SCIM response.
+
+    A queued user has no Connect id yet, so its userName is returned as
+    the SCIM id. The drainer maps it onto the Connect user id in the
+    identity store, which lookups consult before resolving a userName.
+    """
+    try:
+        user_info = json.loads(body)
+        if operation == 'create':
+            userid = user_info['userName']
+            if not (user_info['name']['givenName'] and user_info['name']['familyName'] and isinstance(user_info['entitlements'], list)):     # noqa: E501
+                raise ValueError('name and entitlements are required')
+        elif operation == 'update' and not isinstance(user_info['entitlements'], list):     # noqa: E501
+            raise ValueError('entitlements are required')
+    except (KeyError, ValueError, TypeError) as error:
+        raise ScimError(400, "Invalid user payload: %s" % error, 'invalidSyntax')     # noqa: E501
+    if not userid:
+        raise ScimError(400, "No user Id provided", 'invalidValue')
+    WRITE_QUEUE.send(mutation(operation, userid, body))
+    LOGGER.info("Queued %s of user %s", operation, userid)
+    user_info["id"] = userid
+    return user_info
+
+# The function to apply a queued user mutation.
+
+
+def apply_user_mutation(message):
+    """To apply a queued user mutation to connect."""
+    if message['operation'] == 'create':
+        try:
+            create_connect_user(message['body'], message['user'])
+        except botocore.exceptions.ClientError as error:
+            if error.response['Error']['Code'] != 'DuplicateResourceException':
+                raise error
+            LOGGER.info("Queued user %s already exists", message['user'])
+            user = lookup_connect_user(CONNECT_CLIENT, INSTANCE_ID, USER_INDEX, message['user'])     # noqa: E501
+            if user and IDENTITY_STORE is not None:
+                IDENTITY_STORE.put(identity(message['user'], user['Id'], None, user['Username']))     # noqa: E501
+    elif message['operation'] == 'update':
+        try:
+            update_connect_user(message['user'], message['body'])
+        except ScimError:
+            LOGGER.info("Queued user %s no longer exists", message['user'])
+    elif message['operation'] == 'delete':
+        user = lookup_connect_user(CONNECT_CLIENT, INSTANCE_ID, USER_INDEX, connect_user_key(message['user']))     # noqa: E501
+        if user:
+            delete_connect_user(user['Id'])
+
+# The function to merge two queued mutations of the same user.
+
+
+def merge_user_mutations(previous, message):
+    """To merge two queued user mutations, or None to apply both."""
+    if message['operation'] == 'delete' and previous['operation'] != 'delete':     # noqa: E501
+        return message
+    if message['operation'] != 'update':
+        return None
+    if previous['operation'] == 'update':
+        return message
+    if previous['operation'] == 'create':
+        user_info = json.loads(previous['body'])
+        user_info['entitlements'] = json.loads(message['body'])['entitlements']     # noqa: E501
+        return dict(previous, body=json.dumps(user_info))
+    return None
+
+# The response to send for a SCIM request.
+
+
+def scim_response(status, message):
+    """To build the API Gateway response of a SCIM message."""
+    return {
+        "statusCode": status,
+        "body": dumps(message),
+        "headers": {
+            'Content-Type': 'application/json',
+        }
+    }
+
 # Main Lambda function
 
 
+@instrumented('okta')
 def lambda_handler(event, context):
     """The handler for the user management."""
     LOGGER.info("Received event is %s", json.dumps(event))
@@ -250,6 +603,20 @@ def lambda_handler(event, context):
     body = event['body']
     method = event['httpMethod']
 
+    # Bulk request running many user operations in one invocation
+    if is_bulk_request(event):
+        bulk_operations = QUEUED_BULK_OPERATIONS if WRITE_QUEUE is not None else BULK_OPERATIONS     # noqa: E501
+        status, bulk_response = process_bulk(body, bulk_operations, bulk_deadline(context))     # noqa: E501
+        response_body = dumps(bulk_response)
+        LOGGER.info("Method:POST Bulk - SCIM Bulk Response ==========> %s", response_body)     # noqa: E501
+        return {
+            "statusCode": status,
+            "body": response_body,
+            "headers": {
+                'Content-Type': 'application/json',
+            }
+        }
+
     # Get method user management action
 
     if method == 'GET':
@@ -259,33 +626,57 @@ def lambda_handler(event, context):
             message = dummy_group_response()
             return {
                 "statusCode": 200,
-                "body": json.dumps(message),
+                "body": dumps(message),
                 "headers": {
                         'Content-Type': 'application/json',
                  }
                 }
+        # List of users when no filter is given
+        if event['pathParameters']['Users'] == 'Users' and not (event['queryStringParameters'] or {}).get('filter'):     # noqa: E501
+            scim_users = list_connect_users(event['queryStringParameters'])
+            LOGGER.info("Method:GET list of users - SCIM Response with %s users", scim_users['itemsPerPage'])     # noqa: E501
+            return {
+                'statusCode': 200,
+                'body': dumps(scim_users),
+                'headers': {
+                    'Content-Type': 'application/json',
+                }
+            }
         if (event['pathParameters'] and event['pathParameters']['Users'] and event['pathParameters']['Users'] != 'Users'):      # noqa: E501
             uid = event.pathParameters.proxy.split("/")[1]
-        if "externalId eq" in event['queryStringParameters']['filter']:
-            user_list = re.split(r'["\\\/\"]', event['queryStringParameters']['filter'])        # noqa: E501
-            uid = user_list[-1]
-        if "userName eq" in event['queryStringParameters']['filter']:
-            user_list = re.split(r'["\\\/\"]', event['queryStringParameters']['filter'])        # noqa: E501
-        uid = user_list[-1]
-        if uid == "":
-            uid = user_list[-2]
+        filter_text = event['queryStringParameters']['filter']
+        try:
+            uid = filter_user_key(event['queryStringParameters']) or uid
+            # Filters on other attributes are served from search_users
+            if uid == "":
+                scim_users = filter_connect_users(filter_text, event['queryStringParameters'])     # noqa: E501
+                LOGGER.info("Method:GET filtered list of users - SCIM Response with %s users", scim_users['itemsPerPage'])     # noqa: E501
+                return scim_response(200, scim_users)
+        except ScimFilterError as error:
+            LOGGER.error("Invalid filter %s due to %s", filter_text, error)
+            return scim_response(400, error_response(400, str(error), 'invalidFilter'))     # noqa: E501
         LOGGER.info("The user in the request is %s", uid)
         if uid != "":
-            user = get_connect_user(uid)
+            projection = Projection.from_query(event['queryStringParameters'])     # noqa: E501
+            # The profile names of the entitlements load alongside the user
+            user, _ = run_concurrently(
+                lambda: get_connect_user(uid, USER_REPLICA),
+                lambda: projection.includes('entitlements') and SECURITY_PROFILES.warm(CONNECT_CLIENT)     # noqa: E501
+            )
+            # The other terms of the filter are checked on the user found
+            if user and not isinstance(parse_filter(filter_text), Comparison):     # noqa: E501
+                user = user if compile_filter(filter_text)(scim_list_user(user.details(CONNECT_CLIENT, INSTANCE_ID))) else {}     # noqa: E501
             if user:
-                scim_user = build_scim_user(user)
-                LOGGER.info("Method:GET for existing user - SCIM User Response ==========> %s", json.dumps(scim_user))    # noqa: E501
+                scim_user = build_scim_user(user, projection)
+                response_body = dumps(scim_user)
+                LOGGER.info("Method:GET for existing user - SCIM User Response ==========> %s", response_body)    # noqa: E501
             else:
                 scim_user = user_not_found_response()
-                LOGGER.info("Method:GET - SCIM User Response ==========> %s", json.dumps(scim_user))      # noqa: E501
+                response_body = dumps(scim_user)
+                LOGGER.info("Method:GET - SCIM User Response ==========> %s", response_body)      # noqa: E501
             return {
                 'statusCode': 200,
-                'body': json.dumps(scim_user),
+                'body': response_body,
                 'headers': {
                     'Content-Type': 'application/json',
                 }
@@ -301,19 +692,23 @@ def lambda_handler(event, context):
             message = dummy_group_response()
             return {
                 "statusCode": 200,
-                "body": json.dumps(message),
+                "body": dumps(message),
                 "headers": {
                     'Content-Type': 'application/json',
                  }
                 }
         LOGGER.info("Method:POST - Add User %s", body)
-        user_to_create = create_connect_user(body)
+        try:
+            user_to_create = post_connect_user(body)
+        except ScimError as error:
+            return scim_response(error.status, error_response(error.status, error.detail, error.scim_type))     # noqa: E501
         LOGGER.info(user_to_create)
         if user_to_create:
-            LOGGER.info("Scim return response for POST ======> %s", json.dumps(user_to_create))      # noqa: E501
+            response_body = dumps(user_to_create)
+            LOGGER.info("Scim return response for POST ======> %s", response_body)      # noqa: E501
             return {
                 "statusCode": 200,
-                "body": json.dumps(user_to_create),
+                "body": response_body,
                 "headers": {
                     'Content-Type': 'application/json',
                 }
@@ -333,30 +728,32 @@ def lambda_handler(event, context):
             message = dummy_group_response()
             return {
                 "statusCode": 200,
-                "body": json.dumps(message),
+                "body": dumps(message),
                 "headers": {
                         'Content-Type': 'application/json',
                  }
                 }
         LOGGER.info("Method:PATCH - Update or Delete User %s", body)
-        uid = ''
-        if "userName eq" in event['queryStringParameters']['filter']:
-            user_list = re.split(r'["\\\/]', event['queryStringParameters']['filter'])    # noqa: E501
-            uid = user_list[-1]
+        try:
+            uid = filter_user_key(event['queryStringParameters'])
+        except ScimFilterError as error:
+            return scim_response(400, error_response(400, str(error), 'invalidFilter'))     # noqa: E501
         user_update_info = json.loads(body)
-        for info in user_update_info['Operations']:
-            user_status = info['value']['active']
+        user_status = coalesce_operations(user_update_info['Operations']).get('active')     # noqa: E501
         LOGGER.info("User status is ..... %s", user_status)
-        if user_status == False:
-            CONNECT_CLIENT.delete_user(
-                InstanceId=INSTANCE_ID,
-                UserId=uid
-            )
+        if user_status is False and WRITE_QUEUE is not None:
+            try:
+                return scim_response(200, queue_user_mutation('delete', uid, body))     # noqa: E501
+            except ScimError as error:
+                return scim_response(error.status, error_response(error.status, error.detail, error.scim_type))     # noqa: E501
+        if user_status is False:
+            delete_connect_user(uid)
             user_update_info["id"] = uid
-            LOGGER.info("The SCIM retur response for PATCH %s", json.dumps(user_update_info))     # noqa: E501
+            response_body = dumps(user_update_info)
+            LOGGER.info("The SCIM retur response for PATCH %s", response_body)     # noqa: E501
             return {
                 "statusCode": 200,
-                "body": json.dumps(user_update_info),
+                "body": response_body,
                 "headers": {
                         'Content-Type': 'application/json',
                  }
@@ -368,21 +765,67 @@ def lambda_handler(event, context):
             message = dummy_group_response()
             return {
                 "statusCode" : 200,
-                "body": json.dumps(message),
+                "body": dumps(message),
                 "headers": {
                         'Content-Type': 'application/json',
             }
         }
         LOGGER.info("Method:PUT - Update User attributes")
-        if "userName eq" in event['queryStringParameters']['filter']:
-            user_list = re.split(r'["\\\/]', event['queryStringParameters']['filter'])     # noqa: E501
-            uid = user_list[-1]
-        user_update = update_connect_user(uid, body)
-        LOGGER.info("The Scim return response for PUT ======> %s", json.dumps(user_update))    # noqa: E501
+        try:
+            uid = filter_user_key(event['queryStringParameters'])
+        except ScimFilterError as error:
+            return scim_response(400, error_response(400, str(error), 'invalidFilter'))     # noqa: E501
+        if WRITE_QUEUE is not None:
+            try:
+                return scim_response(200, queue_user_mutation('update', uid, body))     # noqa: E501
+            except ScimError as error:
+                return scim_response(error.status, error_response(error.status, error.detail, error.scim_type))     # noqa: E501
+        try:
+            user_update = update_connect_user(uid, body)
+        except ScimError as error:
+            return scim_response(error.status, error_response(error.status, error.detail, error.scim_type))     # noqa: E501
+        response_body = dumps(user_update)
+        LOGGER.info("The Scim return response for PUT ======> %s", response_body)    # noqa: E501
         return {
             "statusCode": 200,
-            "body": json.dumps(user_update),
+            "body": response_body,
             "headers": {
                 'Content-Type': 'application/json'
             }
-        }
\ No newline at end of file
+        }
+
+
+# Reconciliation Lambda function
+
+
+@instrumented('okta', 'RECONCILE')
+def reconcile_handler(event, context):
+    """The handler for the reconciliation of an IdP user export."""
+    LOGGER.info("Received reconciliation event is %s", json.dumps({key: value for key, value in event.items() if key != 'users'}))     # noqa: E501
+    reconciler = Reconciler(CONNECT_CLIENT, INSTANCE_ID, USER_INDEX, SECURITY_PROFILES, ROUTING_PROFILES, DEFAULT_ROUTING_PROFILE, reconciled_connect_user)     # noqa: E501
+    result = reconciler.run(event, context, desired_connect_user)
+    LOGGER.info("Reconciliation %s is %s after %s actions with %s errors", result['run_id'], result['status'], result.get('applied', 0), len(result['errors']))     # noqa: E501
+    return result
+
+
+# Write queue drainer Lambda function
+
+
+@instrumented('okta', 'DRAIN')
+def drain_handler(event, context):
+    """The handler applying the queued user mutations."""
+    if event.get('Records'):
+        return drain_records(event['Records'], apply_user_mutation, merge_user_mutations)     # noqa: E501
+    return drain_queue(WRITE_QUEUE, apply_user_mutation, merge_user_mutations)
+
+
+# User replica verifier Lambda function
+
+
+@instrumented('okta', 'VERIFY')
+def verify_handler(event, context):
+    """The handler bringing the user replica in line with the instance."""
+    if USER_REPLICA is None:
+        LOGGER.warning("No user replica is configured, USER_REPLICA_MODE is off")     # noqa: E501
+        return {}
+    return USER_REPLICA.verify(CONNECT_CLIENT, INSTANCE_ID)
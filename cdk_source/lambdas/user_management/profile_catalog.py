@@ -0,0 +1,99 @@
+"""Name and Id catalog of the security and routing profiles on the instance."""
+
+import os
+import time
+import logging
+import threading
+from call_ledger import LEDGER, operation_name
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+
+# Environment variable
+PROFILE_CATALOG_TTL = int(os.getenv('PROFILE_CATALOG_TTL', '900'))
+PROFILE_CATALOG_MISS_REFRESH = int(os.getenv('PROFILE_CATALOG_MISS_REFRESH', '30'))     # noqa: E501
+
+
+class ProfileCatalog(object):
+    """Name -> Id and Id -> Name maps of one kind of Connect profile.
+
+    The maps are rebuilt from the list operation once per TTL window, or
+    earlier when a lookup misses, so that a profile created on the instance
+    is picked up without waiting for the TTL. Miss driven refreshes are
+    spaced out so that unknown names coming from the IdP cannot turn every
+    request back into a list call. Lookups from concurrent threads share a
+    single refresh.
+    """
+
+    def __init__(self, instance_id, operation, summary_key,
+                 ttl=PROFILE_CATALOG_TTL,
+                 miss_refresh=PROFILE_CATALOG_MISS_REFRESH):
+        self.instance_id = instance_id
+        self.operation = operation
+        self.summary_key = summary_key
+        self.ttl = ttl
+        self.miss_refresh = miss_refresh
+        self.ids_by_name = {}
+        self.names_by_id = {}
+        self.loaded_at = None
+        self.lock = threading.Lock()
+        self.cache_name = operation_name(operation)[len('List'):]
+
+    def _age(self):
+        return time.monotonic() - self.loaded_at
+
+    def refresh(self, client):
+        """To rebuild the catalog from the list operation."""
+        ids_by_name = {}
+        names_by_id = {}
+        list_profiles = getattr(client, self.operation)
+        kwargs = {'InstanceId': self.instance_id, 'MaxResults': 1000}
+        while True:
+            response = list_profiles(**kwargs)
+            for profile in response[self.summary_key]:
+                ids_by_name[profile['Name']] = profile['Id']
+                names_by_id[profile['Id']] = profile['Name']
+            if not response.get('NextToken'):
+                break
+            kwargs['NextToken'] = response['NextToken']
+        self.ids_by_name = ids_by_name
+        self.names_by_id = names_by_id
+        self.loaded_at = time.monotonic()
+        LOGGER.info("Profile catalog %s refreshed with %s profiles", self.operation, len(ids_by_name))     # noqa: E501
+
+    def _ensure(self, client, missing):
+        """To refresh on TTL expiry, or on a miss once the spacing allows."""
+        with self.lock:
+            if self.loaded_at is None or self._age() > self.ttl:
+                self.refresh(client)
+                LEDGER.record_cache(self.cache_name, False)
+            elif missing() and self._age() > self.miss_refresh:
+                LOGGER.info("Profile catalog %s miss, refreshing", self.operation)     # noqa: E501
+                self.refresh(client)
+                LEDGER.record_cache(self.cache_name, False)
+            else:
+                LEDGER.record_cache(self.cache_name, True)
+
+    def warm(self, client):
+        """To load the catalog ahead of a lookup, when not loaded yet."""
+        self._ensure(client, lambda: False)
+
+    def get_ids(self, client, names):
+        """To get the Ids of the profile names, skipping unknown names."""
+        self._ensure(client, lambda: any(name not in self.ids_by_name for name in names))     # noqa: E501
+        return [self.ids_by_name[name] for name in names if name in self.ids_by_name]     # noqa: E501
+
+    def get_id(self, client, name):
+        """To get the Id of one profile name, or '' when unknown."""
+        ids = self.get_ids(client, [name])
+        return ids[0] if ids else ''
+
+    def get_names(self, client, ids):
+        """To get the names of the profile Ids, skipping unknown Ids."""
+        self._ensure(client, lambda: any(profile_id not in self.names_by_id for profile_id in ids))     # noqa: E501
+        return [self.names_by_id[profile_id] for profile_id in ids if profile_id in self.names_by_id]     # noqa: E501
+
+    def get_name(self, client, profile_id):
+        """To get the name of one profile Id, or '' when unknown."""
+        names = self.get_names(client, [profile_id])
+        return names[0] if names else ''
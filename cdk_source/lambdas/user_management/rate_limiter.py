@@ -0,0 +1,132 @@
+"""Client side pacing of the Amazon Connect API calls."""
+
+import os
+import json
+import time
+import random
+import logging
+import threading
+import botocore.exceptions
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+
+# Environment variable
+CONNECT_RATE_LIMIT = float(os.getenv('CONNECT_RATE_LIMIT', '2'))
+CONNECT_BURST_LIMIT = float(os.getenv('CONNECT_BURST_LIMIT', '5'))
+CONNECT_MAX_RETRIES = int(os.getenv('CONNECT_MAX_RETRIES', '5'))
+CONNECT_OPERATION_WEIGHTS = json.loads(os.getenv('CONNECT_OPERATION_WEIGHTS', '{}'))     # noqa: E501
+
+# Error codes returned by Connect when the account quota is exceeded
+THROTTLING_ERRORS = ('TooManyRequestsException', 'ThrottlingException', 'Throttling')     # noqa: E501
+
+# Client attributes that are not API calls and are passed through unpaced
+PASSTHROUGH_ATTRIBUTES = ('get_paginator', 'get_waiter', 'can_paginate', 'close')     # noqa: E501
+
+
+class TokenBucket(object):
+    """Token bucket with additive increase / multiplicative decrease.
+
+    The bucket starts at the documented Connect quota. Each throttling
+    response halves the refill rate, down to a tenth of the quota, and each
+    successful call wins back a twentieth of the quota, so the rate settles
+    just under what the account can sustain when other callers share it.
+    """
+
+    def __init__(self, rate=CONNECT_RATE_LIMIT, burst=CONNECT_BURST_LIMIT):
+        self.max_rate = rate
+        self.min_rate = rate / 10
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)     # noqa: E501
+        self.updated = now
+
+    def acquire(self, weight=1):
+        """To take tokens for one call, returning the seconds spent waiting.
+
+        The bucket never holds more than burst tokens, so a heavier weight
+        is taken as burst.
+        """
+        weight = min(weight, self.burst)
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= weight:
+                    self.tokens -= weight
+                    return waited
+                delay = (weight - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def on_throttle(self):
+        """To back off after a throttling response."""
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0
+        LOGGER.warning("Connect API throttled, pacing reduced to %.2f requests per second", self.rate)     # noqa: E501
+
+    def on_success(self):
+        """To recover the rate after a successful call."""
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+# Limiter shared by every Connect call made by the container
+CONNECT_RATE_LIMITER = TokenBucket()
+
+
+class RateLimitedClient(object):
+    """boto3 client proxy that paces every API call through a TokenBucket.
+
+    Throttled calls are retried with jittered exponential backoff up to
+    CONNECT_MAX_RETRIES times, so that the IdP sees a slower response
+    instead of a failed one. The seconds spent waiting on the bucket and
+    backing off are recorded per operation in the call ledger of the
+    invocation, whose LedgerClient under this proxy times the calls.
+    """
+
+    def __init__(self, client, limiter=CONNECT_RATE_LIMITER,
+                 weights=None, max_retries=CONNECT_MAX_RETRIES, ledger=None):
+        self.client = client
+        self.limiter = limiter
+        self.weights = CONNECT_OPERATION_WEIGHTS if weights is None else weights     # noqa: E501
+        self.max_retries = max_retries
+        self.ledger = ledger
+
+    def _record_wait(self, operation, seconds):
+        if self.ledger is not None:
+            self.ledger.record_wait(operation, seconds)
+
+    def _call(self, operation, method, *args, **kwargs):
+        attempt = 0
+        while True:
+            self._record_wait(operation, self.limiter.acquire(self.weights.get(operation, 1)))     # noqa: E501
+            try:
+                response = method(*args, **kwargs)
+            except botocore.exceptions.ClientError as error:
+                if error.response['Error']['Code'] not in THROTTLING_ERRORS or attempt >= self.max_retries:     # noqa: E501
+                    raise error
+                self.limiter.on_throttle()
+                attempt += 1
+                backoff = random.uniform(0, min(8.0, 0.25 * 2 ** attempt))
+                self._record_wait(operation, backoff)
+                time.sleep(backoff)
+                continue
+            self.limiter.on_success()
+            return response
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if name.startswith('_') or name in PASSTHROUGH_ATTRIBUTES or not callable(attribute):     # noqa: E501
+            return attribute
+
+        def paced_call(*args, **kwargs):
+            return self._call(name, attribute, *args, **kwargs)
+        return paced_call
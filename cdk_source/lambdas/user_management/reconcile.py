@@ -0,0 +1,300 @@
+"""Reconciliation of an IdP user export against the Amazon Connect instance."""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import botocore.exceptions
+from clients import client
+from fan_out import map_concurrently
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+
+# Environment variable
+RECONCILE_DELETE_MISSING = os.getenv('RECONCILE_DELETE_MISSING', 'false').lower() == 'true'     # noqa: E501
+RECONCILE_CHECKPOINT_BUCKET = os.getenv('RECONCILE_CHECKPOINT_BUCKET')
+RECONCILE_CHECKPOINT_DIR = os.getenv('RECONCILE_CHECKPOINT_DIR', '/tmp')
+RECONCILE_CHECKPOINT_EVERY = int(os.getenv('RECONCILE_CHECKPOINT_EVERY', '25'))     # noqa: E501
+RECONCILE_TIME_MARGIN = float(os.getenv('RECONCILE_TIME_MARGIN', '30'))
+RECONCILE_RESUME = os.getenv('RECONCILE_RESUME', 'true').lower() == 'true'
+
+# Errors on which the scan falls back to list_users and describe_user
+FALLBACK_ERRORS = ('AccessDeniedException', 'InvalidRequestException', 'InvalidParameterException')     # noqa: E501
+
+
+def read_export(lines):
+    """To read the SCIM user resources of a JSON lines export."""
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def index_export(resources, desired_user):
+    """To index the desired state of the exported users by username.
+
+    desired_user maps one SCIM user resource of the IdP onto a dict with
+    the Username, FirstName, LastName, SecurityProfiles, RoutingProfile and
+    Active keys.
+    """
+    desired_users = {}
+    for resource in resources:
+        desired = desired_user(resource)
+        desired_users[desired['Username'].lower()] = desired
+    return desired_users
+
+
+class CheckpointStore(object):
+    """Progress of a reconciliation run, in S3 or in a local directory.
+
+    The checkpoint holds the plan and the number of actions applied so a
+    run that reaches the Lambda timeout resumes where it stopped. S3 is used
+    when RECONCILE_CHECKPOINT_BUCKET is set, otherwise a file under
+    RECONCILE_CHECKPOINT_DIR, which only survives in a warm container.
+    """
+
+    def __init__(self, run_id, bucket=RECONCILE_CHECKPOINT_BUCKET,
+                 directory=RECONCILE_CHECKPOINT_DIR):
+        self.key = 'reconcile/%s.json' % run_id
+        self.bucket = bucket
+        self.path = os.path.join(directory, 'reconcile-%s.json' % run_id)
+        self.s3_client = client('s3') if bucket else None
+
+    def load(self):
+        """To get the saved checkpoint, or None."""
+        if self.bucket:
+            try:
+                checkpoint = self.s3_client.get_object(Bucket=self.bucket, Key=self.key)     # noqa: E501
+                return json.loads(checkpoint['Body'].read())
+            except botocore.exceptions.ClientError as error:
+                if error.response['Error']['Code'] in ('NoSuchKey', '404'):
+                    return None
+                raise error
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as checkpoint:
+            return json.load(checkpoint)
+
+    def save(self, checkpoint):
+        """To save the checkpoint."""
+        body = json.dumps(checkpoint)
+        if self.bucket:
+            self.s3_client.put_object(Bucket=self.bucket, Key=self.key, Body=body.encode('utf-8'))     # noqa: E501
+            return
+        with open(self.path + '.tmp', 'w') as checkpoint_file:
+            checkpoint_file.write(body)
+        os.replace(self.path + '.tmp', self.path)
+
+
+class Reconciler(object):
+    """Diffs the IdP users against the Connect users and repairs the drift.
+
+    The plan is built in one streaming pass over the users of the instance:
+    search_users pages already carry the identity info and security
+    profiles, so each Connect user is compared against the hashed index of
+    the export as it arrives and no per-user describe is needed. When
+    search_users is not permitted the pass runs over list_users and only the
+    users found in the export are described. Exported users never seen on
+    the instance are created, and users deactivated in the IdP are deleted,
+    as are users missing from the export when delete_missing is set.
+    write_through is called with each applied action and the create_user
+    output of a create, so that the handler updates the stores it keeps
+    next to Connect as its own writes do.
+    """
+
+    def __init__(self, client, instance_id, user_index, security_profiles,
+                 routing_profiles, default_routing_profile,
+                 write_through=None):
+        self.client = client
+        self.instance_id = instance_id
+        self.user_index = user_index
+        self.security_profiles = security_profiles
+        self.routing_profiles = routing_profiles
+        self.default_routing_profile = default_routing_profile
+        self.write_through = write_through
+
+    def scan_users(self):
+        """To yield the users of the instance, one page at a time."""
+        kwargs = {'InstanceId': self.instance_id, 'MaxResults': 500}
+        try:
+            while True:
+                page = self.client.search_users(**kwargs)
+                for users in page['Users']:
+                    yield users
+                if not page.get('NextToken'):
+                    return
+                kwargs['NextToken'] = page['NextToken']
+        except botocore.exceptions.ClientError as error:
+            if error.response['Error']['Code'] not in FALLBACK_ERRORS or 'NextToken' in kwargs:     # noqa: E501
+                raise error
+            LOGGER.warning("search_users failed due to %s, reconciling from list_users", error.response['Error']['Code'])     # noqa: E501
+        kwargs = {'InstanceId': self.instance_id, 'MaxResults': 1000}
+        while True:
+            page = self.client.list_users(**kwargs)
+            for users in page['UserSummaryList']:
+                yield users
+            if not page.get('NextToken'):
+                return
+            kwargs['NextToken'] = page['NextToken']
+
+    def _details(self, users):
+        if 'SecurityProfileIds' in users:
+            return users
+        user_info = self.client.describe_user(InstanceId=self.instance_id, UserId=users['Id'])     # noqa: E501
+        return user_info['User']
+
+    def build_plan(self, desired_users, delete_missing=RECONCILE_DELETE_MISSING):     # noqa: E501
+        """To compute the create, update and delete actions of the drift.
+
+        The describe_user calls needed when the users come from list_users
+        are made concurrently.
+        """
+        plan = []
+        seen = set()
+        kept = []
+        for users in self.scan_users():
+            key = users['Username'].lower()
+            desired = desired_users.get(key)
+            seen.add(key)
+            if desired is None or not desired['Active']:
+                if desired is not None or delete_missing:
+                    plan.append({'action': 'delete', 'UserId': users['Id'], 'Username': users['Username']})     # noqa: E501
+                continue
+            kept.append((users, desired))
+        missing = [users for users, desired in kept if 'SecurityProfileIds' not in users]     # noqa: E501
+        details = dict(zip([users['Id'] for users in missing], map_concurrently(self._details, missing)))     # noqa: E501
+        for users, desired in kept:
+            user_info = details.get(users['Id'], users)
+            sg_ids = self.security_profiles.get_ids(self.client, desired['SecurityProfiles'])     # noqa: E501
+            if sg_ids and sorted(sg_ids) != sorted(user_info['SecurityProfileIds']):     # noqa: E501
+                plan.append({'action': 'update_security_profiles', 'UserId': users['Id'], 'Username': users['Username'], 'SecurityProfileIds': sg_ids})     # noqa: E501
+            identity_info = user_info.get('IdentityInfo', {})
+            if (identity_info.get('FirstName'), identity_info.get('LastName')) != (desired['FirstName'], desired['LastName']):     # noqa: E501
+                identity_info = dict(identity_info, FirstName=desired['FirstName'], LastName=desired['LastName'])     # noqa: E501
+                plan.append({'action': 'update_identity_info', 'UserId': users['Id'], 'Username': users['Username'], 'IdentityInfo': identity_info})     # noqa: E501
+        for key, desired in desired_users.items():
+            if key in seen or not desired['Active']:
+                continue
+            plan.append({
+                'action': 'create',
+                'Username': desired['Username'],
+                'ExternalId': desired.get('ExternalId'),
+                'IdentityInfo': {'FirstName': desired['FirstName'], 'LastName': desired['LastName']},     # noqa: E501
+                'SecurityProfileIds': self.security_profiles.get_ids(self.client, desired['SecurityProfiles']),     # noqa: E501
+                'RoutingProfileId': self.routing_profiles.get_id(self.client, desired['RoutingProfile'] or self.default_routing_profile)     # noqa: E501
+            })
+        return plan
+
+    def apply(self, action):
+        """To apply one action of the plan to the instance."""
+        output = None
+        if action['action'] == 'create':
+            output = self.client.create_user(
+                Username=action['Username'],
+                IdentityInfo=action['IdentityInfo'],
+                PhoneConfig={
+                    'PhoneType': 'SOFT_PHONE',
+                    'AutoAccept': False,
+                    'AfterContactWorkTimeLimit': 30
+                },
+                SecurityProfileIds=action['SecurityProfileIds'],
+                RoutingProfileId=action['RoutingProfileId'],
+                InstanceId=self.instance_id
+            )
+            self.user_index.put({
+                "Id": output['UserId'],
+                "Arn": output['UserArn'],
+                "Username": action['Username']
+            })
+        elif action['action'] == 'delete':
+            self.client.delete_user(InstanceId=self.instance_id, UserId=action['UserId'])     # noqa: E501
+            self.user_index.evict(action['UserId'])
+        elif action['action'] == 'update_security_profiles':
+            self.client.update_user_security_profiles(SecurityProfileIds=action['SecurityProfileIds'], UserId=action['UserId'], InstanceId=self.instance_id)     # noqa: E501
+        elif action['action'] == 'update_identity_info':
+            self.client.update_user_identity_info(IdentityInfo=action['IdentityInfo'], UserId=action['UserId'], InstanceId=self.instance_id)     # noqa: E501
+        if self.write_through is not None:
+            self.write_through(action, output)
+
+    def execute(self, checkpoint, store, deadline,
+                every=RECONCILE_CHECKPOINT_EVERY):
+        """To apply the plan from the checkpoint until done or the deadline.
+
+        The Connect client paces every call, so the plan runs at the rate
+        the account quota allows. A failed action is recorded and skipped.
+        """
+        plan = checkpoint['plan']
+        while checkpoint['position'] < len(plan):
+            if time.monotonic() > deadline:
+                store.save(checkpoint)
+                LOGGER.info("Reconciliation paused at action %s of %s", checkpoint['position'], len(plan))     # noqa: E501
+                return checkpoint
+            action = plan[checkpoint['position']]
+            try:
+                self.apply(action)
+            except botocore.exceptions.ClientError as error:
+                LOGGER.error("Connect User Management Failure - Boto3 client error in UserManagementScimLambda while reconciling %s %s due to %s", action['action'], action['Username'], error.response['Error']['Code'])     # noqa: E501
+                checkpoint['errors'].append({'action': action['action'], 'Username': action['Username'], 'error': error.response['Error']['Code']})     # noqa: E501
+            checkpoint['position'] += 1
+            if checkpoint['position'] % every == 0:
+                store.save(checkpoint)
+        checkpoint['status'] = 'complete'
+        store.save(checkpoint)
+        return checkpoint
+
+    def run(self, event, context, desired_user):
+        """To run or resume the reconciliation described by the event.
+
+        The event names the export with export_bucket and export_key, or
+        holds its lines in users. run_id names the checkpoint and defaults
+        to a digest of the export location. dry_run returns the plan without
+        applying it. A run stopped by the Lambda deadline invokes the
+        function again asynchronously with its run_id, so it resumes from
+        its checkpoint without waiting for another export.
+        """
+        if event.get('export_bucket'):
+            source = 's3://%s/%s' % (event['export_bucket'], event['export_key'])     # noqa: E501
+        else:
+            source = '\n'.join(event.get('users', []))
+        run_id = event.get('run_id') or hashlib.sha256(source.encode('utf-8')).hexdigest()[:16]     # noqa: E501
+        store = CheckpointStore(run_id)
+        checkpoint = store.load()
+        if checkpoint is None or checkpoint['status'] == 'complete':
+            if event.get('export_bucket'):
+                export = client('s3').get_object(Bucket=event['export_bucket'], Key=event['export_key'])     # noqa: E501
+                lines = export['Body'].iter_lines()
+            else:
+                lines = event.get('users', [])
+            desired_users = index_export(read_export(lines), desired_user)
+            plan = self.build_plan(desired_users, event.get('delete_missing', RECONCILE_DELETE_MISSING))     # noqa: E501
+            LOGGER.info("Reconciliation %s of %s IdP users planned %s actions", run_id, len(desired_users), len(plan))     # noqa: E501
+            checkpoint = {'run_id': run_id, 'status': 'in_progress', 'position': 0, 'plan': plan, 'errors': []}     # noqa: E501
+            if event.get('dry_run'):
+                checkpoint['status'] = 'planned'
+                return checkpoint
+            store.save(checkpoint)
+        else:
+            LOGGER.info("Reconciliation %s resumed at action %s of %s", run_id, checkpoint['position'], len(checkpoint['plan']))     # noqa: E501
+        budget = context.get_remaining_time_in_millis() / 1000.0 - RECONCILE_TIME_MARGIN if context is not None else float('inf')     # noqa: E501
+        checkpoint = self.execute(checkpoint, store, time.monotonic() + budget)
+        if checkpoint['status'] == 'in_progress' and context is not None and RECONCILE_RESUME:     # noqa: E501
+            LOGGER.info("Reconciliation %s continues in a new invocation", run_id)     # noqa: E501
+            client('lambda').invoke(
+                FunctionName=context.invoked_function_arn,
+                InvocationType='Event',
+                Payload=json.dumps(dict(event, run_id=run_id)).encode('utf-8')
+            )
+        planned = {}
+        for action in checkpoint['plan']:
+            planned[action['action']] = planned.get(action['action'], 0) + 1
+        return {
+            'run_id': run_id,
+            'status': checkpoint['status'],
+            'planned': planned,
+            'applied': checkpoint['position'],
+            'errors': checkpoint['errors']
+        }
@@ -0,0 +1,80 @@
+"""SCIM attributes and excludedAttributes projection (RFC 7644 section 3.9)."""
+
+CORE_USER_SCHEMA = "urn:ietf:params:scim:schemas:core:2.0:User"
+ENTERPRISE_USER_SCHEMA = "urn:ietf:params:scim:schemas:extension:enterprise:2.0:User"     # noqa: E501
+
+# Attributes returned whatever the projection asks for
+ALWAYS_RETURNED = ('schemas', 'id')
+
+
+def attribute_paths(value):
+    """To split a comma separated attribute list into lower-cased paths.
+
+    Each path is a tuple of the top-level attribute and, when given, its
+    sub-attribute. The core schema URN prefix is dropped, an extension
+    attribute is kept under its schema URN.
+    """
+    paths = set()
+    for attribute in (value or '').split(','):
+        attribute = attribute.strip().lower()
+        if not attribute:
+            continue
+        if attribute.startswith(CORE_USER_SCHEMA.lower() + ':'):
+            attribute = attribute[len(CORE_USER_SCHEMA) + 1:]
+        if attribute.startswith(ENTERPRISE_USER_SCHEMA.lower() + ':'):
+            paths.add((ENTERPRISE_USER_SCHEMA.lower(), attribute[len(ENTERPRISE_USER_SCHEMA) + 1:]))     # noqa: E501
+        elif attribute.startswith('urn:'):
+            paths.add((attribute,))
+        else:
+            paths.add(tuple(attribute.split('.', 1)))
+    return paths
+
+
+class Projection(object):
+    """The attributes of a SCIM resource a request asks for.
+
+    Values of the built resource may be callables, which are only called
+    when their attribute is returned, so an attribute that costs Connect
+    calls is computed only when requested.
+    """
+
+    def __init__(self, attributes=None, excluded=None):
+        self.attributes = attribute_paths(attributes)
+        self.excluded = attribute_paths(excluded) if not self.attributes else set()     # noqa: E501
+
+    @classmethod
+    def from_query(cls, query):
+        """To get the projection of the query string parameters."""
+        query = query or {}
+        return cls(query.get('attributes'), query.get('excludedAttributes'))
+
+    def includes(self, name):
+        """To check whether a top-level attribute is returned."""
+        name = name.lower()
+        if name in ALWAYS_RETURNED:
+            return True
+        if self.attributes:
+            return any(path[0] == name for path in self.attributes)
+        return (name,) not in self.excluded
+
+    def _sub_attributes(self, name, value):
+        if not isinstance(value, dict):
+            return value
+        if self.attributes:
+            wanted = set(path[1] for path in self.attributes if path[0] == name and len(path) > 1)     # noqa: E501
+            if not wanted or (name,) in self.attributes:
+                return value
+            return dict((key, item) for key, item in value.items() if key.lower() in wanted)     # noqa: E501
+        dropped = set(path[1] for path in self.excluded if path[0] == name and len(path) > 1)     # noqa: E501
+        return dict((key, item) for key, item in value.items() if key.lower() not in dropped)     # noqa: E501
+
+    def build(self, fields):
+        """To build the resource of the returned fields, in their order."""
+        resource = {}
+        for key, value in fields.items():
+            if not self.includes(key):
+                continue
+            if callable(value):
+                value = value()
+            resource[key] = self._sub_attributes(key.lower(), value)
+        return resource
@@ -0,0 +1,200 @@
+"""SCIM 2.0 /Bulk requests (RFC 7644 section 3.7) for the user handlers."""
+
+import os
+import re
+import json
+import time
+import logging
+import botocore.exceptions
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+
+# Environment variable
+BULK_MAX_OPERATIONS = int(os.getenv('BULK_MAX_OPERATIONS', '1000'))
+BULK_TIME_LIMIT = float(os.getenv('BULK_TIME_LIMIT', '25'))
+
+BULK_REQUEST_SCHEMA = "urn:ietf:params:scim:api:messages:2.0:BulkRequest"
+BULK_RESPONSE_SCHEMA = "urn:ietf:params:scim:api:messages:2.0:BulkResponse"
+ERROR_SCHEMA = "urn:ietf:params:scim:api:messages:2.0:Error"
+
+# Status returned for a successful operation of each method
+SUCCESS_STATUS = {'POST': 201, 'PUT': 200, 'PATCH': 200, 'DELETE': 204}
+
+# Status returned for the Connect errors an operation can fail with
+CONNECT_ERROR_STATUS = {
+    'DuplicateResourceException': (409, 'uniqueness'),
+    'ResourceNotFoundException': (404, None),
+    'InvalidParameterException': (400, 'invalidValue'),
+    'InvalidRequestException': (400, 'invalidValue'),
+    'AccessDeniedException': (403, None),
+    'LimitExceededException': (429, None),
+    'TooManyRequestsException': (429, None),
+    'ThrottlingException': (429, None)
+}
+
+# A reference to the resource created by an earlier operation of the request
+BULK_ID_PATTERN = re.compile(r'bulkId:([\w.\-]+)')
+
+
+class ScimError(Exception):
+    """Error raised by a user operation with the SCIM status to return."""
+
+    def __init__(self, status, detail, scim_type=None):
+        super(ScimError, self).__init__(detail)
+        self.status = status
+        self.detail = detail
+        self.scim_type = scim_type
+
+
+def is_bulk_request(event):
+    """To check whether an API Gateway event is a POST to /Bulk."""
+    path = (event.get('pathParameters') or {}).get('Users') or ''
+    return event['httpMethod'] == 'POST' and path.rstrip('/').split('/')[-1] == 'Bulk'     # noqa: E501
+
+
+def bulk_deadline(context, time_limit=BULK_TIME_LIMIT):
+    """To get the monotonic time after which no operation is started.
+
+    The limit stays under the 29 seconds API Gateway integration timeout
+    and under the remaining Lambda time, keeping a second for the response.
+    """
+    budget = time_limit
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):     # noqa: E501
+        budget = min(budget, context.get_remaining_time_in_millis() / 1000.0 - 1)     # noqa: E501
+    return time.monotonic() + budget
+
+
+def error_response(status, detail, scim_type=None):
+    """To build a SCIM error response."""
+    response = {
+        "schemas": [ERROR_SCHEMA],
+        "status": str(status),
+        "detail": detail
+    }
+    if scim_type:
+        response['scimType'] = scim_type
+    return response
+
+
+def _resolve_bulk_id(value, bulk_ids):
+    """To get the id created for a value that is a bulkId:<id> reference."""
+    match = BULK_ID_PATTERN.fullmatch(value)
+    if match is None:
+        return value
+    if match.group(1) not in bulk_ids:
+        raise KeyError(value)
+    return bulk_ids[match.group(1)]
+
+
+def _resolve_path(path, bulk_ids):
+    """To resolve the bulkId references of the segments of a path."""
+    return '/'.join(_resolve_bulk_id(part, bulk_ids) for part in path.split('/'))     # noqa: E501
+
+
+def _resolve_data(data, bulk_ids):
+    """To resolve the bulkId references of the data of an operation.
+
+    As RFC 7644 section 3.7.2 describes, only a "value" attribute holding
+    exactly bulkId:<id> is a reference, any other text is left as is.
+    """
+    if isinstance(data, dict):
+        return dict(
+            (key, _resolve_bulk_id(item, bulk_ids) if key == 'value' and isinstance(item, str) else _resolve_data(item, bulk_ids))     # noqa: E501
+            for key, item in data.items()
+        )
+    if isinstance(data, list):
+        return [_resolve_data(item, bulk_ids) for item in data]
+    return data
+
+
+def _user_id_from_path(path):
+    """To get the user id of an operation path such as /Users/<id>."""
+    parts = [part for part in path.split('/') if part]
+    if not parts or parts[-1] == 'Users':
+        return ''
+    return parts[-1]
+
+
+def _run_operation(operation, operations, bulk_ids):
+    """To run one bulk operation, returning its status and resource."""
+    method = operation.get('method', '').upper()
+    if method not in operations:
+        return 405, error_response(405, "Method %s is not supported in a bulk request" % method)     # noqa: E501
+    if method == 'POST' and not operation.get('bulkId'):
+        return 400, error_response(400, "POST operations require a bulkId", 'invalidValue')     # noqa: E501
+    try:
+        path = _resolve_path(operation.get('path', ''), bulk_ids)
+        body = json.dumps(_resolve_data(operation.get('data', {}), bulk_ids))
+    except KeyError as error:
+        return 409, error_response(409, "Unresolved reference %s" % error.args[0], 'invalidValue')     # noqa: E501
+    userid = _user_id_from_path(path)
+    if method != 'POST' and not userid:
+        return 400, error_response(400, "No user id in path %s" % path, 'invalidPath')     # noqa: E501
+    try:
+        resource = operations[method](userid, body)
+    except ScimError as error:
+        return error.status, error_response(error.status, error.detail, error.scim_type)     # noqa: E501
+    except botocore.exceptions.ClientError as error:
+        code = error.response['Error']['Code']
+        status, scim_type = CONNECT_ERROR_STATUS.get(code, (500, None))
+        return status, error_response(status, code, scim_type)
+    except (KeyError, ValueError, TypeError, AttributeError) as error:
+        return 400, error_response(400, "Invalid operation data: %s" % error, 'invalidSyntax')     # noqa: E501
+    return SUCCESS_STATUS[method], resource
+
+
+def process_bulk(body, operations, deadline=None,
+                 max_operations=BULK_MAX_OPERATIONS):
+    """To run the operations of a SCIM BulkRequest and build the response.
+
+    operations maps each supported HTTP method to a function taking the
+    user id of the operation path and the JSON operation data and returning
+    the SCIM user resource. The functions are the ones the single request
+    handlers use, so every operation of the batch shares the warm profile
+    catalog, user index and Connect rate limiter of the container.
+
+    Processing stops once failOnErrors errors have occurred, or once the
+    deadline is reached, in which case the remaining operations are
+    returned with status 503 so the IdP can retry them.
+    Returns the HTTP status and the response body.
+    """
+    try:
+        request = json.loads(body)
+        requested = request['Operations']
+    except (KeyError, ValueError, TypeError):
+        return 400, error_response(400, "Invalid BulkRequest", 'invalidSyntax')     # noqa: E501
+    if len(requested) > max_operations:
+        return 413, error_response(413, "The BulkRequest has %s operations, the maximum is %s" % (len(requested), max_operations))     # noqa: E501
+    fail_on_errors = request.get('failOnErrors') or 0
+    bulk_ids = {}
+    results = []
+    errors = 0
+    LOGGER.info("Bulk request with %s operations", len(requested))
+    for operation in requested:
+        if fail_on_errors and errors >= fail_on_errors:
+            break
+        result = {'method': operation.get('method', '')}
+        if operation.get('bulkId'):
+            result['bulkId'] = operation['bulkId']
+        if deadline is not None and time.monotonic() > deadline:
+            status, resource = 503, error_response(503, "The bulk request time limit was reached before this operation")     # noqa: E501
+        else:
+            status, resource = _run_operation(operation, operations, bulk_ids)
+        result['status'] = str(status)
+        if status < 300:
+            userid = (resource or {}).get('id') or _user_id_from_path(operation.get('path', ''))     # noqa: E501
+            if operation.get('bulkId') and userid:
+                bulk_ids[operation['bulkId']] = userid
+            if userid:
+                result['location'] = '/Users/' + userid
+        else:
+            errors += 1
+            result['response'] = resource
+            LOGGER.error("Connect User Management Failure - bulk operation %s %s failed with status %s", result['method'], operation.get('path', ''), status)     # noqa: E501
+        results.append(result)
+    LOGGER.info("Bulk request completed %s operations with %s errors", len(results), errors)     # noqa: E501
+    return 200, {
+        "schemas": [BULK_RESPONSE_SCHEMA],
+        "Operations": results
+    }
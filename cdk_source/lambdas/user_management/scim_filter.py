@@ -0,0 +1,252 @@
+"""SCIM 2.0 filter parser (RFC 7644 section 3.4.2.2) and predicates."""
+
+import os
+import re
+import functools
+from collections import namedtuple
+
+# Environment variable
+SCIM_FILTER_CACHE_SIZE = int(os.getenv('SCIM_FILTER_CACHE_SIZE', '256'))
+
+# Filter nodes
+Comparison = namedtuple('Comparison', ['attribute', 'operator', 'value'])
+Present = namedtuple('Present', ['attribute'])
+And = namedtuple('And', ['left', 'right'])
+Or = namedtuple('Or', ['left', 'right'])
+Not = namedtuple('Not', ['expression'])
+
+COMPARISON_OPERATORS = ('eq', 'ne', 'co', 'sw', 'ew', 'gt', 'ge', 'lt', 'le')
+
+TOKEN_PATTERN = re.compile(r'''
+    \s*(?:
+        (?P<open>\()|
+        (?P<close>\))|
+        "(?P<string>(?:[^"\\]|\\.)*)"|
+        (?P<word>[A-Za-z0-9_:.$\-]+)
+    )''', re.VERBOSE)
+
+# Connect SearchUsers comparison of each pushed down SCIM operator
+SEARCH_COMPARISONS = {'eq': 'EXACT', 'sw': 'STARTS_WITH', 'co': 'CONTAINS'}
+
+
+class ScimFilterError(ValueError):
+    """Raised for a filter that is not valid SCIM filter syntax."""
+
+
+def _tokenize(text):
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = TOKEN_PATTERN.match(text, position)
+        if match is None:
+            raise ScimFilterError("Invalid filter near '%s'" % text[position:])
+        position = match.end()
+        if match.group('open'):
+            tokens.append(('(', '('))
+        elif match.group('close'):
+            tokens.append((')', ')'))
+        elif match.group('string') is not None:
+            tokens.append(('value', re.sub(r'\\(.)', r'\1', match.group('string'))))     # noqa: E501
+        else:
+            tokens.append(('word', match.group('word')))
+    return tokens
+
+
+class _Parser(object):
+    """Recursive descent parser, or binding looser than and, then not."""
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def _peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def _next(self):
+        token = self._peek()
+        if token[0] is None:
+            raise ScimFilterError("Unexpected end of filter")
+        self.position += 1
+        return token
+
+    def _keyword(self, word):
+        kind, value = self._peek()
+        return kind == 'word' and value.lower() == word
+
+    def parse(self):
+        expression = self._or()
+        if self._peek()[0] is not None:
+            raise ScimFilterError("Unexpected '%s' in filter" % self._peek()[1])     # noqa: E501
+        return expression
+
+    def _or(self):
+        expression = self._and()
+        while self._keyword('or'):
+            self._next()
+            expression = Or(expression, self._and())
+        return expression
+
+    def _and(self):
+        expression = self._not()
+        while self._keyword('and'):
+            self._next()
+            expression = And(expression, self._not())
+        return expression
+
+    def _not(self):
+        if self._keyword('not'):
+            self._next()
+            return Not(self._atom())
+        return self._atom()
+
+    def _atom(self):
+        kind, value = self._next()
+        if kind == '(':
+            expression = self._or()
+            if self._next()[0] != ')':
+                raise ScimFilterError("Missing ')' in filter")
+            return expression
+        if kind != 'word':
+            raise ScimFilterError("Expected an attribute, got '%s'" % value)
+        attribute = value
+        kind, operator = self._next()
+        if kind != 'word':
+            raise ScimFilterError("Expected an operator after %s" % attribute)
+        operator = operator.lower()
+        if operator == 'pr':
+            return Present(attribute)
+        if operator not in COMPARISON_OPERATORS:
+            raise ScimFilterError("Unknown operator %s" % operator)
+        kind, literal = self._next()
+        if kind == 'value':
+            return Comparison(attribute, operator, literal)
+        if kind == 'word' and literal.lower() in ('true', 'false', 'null'):
+            return Comparison(attribute, operator, {'true': True, 'false': False, 'null': None}[literal.lower()])     # noqa: E501
+        if kind == 'word':
+            try:
+                return Comparison(attribute, operator, float(literal) if '.' in literal else int(literal))     # noqa: E501
+            except ValueError:
+                pass
+        raise ScimFilterError("Invalid value for %s %s" % (attribute, operator))     # noqa: E501
+
+
+@functools.lru_cache(maxsize=SCIM_FILTER_CACHE_SIZE)
+def parse_filter(text):
+    """To parse a SCIM filter into its tree of nodes, cached by filter text."""
+    return _Parser(_tokenize(text)).parse()
+
+
+def _attribute_value(resource, attribute):
+    """To read an attribute path, ignoring case as SCIM attribute names do.
+
+    An attribute prefixed with a schema URN is read from the extension of
+    that schema, or from the resource itself for the core schema.
+    """
+    value = resource
+    if ':' in attribute:
+        schema, _, attribute = attribute.rpartition(':')
+        value = next((item for key, item in value.items() if key.lower() == schema.lower()), resource)     # noqa: E501
+    for name in attribute.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = next((item for key, item in value.items() if key.lower() == name.lower()), None)     # noqa: E501
+    return value
+
+
+def _compare(actual, operator, expected):
+    if operator == 'eq':
+        if isinstance(actual, str) and isinstance(expected, str):
+            return actual.lower() == expected.lower()
+        return actual == expected
+    if operator == 'ne':
+        return not _compare(actual, 'eq', expected)
+    if actual is None:
+        return False
+    if isinstance(actual, str) and isinstance(expected, str):
+        actual = actual.lower()
+        expected = expected.lower()
+    if operator == 'co':
+        return isinstance(actual, str) and expected in actual
+    if operator == 'sw':
+        return isinstance(actual, str) and actual.startswith(expected)
+    if operator == 'ew':
+        return isinstance(actual, str) and actual.endswith(expected)
+    try:
+        return {
+            'gt': actual > expected,
+            'ge': actual >= expected,
+            'lt': actual < expected,
+            'le': actual <= expected
+        }[operator]
+    except TypeError:
+        return False
+
+
+def _predicate(node):
+    if isinstance(node, Comparison):
+        return lambda resource: _compare(_attribute_value(resource, node.attribute), node.operator, node.value)     # noqa: E501
+    if isinstance(node, Present):
+        return lambda resource: _attribute_value(resource, node.attribute) not in (None, '', [], {})     # noqa: E501
+    if isinstance(node, Not):
+        expression = _predicate(node.expression)
+        return lambda resource: not expression(resource)
+    left = _predicate(node.left)
+    right = _predicate(node.right)
+    if isinstance(node, And):
+        return lambda resource: left(resource) and right(resource)
+    return lambda resource: left(resource) or right(resource)
+
+
+@functools.lru_cache(maxsize=SCIM_FILTER_CACHE_SIZE)
+def compile_filter(text):
+    """To compile a SCIM filter into a predicate on SCIM resources."""
+    return _predicate(parse_filter(text))
+
+
+def equality_value(node, attributes):
+    """To get the value an eq filter on one of the attributes asks for.
+
+    The comparison may be the whole filter or a term of an and. Returns
+    None for any other filter.
+    """
+    names = [attribute.lower() for attribute in attributes]
+    if isinstance(node, Comparison):
+        if node.operator == 'eq' and node.attribute.lower() in names and isinstance(node.value, str):     # noqa: E501
+            return node.value
+        return None
+    if isinstance(node, And):
+        value = equality_value(node.left, attributes)
+        return value if value is not None else equality_value(node.right, attributes)     # noqa: E501
+    return None
+
+
+def search_criteria(node, fields):
+    """To translate a filter into Connect SearchUsers SearchCriteria.
+
+    fields maps the SCIM attributes onto the SearchUsers string fields.
+    Returns None when a part of the filter cannot be pushed down, in which
+    case the compiled predicate has to be applied to the users instead.
+    """
+    fields = dict((attribute.lower(), field) for attribute, field in fields.items())     # noqa: E501
+    if isinstance(node, Comparison):
+        field = fields.get(node.attribute.lower())
+        if field is None or node.operator not in SEARCH_COMPARISONS or not isinstance(node.value, str):     # noqa: E501
+            return None
+        return {
+            'StringCondition': {
+                'FieldName': field,
+                'Value': node.value,
+                'ComparisonType': SEARCH_COMPARISONS[node.operator]
+            }
+        }
+    if isinstance(node, (And, Or)):
+        left = search_criteria(node.left, fields)
+        right = search_criteria(node.right, fields)
+        if left is None or right is None:
+            return None
+        key = 'AndConditions' if isinstance(node, And) else 'OrConditions'
+        return {key: left.get(key, [left]) + right.get(key, [right])}
+    return None
@@ -0,0 +1,72 @@
+"""SCIM User resources built as dicts and serialized once."""
+
+import json
+from scim_attributes import Projection, CORE_USER_SCHEMA, ENTERPRISE_USER_SCHEMA     # noqa: E501
+
+# orjson serializes several times faster than json and is used when it is
+# packaged with the function
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+USER_SCHEMAS = [CORE_USER_SCHEMA, ENTERPRISE_USER_SCHEMA]
+
+
+def dumps(message):
+    """To serialize a SCIM message with the fastest JSON backend available."""
+    if orjson is not None:
+        return orjson.dumps(message).decode('utf-8')
+    return json.dumps(message)
+
+
+class ScimUser(object):
+    """A SCIM User resource of a Connect user.
+
+    external_id, the name and the department are only part of the resource
+    when given. department is the comma separated security profile names,
+    or a callable returning them when they cost Connect calls to resolve,
+    so that a projection leaving the department out never calls it.
+    """
+
+    __slots__ = ('id', 'user_name', 'external_id', 'active', 'given_name',
+                 'family_name', 'department')
+
+    def __init__(self, id, user_name, external_id=None, active=True,
+                 given_name=None, family_name=None, department=None):
+        self.id = id
+        self.user_name = user_name
+        self.external_id = external_id
+        self.active = active
+        self.given_name = given_name
+        self.family_name = family_name
+        self.department = department
+
+    def _department(self):
+        department = self.department() if callable(self.department) else self.department     # noqa: E501
+        if isinstance(department, (list, tuple)):
+            department = ','.join(map(str, department))
+        return {"department": department}
+
+    def fields(self):
+        """To get the attributes of the resource, the department lazily."""
+        fields = {
+            "schemas": list(USER_SCHEMAS),
+            "id": self.id
+        }
+        if self.external_id is not None:
+            fields["externalId"] = self.external_id
+        if self.user_name is not None:
+            fields["userName"] = self.user_name
+        fields["active"] = self.active
+        fields["meta"] = {"resourceType": "User"}
+        fields["roles"] = []
+        if self.given_name is not None or self.family_name is not None:
+            fields["name"] = {"familyName": self.family_name, "givenName": self.given_name}     # noqa: E501
+        if self.department is not None:
+            fields[ENTERPRISE_USER_SCHEMA] = self._department
+        return fields
+
+    def to_dict(self, projection=None):
+        """To build the resource, keeping the attributes of the projection."""
+        return (projection or Projection()).build(self.fields())
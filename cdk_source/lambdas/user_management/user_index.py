@@ -0,0 +1,133 @@
+"""Warm-container index of the users on the Amazon Connect instance."""
+
+import os
+import time
+import logging
+from call_ledger import LEDGER
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+
+# Environment variable
+USER_INDEX_TTL = int(os.getenv('USER_INDEX_TTL', '300'))
+USER_INDEX_PAGE_SIZE = int(os.getenv('USER_INDEX_PAGE_SIZE', '1000'))
+
+
+class UserIndex(object):
+    """Id -> user summary and Username -> Id index built from list_users.
+
+    The index lives at module level so that it survives between invocations
+    of a warm Lambda container. Each TTL window starts an empty index which
+    is filled page by page as lookups miss: a lookup stops fetching pages as
+    soon as its user is found and the next lookup resumes from the saved
+    NextToken, so every page is fetched at most once per window. Users
+    created or deleted through this Lambda are applied to the index in place
+    so they are visible without another scan. The pages fetched and the
+    pages early exits left unfetched are counted in the call ledger of the
+    invocation and logged for the container when a window is complete.
+    """
+
+    def __init__(self, instance_id, ttl=USER_INDEX_TTL,
+                 page_size=USER_INDEX_PAGE_SIZE):
+        self.instance_id = instance_id
+        self.ttl = ttl
+        self.page_size = page_size
+        self.users_by_id = {}
+        self.ids_by_username = {}
+        self.loaded_at = None
+        self.next_token = None
+        self.complete = False
+        self.pages_in_window = 0
+        self.total_pages = None
+        self.stats = {
+            'pages_fetched': 0,
+            'pages_skipped': 0,
+            'early_exits': 0
+        }
+
+    def is_stale(self):
+        """To check whether the index window has expired."""
+        if self.loaded_at is None:
+            return True
+        return time.monotonic() - self.loaded_at > self.ttl
+
+    def clear(self):
+        """To start a new window, forcing a rescan on the next lookup."""
+        self.users_by_id = {}
+        self.ids_by_username = {}
+        self.loaded_at = None
+        self.next_token = None
+        self.complete = False
+        self.pages_in_window = 0
+
+    def _start_window(self):
+        self.clear()
+        self.loaded_at = time.monotonic()
+
+    def _find(self, key):
+        user = self.users_by_id.get(key)
+        if user is None and key in self.ids_by_username:
+            user = self.users_by_id.get(self.ids_by_username[key])
+        return user
+
+    def _fetch_page(self, client):
+        """To fetch the next list_users page of the current window."""
+        kwargs = {'InstanceId': self.instance_id, 'MaxResults': self.page_size}     # noqa: E501
+        if self.next_token:
+            kwargs['NextToken'] = self.next_token
+        page = client.list_users(**kwargs)
+        for users in page['UserSummaryList']:
+            self.users_by_id[users['Id']] = users
+            self.ids_by_username[users['Username']] = users['Id']
+        self.pages_in_window += 1
+        self.stats['pages_fetched'] += 1
+        LEDGER.record_count('UserIndexPagesFetched')
+        self.next_token = page.get('NextToken')
+        if not self.next_token:
+            self.complete = True
+            self.total_pages = self.pages_in_window
+            LOGGER.info("User index loaded %s users in %s pages for Connect instance %s, %s pages fetched, %s skipped by %s early exits in the container", len(self.users_by_id), self.total_pages, self.instance_id, self.stats['pages_fetched'], self.stats['pages_skipped'], self.stats['early_exits'])     # noqa: E501
+
+    def refresh(self, client):
+        """To rebuild the index from a full list_users scan."""
+        self._start_window()
+        while not self.complete:
+            self._fetch_page(client)
+
+    def get(self, client, key, early_exit=True):
+        """To get a user summary by Connect user Id or Username.
+
+        With early_exit the scan stops on the page holding the user and the
+        remaining pages are left for a later lookup in the same window.
+        """
+        if self.is_stale():
+            self._start_window()
+        user = self._find(key)
+        while user is None and not self.complete:
+            self._fetch_page(client)
+            user = self._find(key)
+            if user is not None and not self.complete and early_exit:
+                skipped = self.total_pages - self.pages_in_window if self.total_pages else 0     # noqa: E501
+                self.stats['early_exits'] += 1
+                self.stats['pages_skipped'] += skipped
+                LEDGER.record_count('UserIndexEarlyExits')
+                LEDGER.record_count('UserIndexPagesSkipped', skipped)
+                LOGGER.info("User %s found after %s list_users pages, scan paused with %s pages skipped", key, self.pages_in_window, skipped)     # noqa: E501
+        if not early_exit:
+            while not self.complete:
+                self._fetch_page(client)
+        return user
+
+    def put(self, summary):
+        """To add or replace a user summary without a rescan."""
+        previous = self.users_by_id.get(summary['Id'])
+        if previous is not None:
+            self.ids_by_username.pop(previous['Username'], None)
+        self.users_by_id[summary['Id']] = summary
+        self.ids_by_username[summary['Username']] = summary['Id']
+
+    def evict(self, userid):
+        """To drop a deleted user from the index."""
+        previous = self.users_by_id.pop(userid, None)
+        if previous is not None:
+            self.ids_by_username.pop(previous['Username'], None)
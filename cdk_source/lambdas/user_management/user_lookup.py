@@ -0,0 +1,142 @@
+"""Direct lookups of a single Amazon Connect user."""
+
+import os
+import re
+import logging
+import botocore.exceptions
+from call_ledger import LEDGER
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+
+# Environment variable
+USER_LOOKUP_STRATEGY = os.getenv('USER_LOOKUP_STRATEGY', 'direct')
+
+# Connect user ids are UUIDs, anything else is treated as a username
+USER_ID_PATTERN = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$', re.IGNORECASE)     # noqa: E501
+
+# Errors on which the direct strategy falls back to the user index
+FALLBACK_ERRORS = ('AccessDeniedException', 'InvalidRequestException', 'InvalidParameterException')     # noqa: E501
+
+
+class ResolvedUser(dict):
+    """A user resolved once per request and passed between the handlers.
+
+    The dict holds the Id, Username and Arn keys of a list_users summary so
+    it can be used wherever a summary was used before. The full user record
+    of describe_user is kept next to it: seeded when the lookup already
+    returned it and otherwise fetched on first use, at most once.
+    """
+
+    def __init__(self, summary, user=None):
+        super(ResolvedUser, self).__init__(summary)
+        self.user = user
+
+    def details(self, client, instance_id):
+        """To get the describe_user record, calling Connect at most once."""
+        if self.user is None:
+            user_info = client.describe_user(InstanceId=instance_id, UserId=self['Id'])     # noqa: E501
+            self.user = user_info['User']
+        return self.user
+
+
+def is_user_id(key):
+    """To check whether a lookup key is a Connect user id."""
+    return bool(USER_ID_PATTERN.match(key))
+
+
+def describe_connect_user(client, instance_id, userid):
+    """To get a user by id with one describe_user call, or None."""
+    try:
+        user_info = client.describe_user(InstanceId=instance_id, UserId=userid)     # noqa: E501
+        return user_info['User']
+    except botocore.exceptions.ClientError as error:
+        if error.response['Error']['Code'] == 'ResourceNotFoundException':
+            return None
+        raise error
+
+
+def search_connect_user(client, instance_id, username):
+    """To get a user by exact username with one search_users call, or None."""
+    search_result = client.search_users(
+        InstanceId=instance_id,
+        SearchCriteria={
+            'StringCondition': {
+                'FieldName': 'Username',
+                'Value': username,
+                'ComparisonType': 'EXACT'
+            }
+        },
+        MaxResults=1
+    )
+    for users in search_result['Users']:
+        if users['Username'] == username:
+            return users
+    return None
+
+
+def search_connect_users(client, instance_id, criteria=None, page_size=100):
+    """To yield the users matching SearchUsers criteria, one page at a time.
+
+    Without criteria every user of the instance is returned.
+    """
+    kwargs = {'InstanceId': instance_id, 'MaxResults': page_size}
+    if criteria:
+        kwargs['SearchCriteria'] = criteria
+    while True:
+        search_result = client.search_users(**kwargs)
+        for users in search_result['Users']:
+            yield users
+        if not search_result.get('NextToken'):
+            return
+        kwargs['NextToken'] = search_result['NextToken']
+
+
+def lookup_connect_user(client, instance_id, index, key, replica=None):
+    """To find a user by Connect user id or username as a ResolvedUser.
+
+    A user id is resolved with describe_user and a username with
+    search_users, so a lookup costs one Connect call whatever the size of
+    the instance. The user index is used when USER_LOOKUP_STRATEGY is
+    'index' or when the direct calls are not permitted on the instance.
+    The search_users and describe_user results carry the identity info and
+    security profiles of the user, so they seed the ResolvedUser record.
+
+    With a replica, a user it holds is resolved without any Connect call
+    and so is a missing user while the replica is complete. A user found
+    in Connect instead is written to the replica.
+    """
+    if replica is not None:
+        record = replica.get(key)
+        if record is not None:
+            LEDGER.record_cache('UserReplica', True)
+            return ResolvedUser({"Id": record['Id'], "Arn": record['Arn'], "Username": record['Username']}, record)     # noqa: E501
+        complete = replica.is_complete()
+        LEDGER.record_cache('UserReplica', complete)
+        if complete:
+            return None
+    if USER_LOOKUP_STRATEGY == 'direct':
+        try:
+            if is_user_id(key):
+                users = describe_connect_user(client, instance_id, key)
+            else:
+                users = search_connect_user(client, instance_id, key)
+            if users is None:
+                return None
+            summary = {
+                "Id": users['Id'],
+                "Arn": users['Arn'],
+                "Username": users['Username']
+            }
+            index.put(summary)
+            if replica is not None:
+                replica.put(users)
+            return ResolvedUser(summary, users)
+        except botocore.exceptions.ClientError as error:
+            if error.response['Error']['Code'] not in FALLBACK_ERRORS:
+                raise error
+            LOGGER.warning("Direct user lookup failed due to %s, falling back to the user index", error.response['Error']['Code'])     # noqa: E501
+    summary = index.get(client, key)
+    if summary is None:
+        return None
+    return ResolvedUser(summary)
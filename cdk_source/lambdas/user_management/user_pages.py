@@ -0,0 +1,149 @@
+"""SCIM list windows (startIndex/count) served from list_users pages."""
+
+import os
+import time
+import logging
+import botocore.exceptions
+from call_ledger import LEDGER
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+
+# Environment variable
+USER_PAGE_CURSOR_TTL = int(os.getenv('USER_PAGE_CURSOR_TTL', '300'))
+USER_PAGE_SIZE = int(os.getenv('USER_PAGE_SIZE', '100'))
+SCIM_MAX_COUNT = int(os.getenv('SCIM_MAX_COUNT', '100'))
+
+LIST_RESPONSE_SCHEMA = "urn:ietf:params:scim:api:messages:2.0:ListResponse"
+
+# Errors returned by Connect for an expired or unknown NextToken
+EXPIRED_TOKEN_ERRORS = ('InvalidParameterException', 'InvalidRequestException')     # noqa: E501
+
+
+def list_parameters(query, max_count=SCIM_MAX_COUNT):
+    """To get the 1-based startIndex and the count of a SCIM list request.
+
+    Values that are missing or not numbers fall back to the defaults, a
+    startIndex under 1 is read as 1 and count is capped at max_count, as
+    RFC 7644 section 3.4.2.4 allows.
+    """
+    query = query or {}
+    try:
+        start_index = max(1, int(query.get('startIndex', 1)))
+    except (TypeError, ValueError):
+        start_index = 1
+    try:
+        count = min(max_count, max(0, int(query.get('count', max_count))))
+    except (TypeError, ValueError):
+        count = max_count
+    return start_index, count
+
+
+def list_response(resources, total_results, start_index):
+    """To build a SCIM ListResponse."""
+    return {
+        "schemas": [LIST_RESPONSE_SCHEMA],
+        "totalResults": total_results,
+        "Resources": resources,
+        "startIndex": start_index,
+        "itemsPerPage": len(resources)
+    }
+
+
+class UserPager(object):
+    """Cursor cache mapping user offsets onto list_users NextToken pages.
+
+    Every page fetched records the offset of the first user of the next
+    page together with its NextToken, so a window starting anywhere in the
+    instance resumes from the nearest known cursor instead of paging from
+    the start. Only the pages overlapping the window are kept in memory
+    while it is read. Cursors are dropped once per TTL window, or when
+    Connect rejects a saved NextToken, and the total is known once the last
+    page has been reached. The pages fetched and whether a window past the
+    first page found the cursor of its first page are recorded in the call
+    ledger of the invocation.
+    """
+
+    def __init__(self, instance_id, ttl=USER_PAGE_CURSOR_TTL,
+                 page_size=USER_PAGE_SIZE):
+        self.instance_id = instance_id
+        self.ttl = ttl
+        self.page_size = page_size
+        self.cursors = {0: None}
+        self.total = None
+        self.loaded_at = None
+        self.stats = {
+            'pages_fetched': 0,
+            'cursor_hits': 0,
+            'cursor_misses': 0
+        }
+
+    def clear(self):
+        """To drop every saved cursor."""
+        self.cursors = {0: None}
+        self.total = None
+        self.loaded_at = time.monotonic()
+
+    def _fetch_page(self, client, offset):
+        """To fetch the list_users page starting at a saved cursor."""
+        kwargs = {'InstanceId': self.instance_id, 'MaxResults': self.page_size}     # noqa: E501
+        if self.cursors[offset]:
+            kwargs['NextToken'] = self.cursors[offset]
+        page = client.list_users(**kwargs)
+        self.stats['pages_fetched'] += 1
+        LEDGER.record_count('UserPagesFetched')
+        users = page['UserSummaryList']
+        if page.get('NextToken'):
+            self.cursors[offset + len(users)] = page['NextToken']
+        else:
+            self.total = offset + len(users)
+        return users, bool(page.get('NextToken'))
+
+    def _window(self, client, offset, count):
+        """To yield count user summaries from a 0-based offset."""
+        start = max(cursor for cursor in self.cursors if cursor <= offset)
+        if offset >= self.page_size:
+            hit = start > offset - self.page_size
+            self.stats['cursor_hits' if hit else 'cursor_misses'] += 1
+            LEDGER.record_cache('UserPageCursors', hit)
+            LOGGER.info("List window at offset %s resumed from offset %s, %s cursor hits and %s misses in the container", offset, start, self.stats['cursor_hits'], self.stats['cursor_misses'])     # noqa: E501
+        while count > 0:
+            users, more = self._fetch_page(client, start)
+            for summary in users[max(0, offset - start):]:
+                if count <= 0:
+                    return
+                yield summary
+                offset += 1
+                count -= 1
+            if not more:
+                return
+            start += len(users)
+
+    def window(self, client, start_index, count):
+        """To get the user summaries of a 1-based SCIM window and the total.
+
+        The total is the number of users on the instance when every page has
+        been seen, otherwise the ApproximateTotalCount of one search_users
+        call, or a lower bound when search_users is not permitted.
+        """
+        if self.loaded_at is None or time.monotonic() - self.loaded_at > self.ttl:     # noqa: E501
+            self.clear()
+        try:
+            users = list(self._window(client, start_index - 1, count))
+        except botocore.exceptions.ClientError as error:
+            if error.response['Error']['Code'] not in EXPIRED_TOKEN_ERRORS or len(self.cursors) == 1:     # noqa: E501
+                raise error
+            LOGGER.warning("Saved list_users cursor rejected due to %s, paging from the start", error.response['Error']['Code'])     # noqa: E501
+            self.clear()
+            users = list(self._window(client, start_index - 1, count))
+        return users, self._total(client, start_index - 1 + len(users))
+
+    def _total(self, client, seen):
+        if self.total is not None:
+            return self.total
+        try:
+            search_result = client.search_users(InstanceId=self.instance_id, MaxResults=1)     # noqa: E501
+            return max(seen, search_result.get('ApproximateTotalCount', seen))
+        except botocore.exceptions.ClientError as error:
+            LOGGER.warning("Total user count not available due to %s", error.response['Error']['Code'])     # noqa: E501
+            return seen + 1
@@ -0,0 +1,251 @@
+"""Read replica of the Connect user directory serving the SCIM GETs."""
+
+import os
+import json
+import time
+import logging
+import sqlite3
+import threading
+from clients import client
+from user_lookup import is_user_id, search_connect_users
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+
+# Environment variable
+USER_REPLICA_MODE = os.getenv('USER_REPLICA_MODE', 'off')
+USER_REPLICA_TABLE = os.getenv('USER_REPLICA_TABLE')
+USER_REPLICA_FILE = os.getenv('USER_REPLICA_FILE', '/tmp/scim-user-replica.db')     # noqa: E501
+USER_REPLICA_MAX_AGE = int(os.getenv('USER_REPLICA_MAX_AGE', '1800'))
+
+# Key of the time of the last full verification
+SYNC_KEY = 'sync#'
+
+# Attributes of a replica record compared by the verifier
+RECORD_ATTRIBUTES = ('Id', 'Arn', 'Username', 'IdentityInfo', 'SecurityProfileIds', 'RoutingProfileId')     # noqa: E501
+
+
+def replica_record(user):
+    """To get the replica record of a describe_user or search_users user.
+
+    The record has the shape of the describe_user User, so it can stand in
+    for it wherever the user details are read.
+    """
+    identity_info = user.get('IdentityInfo') or {}
+    return {
+        'Id': user['Id'],
+        'Arn': user.get('Arn'),
+        'Username': user['Username'],
+        'IdentityInfo': {
+            'FirstName': identity_info.get('FirstName'),
+            'LastName': identity_info.get('LastName')
+        },
+        'SecurityProfileIds': sorted(user.get('SecurityProfileIds') or []),
+        'RoutingProfileId': user.get('RoutingProfileId'),
+        'UpdatedAt': time.time()
+    }
+
+
+def record_keys(record):
+    """To get the keys a record is stored under."""
+    return ['id#' + record['Id'], 'userName#' + record['Username']]
+
+
+def lookup_key(key):
+    """To get the key of a Connect user id or username lookup."""
+    return ('id#' if is_user_id(key) else 'userName#') + key
+
+
+class MemoryTable(object):
+    """In-process replica table, for tests and local runs."""
+
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """To get the record stored under a key, or None."""
+        with self.lock:
+            return self.items.get(key)
+
+    def put(self, keys, record):
+        """To store a record under each of its keys."""
+        with self.lock:
+            for key in keys:
+                self.items[key] = record
+
+    def delete(self, keys):
+        """To remove the records stored under the keys."""
+        with self.lock:
+            for key in keys:
+                self.items.pop(key, None)
+
+    def records(self):
+        """To get every user record."""
+        with self.lock:
+            return [record for key, record in self.items.items() if key.startswith('id#')]     # noqa: E501
+
+
+class SqliteTable(object):
+    """Replica table kept in a SQLite file, surviving a process restart."""
+
+    def __init__(self, path=USER_REPLICA_FILE):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS users (key TEXT PRIMARY KEY, record TEXT NOT NULL)')     # noqa: E501
+
+    def get(self, key):
+        """To get the record stored under a key, or None."""
+        with self.lock:
+            row = self.connection.execute('SELECT record FROM users WHERE key = ?', (key,)).fetchone()     # noqa: E501
+        return json.loads(row[0]) if row else None
+
+    def put(self, keys, record):
+        """To store a record under each of its keys."""
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO users (key, record) VALUES (?, ?)', [(key, json.dumps(record)) for key in keys])     # noqa: E501
+
+    def delete(self, keys):
+        """To remove the records stored under the keys."""
+        with self.lock, self.connection:
+            self.connection.executemany('DELETE FROM users WHERE key = ?', [(key,) for key in keys])     # noqa: E501
+
+    def records(self):
+        """To get every user record."""
+        with self.lock:
+            rows = self.connection.execute("SELECT record FROM users WHERE key LIKE 'id#%'").fetchall()     # noqa: E501
+        return [json.loads(row[0]) for row in rows]
+
+
+class DynamoTable(object):
+    """Replica table in DynamoDB with a Key string partition key.
+
+    The record is kept as JSON in a Record attribute, written in full under
+    the Connect user id and the username so that either resolves the user
+    with one GetItem.
+    """
+
+    def __init__(self, table=USER_REPLICA_TABLE):
+        self.table = table
+
+    def get(self, key):
+        """To get the record stored under a key, or None."""
+        item = client('dynamodb').get_item(
+            TableName=self.table,
+            Key={'Key': {'S': key}},
+            ConsistentRead=True
+        ).get('Item')
+        return json.loads(item['Record']['S']) if item else None
+
+    def _write(self, requests):
+        for start in range(0, len(requests), 25):
+            request_items = {self.table: requests[start:start + 25]}
+            for attempt in range(5):
+                request_items = client('dynamodb').batch_write_item(RequestItems=request_items).get('UnprocessedItems')     # noqa: E501
+                if not request_items:
+                    break
+                time.sleep(0.05 * 2 ** attempt)
+            if request_items:
+                raise RuntimeError("User replica writes left unprocessed: %s" % request_items)     # noqa: E501
+
+    def put(self, keys, record):
+        """To store a record under each of its keys."""
+        self._write([{'PutRequest': {'Item': {'Key': {'S': key}, 'Record': {'S': json.dumps(record)}}}} for key in keys])     # noqa: E501
+
+    def delete(self, keys):
+        """To remove the records stored under the keys."""
+        self._write([{'DeleteRequest': {'Key': {'Key': {'S': key}}}} for key in keys])     # noqa: E501
+
+    def records(self):
+        """To get every user record, scanning the table."""
+        records = []
+        kwargs = {
+            'TableName': self.table,
+            'FilterExpression': 'begins_with(#key, :prefix)',
+            'ExpressionAttributeNames': {'#key': 'Key'},
+            'ExpressionAttributeValues': {':prefix': {'S': 'id#'}}
+        }
+        while True:
+            page = client('dynamodb').scan(**kwargs)
+            records.extend(json.loads(item['Record']['S']) for item in page['Items'])     # noqa: E501
+            if not page.get('LastEvaluatedKey'):
+                return records
+            kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+
+class UserReplica(object):
+    """Shadow copy of the users of the instance answering the SCIM GETs.
+
+    The SCIM mutations write their result through, and verify() rebuilds
+    the replica from a full search_users scan on a schedule so that changes
+    made outside of SCIM are picked up. While the last verification is
+    younger than max_age a user missing from the replica does not exist,
+    otherwise the caller falls back to Connect.
+    """
+
+    def __init__(self, table, max_age=USER_REPLICA_MAX_AGE):
+        self.table = table
+        self.max_age = max_age
+
+    def get(self, key):
+        """To get the record of a user by Connect user id or username."""
+        return self.table.get(lookup_key(key))
+
+    def is_complete(self):
+        """To check whether a miss can be answered without Connect."""
+        sync = self.table.get(SYNC_KEY)
+        return bool(sync) and time.time() - sync['SyncedAt'] <= self.max_age
+
+    def put(self, user):
+        """To write a user through, given its describe_user record."""
+        record = replica_record(user)
+        previous = self.table.get('id#' + record['Id'])
+        if previous is not None and previous['Username'] != record['Username']:     # noqa: E501
+            self.table.delete(['userName#' + previous['Username']])
+        self.table.put(record_keys(record), record)
+
+    def delete(self, key):
+        """To remove a user by Connect user id or username."""
+        record = self.get(key)
+        if record is not None:
+            self.table.delete(record_keys(record))
+
+    def verify(self, connect_client, instance_id):
+        """To bring the replica in line with the instance.
+
+        Records written through after the scan started are left alone, as
+        the scan may predate them.
+        """
+        started = time.time()
+        stats = {'users': 0, 'added': 0, 'updated': 0, 'removed': 0}
+        existing = dict((record['Id'], record) for record in self.table.records())     # noqa: E501
+        for user in search_connect_users(connect_client, instance_id):
+            stats['users'] += 1
+            previous = existing.pop(user['Id'], None)
+            record = replica_record(user)
+            if previous is not None and previous.get('UpdatedAt', 0) > started:
+                continue
+            if previous is not None and all(previous.get(name) == record[name] for name in RECORD_ATTRIBUTES):     # noqa: E501
+                continue
+            stats['updated' if previous is not None else 'added'] += 1
+            self.put(user)
+        for record in existing.values():
+            if record.get('UpdatedAt', 0) > started:
+                continue
+            stats['removed'] += 1
+            self.table.delete(record_keys(record))
+        self.table.put([SYNC_KEY], {'SyncedAt': started})
+        LOGGER.info("User replica verified %s users of Connect instance %s: %s added, %s updated, %s removed", stats['users'], instance_id, stats['added'], stats['updated'], stats['removed'])     # noqa: E501
+        return stats
+
+
+def user_replica(mode=USER_REPLICA_MODE):
+    """To get the user replica of the mode, or None when GETs read Connect."""
+    if mode == 'dynamodb':
+        return UserReplica(DynamoTable())
+    if mode == 'sqlite':
+        return UserReplica(SqliteTable())
+    if mode == 'memory':
+        return UserReplica(MemoryTable())
+    return None
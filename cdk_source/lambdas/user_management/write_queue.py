@@ -0,0 +1,194 @@
+"""Write-behind queue of the SCIM user mutations applied to Amazon Connect."""
+
+import os
+import json
+import time
+import uuid
+import hashlib
+import logging
+import threading
+from clients import client
+from coalesce import coalesce_mutations
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+
+# Environment variable
+WRITE_QUEUE_MODE = os.getenv('WRITE_QUEUE_MODE', 'off')
+WRITE_QUEUE_URL = os.getenv('WRITE_QUEUE_URL')
+WRITE_QUEUE_FILE = os.getenv('WRITE_QUEUE_FILE', '/tmp/scim-write-queue.jsonl')     # noqa: E501
+WRITE_QUEUE_DEBOUNCE = float(os.getenv('WRITE_QUEUE_DEBOUNCE', '5'))
+
+
+def mutation(operation, user, body):
+    """To build a queued mutation of one user.
+
+    user is the key the IdP addresses the user with and orders the
+    mutations: all the mutations of one key are applied in the order they
+    were queued.
+    """
+    return {
+        'id': str(uuid.uuid4()),
+        'operation': operation,
+        'user': user,
+        'body': body,
+        'queued_at': time.time()
+    }
+
+
+class MemoryQueue(object):
+    """In-process FIFO queue, for tests and local runs."""
+
+    def __init__(self):
+        self.messages = []
+        self.lock = threading.Lock()
+
+    def send(self, message):
+        """To queue a mutation."""
+        with self.lock:
+            self.messages.append(message)
+
+    def receive(self, max_messages=10):
+        """To get the oldest mutations without removing them."""
+        with self.lock:
+            return list(self.messages[:max_messages])
+
+    def delete(self, message_ids):
+        """To remove applied mutations."""
+        with self.lock:
+            self.messages = [message for message in self.messages if message['id'] not in message_ids]     # noqa: E501
+
+
+class FileQueue(MemoryQueue):
+    """FIFO queue kept in a JSON lines file, surviving a process restart."""
+
+    def __init__(self, path=WRITE_QUEUE_FILE):
+        super(FileQueue, self).__init__()
+        self.path = path
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as queue_file:
+            return [json.loads(line) for line in queue_file if line.strip()]     # noqa: E501
+
+    def _store(self, messages):
+        with open(self.path + '.tmp', 'w') as queue_file:
+            for message in messages:
+                queue_file.write(json.dumps(message) + '\n')
+        os.replace(self.path + '.tmp', self.path)
+
+    def send(self, message):
+        """To queue a mutation."""
+        with self.lock:
+            with open(self.path, 'a') as queue_file:
+                queue_file.write(json.dumps(message) + '\n')
+
+    def receive(self, max_messages=10):
+        """To get the oldest mutations without removing them."""
+        with self.lock:
+            return self._load()[:max_messages]
+
+    def delete(self, message_ids):
+        """To remove applied mutations."""
+        with self.lock:
+            self._store([message for message in self._load() if message['id'] not in message_ids])     # noqa: E501
+
+
+class SqsQueue(object):
+    """SQS FIFO queue using the user key as message group.
+
+    Mutations are received by the drainer through the SQS event source
+    rather than polled, so only send is needed here.
+    """
+
+    def __init__(self, queue_url=WRITE_QUEUE_URL):
+        self.queue_url = queue_url
+
+    def send(self, message):
+        """To queue a mutation."""
+        client('sqs').send_message(
+            QueueUrl=self.queue_url,
+            MessageBody=json.dumps(message),
+            MessageGroupId=hashlib.sha256(message['user'].encode('utf-8')).hexdigest(),     # noqa: E501
+            MessageDeduplicationId=message['id']
+        )
+
+
+def write_queue(mode=WRITE_QUEUE_MODE):
+    """To get the queue of the mode, or None when mutations are synchronous."""
+    if mode == 'sqs':
+        return SqsQueue()
+    if mode == 'file':
+        return FileQueue()
+    if mode == 'memory':
+        return MemoryQueue()
+    return None
+
+
+def _apply_in_order(messages, apply, merge=None):
+    """To apply mutations, stopping a user key at its first failure.
+
+    With merge, the mutations of each user are coalesced first so that
+    several updates of a user cost one Connect write. Returns the ids of
+    the applied mutations and of the failed or held back ones. A mutation
+    queued after a failed one for the same user is held back so it cannot
+    overtake it when the failure is retried.
+    """
+    if merge is None:
+        groups = [(message, [message['id']]) for message in messages]
+    else:
+        groups = coalesce_mutations(messages, merge)
+    applied = []
+    failed = []
+    blocked = set()
+    for message, message_ids in groups:
+        if message['user'] in blocked:
+            failed.extend(message_ids)
+            continue
+        try:
+            apply(message)
+            applied.extend(message_ids)
+        except Exception as error:     # noqa: B902
+            LOGGER.error("Connect User Management Failure - queued %s of user %s failed due to %s", message['operation'], message['user'], error)     # noqa: E501
+            blocked.add(message['user'])
+            failed.extend(message_ids)
+    if len(groups) < len(messages):
+        LOGGER.info("Write queue coalesced %s mutations into %s", len(messages), len(groups))     # noqa: E501
+    return applied, failed
+
+
+def drain_records(records, apply, merge=None):
+    """To apply the mutations of an SQS event, reporting partial failures.
+
+    The returned batchItemFailures make SQS redeliver the failed and held
+    back messages only, which requires ReportBatchItemFailures on the
+    event source mapping. The queue delivery delay debounces the mutations
+    of a user so they arrive in the same batch.
+    """
+    messages = []
+    message_ids = {}
+    for record in records:
+        message = json.loads(record['body'])
+        message_ids[message['id']] = record['messageId']
+        messages.append(message)
+    applied, failed = _apply_in_order(messages, apply, merge)
+    LOGGER.info("Write queue drained %s mutations, %s left for retry", len(applied), len(failed))     # noqa: E501
+    return {'batchItemFailures': [{'itemIdentifier': message_ids[message_id]} for message_id in failed]}     # noqa: E501
+
+
+def drain_queue(queue, apply, merge=None, max_messages=100,
+                debounce=WRITE_QUEUE_DEBOUNCE):
+    """To apply the oldest mutations of a local queue.
+
+    The mutations of a user queued less than debounce seconds ago are left
+    for a later drain, so that a burst of changes is coalesced.
+    """
+    messages = queue.receive(max_messages)
+    settled_at = time.time() - debounce
+    recent = set(message['user'] for message in messages if message['queued_at'] > settled_at)     # noqa: E501
+    messages = [message for message in messages if message['user'] not in recent]     # noqa: E501
+    applied, failed = _apply_in_order(messages, apply, merge)
+    queue.delete(set(applied))
+    LOGGER.info("Write queue drained %s mutations, %s left for retry", len(applied), len(failed))     # noqa: E501
+    return {'applied': len(applied), 'failed': len(failed), 'debounced': len(recent)}     # noqa: E501
@@ -1,4 +1,4 @@
-import { CustomResource,Stack, StackProps, Duration, CfnParameter, CfnOutput, CfnCondition, Fn } from 'aws-cdk-lib';
+import { CustomResource,Stack, StackProps, Duration, CfnParameter, CfnOutput, CfnCondition, Fn, RemovalPolicy } from 'aws-cdk-lib';
 import * as iam from 'aws-cdk-lib/aws-iam';
 import { Construct } from 'constructs';
 import { Function, Runtime, Code } from 'aws-cdk-lib/aws-lambda';
@@ -8,6 +8,12 @@ import { RestApi, EndpointType, Integration, IntegrationType, TokenAuthorizer, D
 import { ServicePrincipal } from 'aws-cdk-lib/aws-iam';
 import { RetentionDays } from 'aws-cdk-lib/aws-logs';
 import { StringParameter } from 'aws-cdk-lib/aws-ssm';
+import { Queue } from 'aws-cdk-lib/aws-sqs';
+import { SqsEventSource } from 'aws-cdk-lib/aws-lambda-event-sources';
+import { Table, AttributeType, BillingMode } from 'aws-cdk-lib/aws-dynamodb';
+import { Rule, Schedule, RuleTargetInput, EventField } from 'aws-cdk-lib/aws-events';
+import { LambdaFunction } from 'aws-cdk-lib/aws-events-targets';
+import { Bucket, BlockPublicAccess, BucketEncryption } from 'aws-cdk-lib/aws-s3';
 
 export class ConnnectUserManagement extends Stack {
   constructor(scope: Construct, id: string, props?: StackProps) {
@@ -92,6 +98,233 @@ export class ConnnectUserManagement extends Stack {
     });
 
 
+    // Optional identity store mapping the SCIM ids onto the Connect users, so the
+    // Azure AD SCIM ids no longer carry the externalId. The write queue needs it
+    // to map the ids answered to queued creates onto the users the drainer creates
+    const identity_store = this.node.tryGetContext('identity_store')
+    const write_queue = this.node.tryGetContext('write_queue')
+    let scim_identity_table: Table | undefined;
+
+    if (identity_store === true || identity_store === 'true' || write_queue === true || write_queue === 'true') {
+      scim_identity_table = new Table(this, 'scim_identity_table', {
+        tableName: 'connect-scim-identities',
+        partitionKey: { name: 'Key', type: AttributeType.STRING },
+        billingMode: BillingMode.PAY_PER_REQUEST,
+        pointInTimeRecovery: true,
+        removalPolicy: RemovalPolicy.RETAIN
+      });
+
+      scim_identity_table.grantReadWriteData(SCIM_provisioning_lambda_role);
+      SCIM_provisioning_lambda_function.addEnvironment('IDENTITY_STORE_MODE', 'dynamodb');
+      SCIM_provisioning_lambda_function.addEnvironment('IDENTITY_TABLE', scim_identity_table.tableName);
+    }
+
+    // Optional table of the recent user creations shared by every container, so
+    // an IdP retrying a POST gets the first response back whichever container
+    // serves it. Without it each container replays the creations it served
+    const idempotency = this.node.tryGetContext('idempotency')
+    let scim_idempotency_table: Table | undefined;
+
+    if (idempotency === true || idempotency === 'true') {
+      scim_idempotency_table = new Table(this, 'scim_idempotency_table', {
+        tableName: 'connect-scim-idempotency',
+        partitionKey: { name: 'Key', type: AttributeType.STRING },
+        billingMode: BillingMode.PAY_PER_REQUEST,
+        timeToLiveAttribute: 'ExpiresAt',
+        removalPolicy: RemovalPolicy.DESTROY
+      });
+
+      scim_idempotency_table.grantReadWriteData(SCIM_provisioning_lambda_role);
+      SCIM_provisioning_lambda_function.addEnvironment('IDEMPOTENCY_MODE', 'dynamodb');
+      SCIM_provisioning_lambda_function.addEnvironment('IDEMPOTENCY_TABLE', scim_idempotency_table.tableName);
+    }
+
+    // Optional read replica of the Connect users answering the SCIM GETs, kept up
+    // to date by the SCIM writes and verified against the instance on a schedule
+    const user_replica = this.node.tryGetContext('user_replica')
+    let scim_user_replica_table: Table | undefined;
+
+    if (user_replica === true || user_replica === 'true') {
+      scim_user_replica_table = new Table(this, 'scim_user_replica_table', {
+        tableName: 'connect-scim-user-replica',
+        partitionKey: { name: 'Key', type: AttributeType.STRING },
+        billingMode: BillingMode.PAY_PER_REQUEST,
+        removalPolicy: RemovalPolicy.DESTROY
+      });
+
+      scim_user_replica_table.grantReadWriteData(SCIM_provisioning_lambda_role);
+      SCIM_provisioning_lambda_function.addEnvironment('USER_REPLICA_MODE', 'dynamodb');
+      SCIM_provisioning_lambda_function.addEnvironment('USER_REPLICA_TABLE', scim_user_replica_table.tableName);
+
+      const SCIM_replica_verifier_function = new Function(this, 'SCIM_replica_verifier_function', {
+        runtime: Runtime.PYTHON_3_9,
+        code: Code.fromAsset(join(__dirname, "../lambdas/user_management")),
+        handler: idp_type + '.verify_handler',
+        description: 'AWS Lambda function to verify the SCIM user replica against the Amazon Connect instance.',
+        timeout: Duration.seconds(900),
+        memorySize: 512,
+        functionName: 'connect-scim-replica-verifier',
+        role: SCIM_provisioning_lambda_role,
+        reservedConcurrentExecutions: 1,
+        environment:{
+          INSTANCE_ID: connect_instance_id.valueAsString,
+          DEFAULT_ROUTING_PROFILE: 'Basic Routing Profile',
+          USER_REPLICA_MODE: 'dynamodb',
+          USER_REPLICA_TABLE: scim_user_replica_table.tableName
+        },
+      });
+
+      new Rule(this, 'scim_replica_verifier_schedule', {
+        description: 'Verify the SCIM user replica against the Amazon Connect instance.',
+        schedule: Schedule.rate(Duration.minutes(10)),
+        targets: [new LambdaFunction(SCIM_replica_verifier_function)]
+      });
+    }
+
+    // Optional write-behind queue, the SCIM requests are acknowledged once queued
+    // and a single drainer applies them at the rate the Connect quota allows
+    if (write_queue === true || write_queue === 'true') {
+      const scim_write_dlq = new Queue(this, 'scim_write_dlq', {
+        queueName: 'connect-scim-write-dlq.fifo',
+        fifo: true,
+        retentionPeriod: Duration.days(14)
+      });
+
+      const scim_write_queue = new Queue(this, 'scim_write_queue', {
+        queueName: 'connect-scim-write.fifo',
+        fifo: true,
+        deliveryDelay: Duration.seconds(5),
+        visibilityTimeout: Duration.seconds(900),
+        deadLetterQueue: {
+          maxReceiveCount: 5,
+          queue: scim_write_dlq
+        }
+      });
+
+      scim_write_queue.grantSendMessages(SCIM_provisioning_lambda_function);
+      SCIM_provisioning_lambda_function.addEnvironment('WRITE_QUEUE_MODE', 'sqs');
+      SCIM_provisioning_lambda_function.addEnvironment('WRITE_QUEUE_URL', scim_write_queue.queueUrl);
+
+      const SCIM_write_drainer_function = new Function(this, 'SCIM_write_drainer_function', {
+        runtime: Runtime.PYTHON_3_9,
+        code: Code.fromAsset(join(__dirname, "../lambdas/user_management")),
+        handler: idp_type + '.drain_handler',
+        description: 'AWS Lambda function to apply the queued IdP SCIM user changes to the Amazon Connect instance.',
+        timeout: Duration.seconds(900),
+        memorySize: 512,
+        functionName: 'connect-scim-write-drainer',
+        role: SCIM_provisioning_lambda_role,
+        reservedConcurrentExecutions: 1,
+        environment:{
+          INSTANCE_ID: connect_instance_id.valueAsString,
+          DEFAULT_ROUTING_PROFILE: 'Basic Routing Profile'
+        },
+      });
+
+      if (scim_identity_table) {
+        SCIM_write_drainer_function.addEnvironment('IDENTITY_STORE_MODE', 'dynamodb');
+        SCIM_write_drainer_function.addEnvironment('IDENTITY_TABLE', scim_identity_table.tableName);
+      }
+
+      if (scim_idempotency_table) {
+        SCIM_write_drainer_function.addEnvironment('IDEMPOTENCY_MODE', 'dynamodb');
+        SCIM_write_drainer_function.addEnvironment('IDEMPOTENCY_TABLE', scim_idempotency_table.tableName);
+      }
+
+      if (scim_user_replica_table) {
+        SCIM_write_drainer_function.addEnvironment('USER_REPLICA_MODE', 'dynamodb');
+        SCIM_write_drainer_function.addEnvironment('USER_REPLICA_TABLE', scim_user_replica_table.tableName);
+      }
+
+      SCIM_write_drainer_function.addEventSource(new SqsEventSource(scim_write_queue, {
+        batchSize: 10,
+        reportBatchItemFailures: true
+      }));
+    }
+
+    // Optional reconciliation of the IdP user exports, run when an export is
+    // uploaded under exports/ with its checkpoints kept next to it. A run
+    // reaching the Lambda timeout invokes the function again to resume
+    const reconcile = this.node.tryGetContext('reconcile')
+
+    if (reconcile === true || reconcile === 'true') {
+      const scim_reconcile_bucket = new Bucket(this, 'scim_reconcile_bucket', {
+        encryption: BucketEncryption.S3_MANAGED,
+        blockPublicAccess: BlockPublicAccess.BLOCK_ALL,
+        enforceSSL: true,
+        eventBridgeEnabled: true,
+        removalPolicy: RemovalPolicy.RETAIN
+      });
+
+      scim_reconcile_bucket.grantReadWrite(SCIM_provisioning_lambda_role);
+
+      const SCIM_reconciler_function = new Function(this, 'SCIM_reconciler_function', {
+        runtime: Runtime.PYTHON_3_9,
+        code: Code.fromAsset(join(__dirname, "../lambdas/user_management")),
+        handler: idp_type + '.reconcile_handler',
+        description: 'AWS Lambda function to reconcile an IdP user export with the Amazon Connect instance.',
+        timeout: Duration.seconds(900),
+        memorySize: 512,
+        functionName: 'connect-scim-reconciler',
+        role: SCIM_provisioning_lambda_role,
+        reservedConcurrentExecutions: 1,
+        environment:{
+          INSTANCE_ID: connect_instance_id.valueAsString,
+          DEFAULT_ROUTING_PROFILE: 'Basic Routing Profile',
+          RECONCILE_CHECKPOINT_BUCKET: scim_reconcile_bucket.bucketName
+        },
+      });
+
+      if (scim_identity_table) {
+        SCIM_reconciler_function.addEnvironment('IDENTITY_STORE_MODE', 'dynamodb');
+        SCIM_reconciler_function.addEnvironment('IDENTITY_TABLE', scim_identity_table.tableName);
+      }
+
+      SCIM_provisioning_lambda_role.addToPolicy(new iam.PolicyStatement({
+        sid: "ReconcileResume",
+        effect: iam.Effect.ALLOW,
+        actions: [
+          "lambda:InvokeFunction"
+        ],
+        resources: [
+          'arn:' + this.partition + ':lambda:' + this.region + ':' + this.account + ':function:connect-scim-reconciler'
+        ]
+      }));
+
+      if (scim_idempotency_table) {
+        SCIM_reconciler_function.addEnvironment('IDEMPOTENCY_MODE', 'dynamodb');
+        SCIM_reconciler_function.addEnvironment('IDEMPOTENCY_TABLE', scim_idempotency_table.tableName);
+      }
+
+      if (scim_user_replica_table) {
+        SCIM_reconciler_function.addEnvironment('USER_REPLICA_MODE', 'dynamodb');
+        SCIM_reconciler_function.addEnvironment('USER_REPLICA_TABLE', scim_user_replica_table.tableName);
+      }
+
+      new Rule(this, 'scim_reconcile_export_uploaded', {
+        description: 'Reconcile an IdP user export uploaded to the reconciliation bucket with the Amazon Connect instance.',
+        eventPattern: {
+          source: ['aws.s3'],
+          detailType: ['Object Created'],
+          detail: {
+            bucket: { name: [scim_reconcile_bucket.bucketName] },
+            object: { key: [{ prefix: 'exports/' }] }
+          }
+        },
+        targets: [new LambdaFunction(SCIM_reconciler_function, {
+          event: RuleTargetInput.fromObject({
+            export_bucket: EventField.fromPath('$.detail.bucket.name'),
+            export_key: EventField.fromPath('$.detail.object.key')
+          })
+        })]
+      });
+
+      new CfnOutput(this, 'scim_reconcile_bucket_name', {
+        description: 'Bucket to upload the IdP user exports to, under exports/, to reconcile them with the Amazon Connect instance.',
+        value: scim_reconcile_bucket.bucketName
+      });
+    }
+
     // Lambda authorizer to authorize SCIM requests to SCIM provisioning Lambda function
     const lambda_authorizer_role = new iam.Role(this, 'lambda_authorizer_role', {
       assumedBy: new iam.ServicePrincipal('lambda.amazonaws.com'),